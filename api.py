@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+import events
+from database import get_queues_with_entries
+from guilds import GUILDS, current_guild, get_guild
+
+# --- CONFIGURATION ---
+# Порт read-only API для сайта гильдии и оверлея. Пусто — API выключено.
+API_PORT = int(os.getenv("API_PORT", "0")) or None
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+# Сколько секунд снимок живёт без пересборки. События сбрасывают его только в своём процессе,
+# а очереди меняют и другие реплики и worker.py — их изменения видны не позже, чем через столько секунд.
+API_SNAPSHOT_TTL = float(os.getenv("API_SNAPSHOT_TTL", "5"))
+
+# --- SNAPSHOT ---
+# guild_id -> готовый JSON всех очередей (body, etag, когда собран). Пересобирается после изменений и по TTL.
+_snapshots = {}
+_runner = None
+
+
+def invalidate():
+    """Сбрасывает снимок текущей гильдии — следующий запрос соберёт его заново."""
+    _snapshots.pop(get_guild().id, None)
+
+
+@events.subscribe(*events.QUEUE_EVENTS)
+def _on_queue_event(event):
+    invalidate()
+
+
+def _build():
+    queues, by_queue = get_queues_with_entries()
+
+    data = {
+        "generated_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "queues": [
+            {
+                "id": q.id,
+                "name": q.name,
+                "description": q.description,
+                "is_locked": q.is_locked,
+                "entries": by_queue[q.id],
+            }
+            for q in queues
+        ],
+    }
+    body = json.dumps(data, ensure_ascii=False).encode()
+    # ETag считаем по содержимому без времени сборки — он не меняется, пока не изменились очереди
+    digest = hashlib.sha1(json.dumps(data["queues"], ensure_ascii=False).encode()).hexdigest()[:16]
+    return body, f'"{digest}"'
+
+
+def get_snapshot():
+    gid = get_guild().id
+    cached = _snapshots.get(gid)
+    if cached is None or time.monotonic() - cached[2] > API_SNAPSHOT_TTL:
+        # ETag — по содержимому: если очереди не менялись, клиент после пересборки всё равно получит 304
+        cached = _snapshots[gid] = (*_build(), time.monotonic())
+    return cached[:2]
+
+
+# --- HTTP ---
+
+async def handle_queues(request: web.Request):
+    gid = request.match_info.get("guild", next(iter(GUILDS)))
+    if gid not in GUILDS: raise web.HTTPNotFound()
+
+    token = current_guild.set(gid)
+    try: body, etag = get_snapshot()
+    finally: current_guild.reset(token)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Access-Control-Allow-Origin": "*"}
+
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get("/api/queues", handle_queues)
+    app.router.add_get("/api/{guild}/queues", handle_queues)
+    return app
+
+
+async def start_api():
+    """Поднимает API на API_PORT (если задан)."""
+    global _runner
+    if not API_PORT: return
+    _runner = web.AppRunner(create_app())
+    await _runner.setup()
+    await web.TCPSite(_runner, API_HOST, API_PORT).start()
+    print(f"🌐 Queue API listening on {API_HOST}:{API_PORT}/api/queues")
+
+
+async def stop_api():
+    if _runner: await _runner.cleanup()
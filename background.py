@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+
+import lag_watchdog
+import tracing
+from metrics import Counter, Histogram, Gauge
+
+# --- CONFIGURATION ---
+# Вид задачи -> (сколько выполняется одновременно, сколько всего может ждать + выполняться)
+KINDS = {
+    "sheets": (int(os.getenv("SHEETS_CONCURRENCY", "4")), int(os.getenv("SHEETS_BACKLOG", "200"))),
+}
+DEFAULT_KIND = (8, 100)
+# Сколько хендлер ждёт места в переполненной очереди, прежде чем задача будет отброшена
+SUBMIT_TIMEOUT = float(os.getenv("BACKGROUND_SUBMIT_TIMEOUT", "10"))
+# Сколько при остановке ждём недоделанные задачи
+DRAIN_TIMEOUT = float(os.getenv("BACKGROUND_DRAIN_TIMEOUT", "30"))
+
+background_tasks = Counter("bot_background_tasks_total", "Background tasks by result", ("kind", "result"))
+background_seconds = Histogram("bot_background_seconds", "Background task duration", ("kind",))
+
+
+class _Pool:
+    def __init__(self, kind, limit, backlog):
+        self.kind = kind
+        self.running = asyncio.Semaphore(limit)
+        self.slots = asyncio.Semaphore(backlog)
+        self.tasks = set()
+
+
+_pools = {}
+
+Gauge("bot_background_pending", "Background tasks waiting or running", lambda: {k: len(p.tasks) for k, p in _pools.items()}, "kind")
+
+
+def _pool(kind):
+    pool = _pools.get(kind)
+    if pool is None:
+        pool = _pools[kind] = _Pool(kind, *KINDS.get(kind, DEFAULT_KIND))
+    return pool
+
+
+async def submit(kind, fn, *args, **kwargs):
+    """
+    Запускает fn(*args, **kwargs) в фоне под присмотром.
+
+    Одновременно выполняется не больше лимита вида задачи; если очередь вида полна,
+    вызывающий ждёт (до SUBMIT_TIMEOUT, потом задача отбрасывается с записью в лог).
+    Задача наследует контекст вызывающего — в том числе гильдию.
+    Возвращает asyncio.Task или None, если задача отброшена.
+    """
+    pool = _pool(kind)
+    try:
+        await asyncio.wait_for(pool.slots.acquire(), SUBMIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        background_tasks.inc(kind, "dropped")
+        print(f"❌ Background '{kind}' is full, dropped {getattr(fn, '__name__', fn)}{args}")
+        return None
+
+    task = asyncio.create_task(_run(pool, fn, args, kwargs))
+    pool.tasks.add(task)
+    task.add_done_callback(pool.tasks.discard)
+    return task
+
+
+async def _run(pool, fn, args, kwargs):
+    try:
+        async with pool.running:
+            lag_watchdog.tag(f"background {pool.kind} {getattr(fn, '__name__', '')}")
+            started = time.perf_counter()
+            try:
+                # Спан попадёт в трейс апдейта, запустившего задачу
+                with tracing.span(getattr(fn, "__name__", "task"), "background", pool=pool.kind):
+                    await fn(*args, **kwargs)
+                background_tasks.inc(pool.kind, "ok")
+            except asyncio.CancelledError:
+                background_tasks.inc(pool.kind, "cancelled")
+                raise
+            except Exception as e:
+                # Ошибка фоновой задачи не должна теряться молча
+                background_tasks.inc(pool.kind, "error")
+                trace_id = tracing.correlation_id()
+                print(f"❌ Background '{pool.kind}' {getattr(fn, '__name__', fn)} failed: {type(e).__name__}: {e}"
+                      + (f" (trace {trace_id})" if trace_id else ""))
+            finally:
+                background_seconds.observe(time.perf_counter() - started, pool.kind)
+    finally:
+        pool.slots.release()
+
+
+async def drain(timeout=DRAIN_TIMEOUT):
+    """При остановке: даём фоновым задачам доделаться, оставшиеся отменяем."""
+    tasks = [t for pool in _pools.values() for t in pool.tasks]
+    if not tasks: return
+    print(f"⏳ Waiting for {len(tasks)} background task(s)...")
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending: task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        print(f"⚠️ Cancelled {len(pending)} background task(s) after {timeout:g} s")
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+from aiogram.exceptions import TelegramBadRequest
+
+import events
+from loader import bot
+from database import session, Settings, get_queues_with_entries
+from guilds import get_guild
+from metrics import Gauge
+
+# --- CONFIGURATION ---
+# Чат, где висит закреплённое табло, задаётся у гильдии (board_chat_id). Пусто — табло выключено.
+# "combined" — одно сообщение на все очереди, "per_queue" — по сообщению на очередь
+BOARD_MODE = os.getenv("BOARD_MODE", "combined")
+# Изменения копятся столько секунд и уходят одним редактированием
+BOARD_DEBOUNCE = float(os.getenv("BOARD_DEBOUNCE", "5"))
+
+MAX_TEXT = 4096
+ALL = "all"
+
+# --- STATE ---
+# guild_id -> изменившиеся очереди / задача отложенного обновления
+_dirty = {}
+_flush_tasks = {}
+
+Gauge("bot_board_pending", "Board queues waiting for refresh", lambda: {gid: len(d) for gid, d in _dirty.items()}, "guild")
+
+
+def mark_dirty(qid=None):
+    """Отмечает, что очередь изменилась (None — все очереди). Табло обновится после паузы."""
+    guild = get_guild()
+    if not guild.board_chat_id: return
+
+    _dirty.setdefault(guild.id, set()).add(ALL if qid is None or BOARD_MODE == "combined" else qid)
+    task = _flush_tasks.get(guild.id)
+    if task is None or task.done():
+        # Задача наследует контекст — обновление пойдёт в базе этой же гильдии
+        _flush_tasks[guild.id] = asyncio.create_task(_flush_loop(guild.id))
+
+
+@events.subscribe(*events.QUEUE_EVENTS)
+def _on_queue_event(event):
+    mark_dirty(event.queue_id)
+
+
+async def _flush_loop(guild_id):
+    # Пока во время обновления приходят новые изменения — ждём ещё один интервал
+    dirty = _dirty[guild_id]
+    while dirty:
+        await asyncio.sleep(BOARD_DEBOUNCE)
+        keys = set(dirty)
+        dirty.clear()
+        try:
+            await refresh(keys)
+        except Exception as e:
+            print(f"❌ Board refresh error: {e}")
+
+
+# --- RENDER ---
+
+def _render_queue(q, nicks):
+    lock = " 🔒" if q.is_locked else ""
+    text = f"🛡 <b>{q.name}</b>{lock} — {len(nicks)}\n"
+    if not nicks: return text + "<i>Пусто</i>\n"
+    return text + "".join(f"{i}. {n}\n" for i, n in enumerate(nicks, 1))
+
+
+def _fit(text):
+    return text if len(text) <= MAX_TEXT else text[:MAX_TEXT - 1] + "…"
+
+
+async def refresh(keys=None):
+    """Перерисовывает табло текущей гильдии. keys — {ALL} или набор id очередей (для per_queue)."""
+    chat_id = get_guild().board_chat_id
+    if not chat_id: return
+
+    if BOARD_MODE == "combined":
+        queues, by_queue = get_queues_with_entries()
+        text = "📋 <b>Очереди гильдии</b>\n\n" + "\n".join(_render_queue(q, by_queue[q.id]) for q in queues)
+        return await _publish(chat_id, f"board_msg_{ALL}", _fit(text))
+
+    queues, by_queue = get_queues_with_entries(None if not keys or ALL in keys else keys)
+    for q in queues:
+        await _publish(chat_id, f"board_msg_{q.id}", _fit(_render_queue(q, by_queue[q.id])))
+
+
+async def _publish(chat_id, setting_key, text):
+    setting = session.query(Settings).filter_by(key=setting_key).first()
+    if setting:
+        try:
+            return await bot.edit_message_text(text, chat_id=chat_id, message_id=int(setting.value), parse_mode="HTML")
+        except TelegramBadRequest as e:
+            # Табло и так актуально (например, после рестарта без кэша отрисовки)
+            if "message is not modified" in e.message: return
+            # Сообщение удалили руками — создадим заново
+            if "not found" not in e.message: raise
+
+    msg = await bot.send_message(chat_id, text, parse_mode="HTML", disable_notification=True)
+    try:
+        await bot.pin_chat_message(chat_id, msg.message_id, disable_notification=True)
+    except TelegramBadRequest as e:
+        print(f"⚠️ Board: can't pin message ({e.message}). Дай боту права на закреп.")
+
+    if setting: setting.value = str(msg.message_id)
+    else: session.add(Settings(key=setting_key, value=str(msg.message_id)))
+    session.commit()
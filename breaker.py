@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+from metrics import Counter, Gauge
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+breaker_trips = Counter("bot_breaker_trips_total", "Circuit breaker openings", ("breaker",))
+breaker_rejected = Counter("bot_breaker_rejected_total", "Calls rejected by an open circuit breaker", ("breaker",))
+
+_breakers = {}
+
+Gauge("bot_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+      lambda: {name: _STATE_VALUE[b.state] for name, b in _breakers.items()}, "breaker")
+
+
+def describe(error):
+    """"TimeoutError" вместо "TimeoutError: " у исключений без текста."""
+    return f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+
+
+class CircuitOpen(Exception):
+    """Внешний сервис считается недоступным — вызов не делался."""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для блокирующих вызовов внешнего сервиса (выполняются в потоке, с таймаутом).
+
+    После failures ошибок подряд размыкается: вызовы сразу получают CircuitOpen, никто
+    не ждёт таймаута. Раз в retry_after секунд в фоне выполняется probe() (полуоткрытое
+    состояние); удалась — предохранитель снова замкнут.
+
+    is_failure(error) решает, считать ли ошибку сбоем сервиса. Ответ вроде "нет доступа" —
+    это настройка, а не сбой: сервис ответил, счётчик ошибок сбрасывается.
+
+    Таймаут отменяет ожидание, но не поток: вызов, не уложившийся в timeout, может
+    ещё завершиться и сделать своё дело.
+
+    Состояние живёт в памяти процесса. on_change(breaker) — async-функция, которую зовут
+    при размыкании и после каждой проверки: через неё состояние видят другие процессы.
+    """
+
+    def __init__(self, name, failures, retry_after, timeout, probe, is_failure=None, on_change=None):
+        self.name = name
+        self.failures = failures
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.probe = probe
+        self.is_failure = is_failure or (lambda error: True)
+        self.state = CLOSED
+        self.errors = 0
+        self.opened_at = None
+        self.last_error = None
+        self.on_change = on_change
+        self._probe_task = None
+        self._notify_tasks = set()
+        _breakers[name] = self
+
+    async def call(self, fn, *args):
+        """fn(*args) в потоке с таймаутом. CircuitOpen — если предохранитель разомкнут."""
+        if self.state != CLOSED:
+            breaker_rejected.inc(self.name)
+            raise CircuitOpen(f"{self.name} is unavailable since {time.strftime('%H:%M:%S', time.localtime(self.opened_at))}")
+        try:
+            result = await asyncio.wait_for(asyncio.to_thread(fn, *args), self.timeout)
+        except Exception as e:
+            if self.is_failure(e): self._failed(e)
+            else: self.errors = 0
+            raise
+        self.errors = 0
+        return result
+
+    def _failed(self, error):
+        self.errors += 1
+        self.last_error = describe(error)
+        if self.state == CLOSED and self.errors >= self.failures: self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.time()
+        breaker_trips.inc(self.name)
+        print(f"🔌 {self.name}: {self.errors} errors in a row ({self.last_error}), failing fast for {self.retry_after:g} s")
+        self._changed()
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    def _changed(self):
+        if not self.on_change: return
+        task = asyncio.create_task(self.on_change(self))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+    async def _probe_loop(self):
+        while self.state != CLOSED:
+            await asyncio.sleep(self.retry_after)
+            self.state = HALF_OPEN
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self.probe), self.timeout)
+            except Exception as e:
+                self.state = OPEN
+                self.last_error = describe(e)
+                print(f"🔌 {self.name}: probe failed ({self.last_error}), next try in {self.retry_after:g} s")
+                self._changed()
+                continue
+            self.state = CLOSED
+            self.errors = 0
+            print(f"🔌 {self.name}: available again after {time.time() - self.opened_at:.0f} s")
+            self._changed()
+
+    async def stop(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+
+
+async def stop_all():
+    """Останавливает фоновые проверки всех предохранителей (при остановке процесса)."""
+    for b in list(_breakers.values()): await b.stop()
@@ -0,0 +1,89 @@
+import inspect
+from aiogram import Router, types
+from aiogram.fsm.context import FSMContext
+
+# --- CALLBACK DATA ---
+# Формат: "код_действия:арг1:арг2", например "do_join:3:17".
+# Код без аргументов — просто "menu_join".
+
+SEP = ":"
+MAX_LEN = 64  # Лимит Telegram на callback_data (в байтах)
+
+
+def pack(action, *args):
+    """Собирает callback_data для кнопки."""
+    data = SEP.join([action, *map(str, args)])
+    if len(data.encode()) > MAX_LEN:
+        raise ValueError(f"callback_data too long: {data}")
+    return data
+
+
+class CallbackDispatcher:
+    """
+    Таблица "код действия -> обработчик".
+    Вместо перебора десятков F.data.startswith(...) — один поиск в словаре.
+    """
+
+    def __init__(self):
+        # code -> (функция, типы аргументов, сколько из них обязательны, нужен ли state)
+        self.handlers = {}
+
+    def action(self, code, *arg_types):
+        """
+        Регистрирует обработчик. Аргументы приходят уже приведёнными к типам:
+
+            @cb.action("view_q", int)
+            async def view_queue(callback, qid): ...
+
+        Аргумент со значением по умолчанию можно не передавать ("m_users_list" = "m_users_list:0").
+        """
+        if SEP in code:
+            raise ValueError(f"Action code must not contain '{SEP}': {code}")
+
+        def decorator(func):
+            if code in self.handlers:
+                raise ValueError(f"Duplicate callback action: {code}")
+            params = inspect.signature(func).parameters
+            wants_state = "state" in params
+            # Первый параметр — callback, state передаётся по имени
+            positional = [p for name, p in params.items() if name != "state"][1:1 + len(arg_types)]
+            required = sum(p.default is inspect.Parameter.empty for p in positional)
+            self.handlers[code] = (func, arg_types, required, wants_state)
+            return func
+        return decorator
+
+    def resolve(self, data):
+        """Возвращает (обработчик, аргументы, нужен ли state) или None, если кнопка неизвестна."""
+        code, *raw = data.split(SEP)
+        entry = self.handlers.get(code)
+        if not entry: return None
+
+        func, arg_types, required, wants_state = entry
+        # Лишние или недостающие аргументы — кнопка от старой раскладки
+        if not required <= len(raw) <= len(arg_types): return None
+        try:
+            args = [t(v) for t, v in zip(arg_types, raw)]
+        except ValueError:
+            return None
+        return func, args, wants_state
+
+    async def dispatch(self, callback: types.CallbackQuery, state: FSMContext):
+        resolved = self.resolve(callback.data or "")
+        if not resolved:
+            # Кнопка из старого сообщения (до обновления бота) или мусор
+            return await callback.answer("⚠️ Меню устарело. Нажми /start", show_alert=True)
+
+        func, args, wants_state = resolved
+        if wants_state:
+            return await func(callback, *args, state=state)
+        return await func(callback, *args)
+
+
+cb = CallbackDispatcher()
+
+router = Router()
+
+
+@router.callback_query()
+async def dispatch_callback(callback: types.CallbackQuery, state: FSMContext):
+    return await cb.dispatch(callback, state)
@@ -1,6 +1,14 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Index
+from sqlalchemy import func, inspect, text
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+import time
+from dataclasses import dataclass
 from datetime import datetime
+from cachetools import LRUCache
+
+from guilds import DEFAULT_GUILD, GUILDS, current_guild, get_guild, in_use
+import metrics
+import tracing
 
 Base = declarative_base()
 
@@ -43,6 +51,8 @@ class QueueEntry(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     queue_type_id = Column(Integer, ForeignKey('queue_types.id'))
     character_name = Column(String)
+    # Когда встал в очередь — для планировщика раздачи (старые записи получили время миграции)
+    created_at = Column(DateTime, default=datetime.utcnow)
     user = relationship("User")
     queue = relationship("QueueType")
 
@@ -54,6 +64,18 @@ class RewardHistory(Base):
     queue_name = Column(String)
     issued_by = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # Последняя награда игрока в очереди — поиском по индексу, без перебора истории
+    __table_args__ = (Index("ix_reward_history_queue_user_time", "queue_name", "user_id", "timestamp"),)
+
+class SheetOutbox(Base):
+    """Строки лога, не записанные в Google Sheets (сервис лежал) — допишутся позже, см. utils.flush_outbox."""
+    __tablename__ = 'sheet_outbox'
+    id = Column(Integer, primary_key=True)
+    logged_at = Column(String)
+    queue_name = Column(String)
+    main_nick = Column(String)
+    char_nick = Column(String)
+    status = Column(String)
 
 class ScheduledAnnouncement(Base):
     __tablename__ = 'announcements'
@@ -65,43 +87,191 @@ class ScheduledAnnouncement(Base):
     is_active = Column(Boolean, default=True)
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
+# У каждой гильдии свой файл SQLite. Открытыми держим только недавно активные.
 
-engine = create_engine('sqlite:///guild_bot.db', echo=False)
-Session = sessionmaker(bind=engine)
-session = Session()
+MAX_OPEN_GUILDS = 32
+# Вытесненную гильдию закрываем, только если в ней никто не работает и к базе не обращались столько секунд
+EVICT_GRACE = 60
 
-def init_db():
+
+class _GuildSessions(LRUCache):
+    """
+    guild_id -> сессия. Вытесненная гильдия не закрывается сразу: её апдейт или задача
+    могут стоять на await с объектами из этой сессии. Она ждёт в _retired, пока не освободится.
+    """
+
+    def popitem(self):
+        gid, sess = super().popitem()
+        _retired[gid] = sess
+        return gid, sess
+
+
+_sessions = _GuildSessions(maxsize=MAX_OPEN_GUILDS)
+# Вытесненные, но ещё не закрытые сессии
+_retired = {}
+# guild_id -> когда последний раз брали сессию (time.monotonic)
+_last_used = {}
+
+
+def _close_idle():
+    """Закрывает вытесненные гильдии, в которых никто не работает дольше EVICT_GRACE."""
+    idle_before = time.monotonic() - EVICT_GRACE
+    for gid, sess in list(_retired.items()):
+        if in_use[gid] or _last_used.get(gid, 0) > idle_before: continue
+        del _retired[gid]
+        _close(sess)
+
+
+def _close(sess):
+    engine = sess.get_bind()
+    sess.close()
+    engine.dispose()
+
+
+def close_sessions():
+    """Закрывает базы всех гильдий сразу (прогоны инструментов на свежей базе)."""
+    for sess in [*_sessions.values(), *_retired.values()]: _close(sess)
+    _sessions.clear()
+    _retired.clear()
+
+# Identity map слабая: объект живёт в ней, пока на него ссылается хендлер. Рост тут — признак утечки ссылок.
+metrics.Gauge("bot_orm_identity_map", "ORM objects in the session identity map",
+              lambda: {gid: len(s.identity_map) for gid, s in list(_sessions.items())}, "guild")
+
+
+def create_guild_engine(guild):
+    engine = create_engine(f"sqlite:///{guild.db_path}", echo=False)
+    return tracing.instrument_engine(metrics.instrument_engine(engine, guild.id))
+
+
+def get_session():
+    """Сессия базы гильдии из текущего контекста (см. guilds.current_guild)."""
+    guild = get_guild()
+    _last_used[guild.id] = time.monotonic()
+    sess = _sessions.get(guild.id)
+    if sess is None:
+        # Гильдия могла быть вытеснена, но ещё не закрыта — берём ту же сессию, а не открываем вторую
+        sess = _retired.pop(guild.id, None)
+        if sess is None:
+            engine = create_guild_engine(guild)
+            sess = sessionmaker(bind=engine)()
+            _sessions[guild.id] = sess
+            _seed(sess, engine, guild)
+        else:
+            _sessions[guild.id] = sess
+        _close_idle()
+    return sess
+
+
+class _SessionProxy:
+    """Ведёт себя как обычная сессия, но каждый раз берёт сессию текущей гильдии."""
+
+    def __getattr__(self, name):
+        return getattr(get_session(), name)
+
+
+session = _SessionProxy()
+
+
+def _migrate(engine):
+    """Досоздаёт колонки и индексы, появившиеся после создания базы (create_all их не трогает)."""
+    columns = {c["name"] for c in inspect(engine).get_columns("queue_entries")}
+    if "created_at" not in columns:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE queue_entries ADD COLUMN created_at DATETIME"))
+            conn.execute(text("UPDATE queue_entries SET created_at = CURRENT_TIMESTAMP"))
+    for table in Base.metadata.tables.values():
+        for index in table.indexes: index.create(engine, checkfirst=True)
+
+
+def _seed(sess, engine, guild):
     Base.metadata.create_all(engine)
-    
-    queues = [
-        "Камень доблести", "Метеориты", "Жемчужины Фу Си", "Опыт в диск",
-        "Проходки в УФ", "Знаки Единства", "Колода карт", "Сущность карты",
-        "Камень божества", "Камни бессмертных", "Цилинь"
-    ]
-    for q_name in queues:
-        if not session.query(QueueType).filter_by(name=q_name).first():
-            session.add(QueueType(name=q_name))
-            
-    if not session.query(Settings).filter_by(key="default_limit").first():
-        session.add(Settings(key="default_limit", value="1"))
-        
-    session.commit()
+    _migrate(engine)
+
+    # Каталог досоздаём одним запросом на все очереди, а не SELECT на каждую
+    existing = {name for (name,) in sess.query(QueueType.name)}
+    sess.add_all([QueueType(name=q_name) for q_name in guild.queues if q_name not in existing])
+
+    if not sess.get(Settings, "default_limit"):
+        sess.add(Settings(key="default_limit", value="1"))
+
+    sess.commit()
+
+
+def init_db():
+    """Создаёт таблицы и каталог очередей во всех гильдиях."""
+    for gid in GUILDS:
+        token = current_guild.set(gid)
+        try: get_session()
+        finally: current_guild.reset(token)
+
+# --- МОДЕЛИ ДЛЯ ЧТЕНИЯ ---
+# Горячие экраны (меню, очереди, список игроков) читают только нужные колонки в неизменяемые
+# строки: ORM-объекты не создаются, не держатся в identity map и не перечитываются после commit.
+
+@dataclass(frozen=True, slots=True)
+class QueueRow:
+    id: int
+    name: str
+    description: str
+    is_locked: bool
+
+
+@dataclass(frozen=True, slots=True)
+class EntryRow:
+    id: int
+    queue_type_id: int
+    queue_name: str
+    character_name: str
+
+
+@dataclass(frozen=True, slots=True)
+class CharacterRow:
+    id: int
+    nickname: str
+    is_main: bool
+
+
+@dataclass(frozen=True, slots=True)
+class PlayerRow:
+    id: int
+    telegram_id: int
+    username: str
+    main_nick: str
+    alts: tuple
+
 
 # --- ФУНКЦИИ ЗАПРОСОВ (Перенесли сюда) ---
 
 def ensure_user(telegram_id, username):
     """Получает или создает пользователя."""
     user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    masters = get_guild().masters
     if not user:
-        is_first = session.query(User).count() == 0
-        user = User(telegram_id=telegram_id, username=username, is_master=is_first)
+        if masters:
+            is_master = telegram_id in masters
+        else:
+            # Без MASTER_IDS (только гильдия из .env) мастером, как раньше, становится первый игрок
+            is_master = get_guild().id == DEFAULT_GUILD and session.query(User).count() == 0
+        user = User(telegram_id=telegram_id, username=username, is_master=is_master)
         session.add(user)
         session.commit()
+    elif telegram_id in masters and not user.is_master:
+        user.is_master = True
+        session.commit()
     return user
 
 def get_user_active_queues(user_id):
-    """Возвращает список активных записей пользователя."""
-    return session.query(QueueEntry).filter_by(user_id=user_id).all()
+    """Активные записи пользователя (EntryRow) с названиями очередей — одним запросом."""
+    rows = (session.query(QueueEntry.id, QueueEntry.queue_type_id, QueueType.name, QueueEntry.character_name)
+            .join(QueueType, QueueEntry.queue_type_id == QueueType.id)
+            .filter(QueueEntry.user_id == user_id).order_by(QueueEntry.id))
+    return [EntryRow(*r) for r in rows]
+
+
+def get_queue_counts():
+    """{id очереди: сколько записей} — одним запросом на все очереди."""
+    return dict(session.query(QueueEntry.queue_type_id, func.count(QueueEntry.id)).group_by(QueueEntry.queue_type_id).all())
 
 
 def get_effective_limit_logic(user):
@@ -112,4 +282,54 @@ def get_effective_limit_logic(user):
         
     # Иначе берем общий из настроек
     setting = session.query(Settings).filter_by(key="default_limit").first()
-    return int(setting.value) if setting else 1
\ No newline at end of file
+    return int(setting.value) if setting else 1
+
+
+def get_active_queues(qids=None):
+    """Активные очереди (QueueRow) по порядку."""
+    q_query = (session.query(QueueType.id, QueueType.name, QueueType.description, QueueType.is_locked)
+               .filter_by(is_active=True).order_by(QueueType.id))
+    if qids: q_query = q_query.filter(QueueType.id.in_(qids))
+    return [QueueRow(*r) for r in q_query]
+
+
+def get_queue_nicks(qid):
+    """Ники в очереди по порядку записи."""
+    return [nick for (nick,) in session.query(QueueEntry.character_name).filter_by(queue_type_id=qid).order_by(QueueEntry.id)]
+
+
+def get_characters(user_id):
+    """Персонажи игрока (CharacterRow) в порядке добавления."""
+    rows = session.query(Character.id, Character.nickname, Character.is_main).filter_by(user_id=user_id).order_by(Character.id)
+    return [CharacterRow(*r) for r in rows]
+
+
+def get_players_page(offset, limit):
+    """Игроки с персонажами (PlayerRow) для списка мастера: (всего, страница) — тремя запросами на страницу."""
+    total = session.query(User.id).filter(User.characters.any()).count()
+    users = (session.query(User.id, User.telegram_id, User.username).filter(User.characters.any())
+             .order_by(User.id).offset(offset).limit(limit).all())
+
+    chars = {}
+    for user_id, nick, is_main in (session.query(Character.user_id, Character.nickname, Character.is_main)
+                                   .filter(Character.user_id.in_([u.id for u in users])).order_by(Character.id)):
+        chars.setdefault(user_id, []).append((nick, is_main))
+
+    page = []
+    for uid, telegram_id, username in users:
+        own = chars.get(uid, [])
+        main_nick = next((n for n, is_main in own if is_main), None)
+        page.append(PlayerRow(uid, telegram_id, username, main_nick, tuple(n for n, is_main in own if not is_main)))
+    return total, page
+
+
+def get_queues_with_entries(qids=None):
+    """Активные очереди и ники в них по порядку записи — двумя запросами на все очереди сразу."""
+    queues = get_active_queues(qids)
+
+    by_queue = {q.id: [] for q in queues}
+    rows = (session.query(QueueEntry.queue_type_id, QueueEntry.character_name)
+            .filter(QueueEntry.queue_type_id.in_(by_queue.keys()))
+            .order_by(QueueEntry.id).all())
+    for qid, nick in rows: by_queue[qid].append(nick)
+    return queues, by_queue
@@ -0,0 +1,133 @@
+"""
+Доменные события: хендлер меняет очереди, делает commit и один раз сообщает, что произошло.
+
+Всё остальное (запись в Google Sheets, табло, снимок для API, статистика) подписывается
+на события и само решает, как и когда реагировать — например, копит записи пачкой.
+
+    @events.subscribe(EntryJoined, EntryLeft)
+    def on_change(event): ...
+
+    await events.emit(EntryJoined(...))
+"""
+import inspect
+from collections import defaultdict
+from dataclasses import dataclass
+
+from metrics import Counter
+
+domain_events = Counter("bot_domain_events_total", "Domain events by queue", ("event", "queue"))
+subscriber_errors = Counter("bot_event_subscriber_errors_total", "Failed event subscribers", ("subscriber",))
+
+
+# --- СОБЫТИЯ ---
+# actor — username того, кто сделал действие (игрок или мастер)
+
+@dataclass(frozen=True, slots=True)
+class EntryJoined:
+    queue_id: int
+    queue_name: str
+    character: str
+    main_nick: str
+    actor: str
+    by_master: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class EntryLeft:
+    queue_id: int
+    queue_name: str
+    character: str
+    main_nick: str
+    actor: str
+    # "left" — вышел сам, "kicked" — удалил мастер, "character_removed" — удалён персонаж, "banned" — бан
+    reason: str = "left"
+
+
+@dataclass(frozen=True, slots=True)
+class EntrySwapped:
+    queue_id: int
+    queue_name: str
+    old_character: str
+    new_character: str
+    main_nick: str
+    actor: str
+    # "swap" — замена персонажа, "main_changed" — смена основы, "character_removed" — замена удалённого на основу
+    reason: str = "swap"
+
+
+@dataclass(frozen=True, slots=True)
+class RewardIssued:
+    queue_id: int
+    queue_name: str
+    character: str
+    main_nick: str
+    issued_by: str
+    user_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class CharacterRemoved:
+    user_id: int
+    nickname: str
+    actor: str
+
+
+@dataclass(frozen=True, slots=True)
+class QueueLocked:
+    queue_id: int
+    queue_name: str
+    locked: bool
+
+
+@dataclass(frozen=True, slots=True)
+class QueueDescriptionChanged:
+    queue_id: int
+
+
+@dataclass(frozen=True, slots=True)
+class LimitChanged:
+    # None — общий лимит гильдии
+    user_id: int
+    limit: int
+
+
+# События, после которых меняется состав или вид очередей
+QUEUE_EVENTS = (EntryJoined, EntryLeft, EntrySwapped, RewardIssued, QueueLocked, QueueDescriptionChanged)
+ALL_EVENTS = QUEUE_EVENTS + (CharacterRemoved, LimitChanged)
+
+
+# --- ШИНА ---
+
+# тип события -> подписчики в порядке подписки
+_subscribers = defaultdict(list)
+
+
+def subscribe(*event_types):
+    """Декоратор: функция (обычная или async) будет вызвана для каждого события этих типов."""
+    def decorator(fn):
+        for event_type in event_types: _subscribers[event_type].append(fn)
+        return fn
+    return decorator
+
+
+async def emit(*events):
+    """
+    Раздаёт события подписчикам — вызывать после commit. Подписчики работают в контексте
+    хендлера (гильдия, трейс). Ошибка подписчика пишется в лог и не мешает остальным.
+    """
+    for event in events:
+        name = type(event).__name__
+        for fn in _subscribers[type(event)]:
+            try:
+                result = fn(event)
+                if inspect.isawaitable(result): await result
+            except Exception as e:
+                subscriber_errors.inc(fn.__qualname__)
+                print(f"❌ Event subscriber {fn.__qualname__} failed on {name}: {type(e).__name__}: {e}")
+
+
+# --- СТАТИСТИКА ---
+
+@subscribe(*ALL_EVENTS)
+def _count(event):
+    domain_events.inc(type(event).__name__, getattr(event, "queue_name", ""))
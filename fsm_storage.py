@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from guilds import resolve_guild
+
+# --- НАСТРОЙКИ ---
+# Незавершённые сценарии (регистрация, объявление и т.п.) живут сутки
+STATE_TTL = 24 * 60 * 60
+# Как часто сбрасываем накопленные изменения в БД одной транзакцией
+FLUSH_INTERVAL = 1.0
+# Как часто чистим просроченные состояния
+SWEEP_INTERVAL = 10 * 60
+# Чистые записи, к которым не обращались столько секунд, выкидываем из памяти
+MEMORY_IDLE = 5 * 60
+
+
+class GuildKeyBuilder(DefaultKeyBuilder):
+    """
+    Ключ FSM с гильдией впереди: сценарий, начатый в одной гильдии, не всплывает в другой.
+    Гильдия берётся по чату и игроку ключа, как в GuildMiddleware, — aiogram читает
+    состояние раньше, чем отрабатывают наши middleware.
+    """
+
+    def build(self, key, part=None):
+        return f"{resolve_guild(key.chat_id, key.user_id)}:{super().build(key, part)}"
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite: переживает рестарт и не копит брошенные сценарии.
+
+    Запись батчится: set_state/set_data меняют строку в памяти, а в БД всё
+    уходит раз в FLUSH_INTERVAL. Состояния старше STATE_TTL удаляются.
+    """
+
+    def __init__(self, path, ttl=STATE_TTL, flush_interval=FLUSH_INTERVAL, sweep_interval=SWEEP_INTERVAL):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.key_builder = GuildKeyBuilder(with_destiny=True)
+
+        # key -> [state, data, время последнего обращения]
+        self._rows = {}
+        self._dirty = set()
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._tasks = []
+
+    # --- ПОДКЛЮЧЕНИЕ ---
+
+    async def _connect(self):
+        async with self._lock:
+            if self._db: return self._db
+            db = await aiosqlite.connect(self.path)
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS fsm_states ("
+                "key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at REAL NOT NULL)"
+            )
+            await db.execute("CREATE INDEX IF NOT EXISTS ix_fsm_states_updated_at ON fsm_states (updated_at)")
+            await db.commit()
+            self._db = db
+            self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._sweep_loop())]
+            return db
+
+    async def _row(self, key):
+        k = self.key_builder.build(key)
+        row = self._rows.get(k)
+        if row is None:
+            db = await self._connect()
+            async with db.execute(
+                "SELECT state, data FROM fsm_states WHERE key = ? AND updated_at >= ?",
+                (k, time.time() - self.ttl),
+            ) as cur:
+                found = await cur.fetchone()
+            state, data = (found[0], json.loads(found[1] or "{}")) if found else (None, {})
+            # Повторная проверка: пока ждали SELECT, строку мог создать соседний апдейт
+            row = self._rows.setdefault(k, [state, data, 0])
+        row[2] = time.monotonic()
+        return k, row
+
+    # --- ИНТЕРФЕЙС BaseStorage ---
+
+    async def set_state(self, key, state=None):
+        k, row = await self._row(key)
+        row[0] = state.state if isinstance(state, State) else state
+        self._dirty.add(k)
+
+    async def get_state(self, key):
+        _, row = await self._row(key)
+        return row[0]
+
+    async def set_data(self, key, data):
+        k, row = await self._row(key)
+        row[1] = data.copy()
+        self._dirty.add(k)
+
+    async def get_data(self, key):
+        _, row = await self._row(key)
+        return row[1].copy()
+
+    async def preload(self):
+        """Поднимает в память все живые состояния одним запросом — после рестарта их не читают по одному."""
+        db = await self._connect()
+        async with db.execute(
+            "SELECT key, state, data FROM fsm_states WHERE updated_at >= ?", (time.time() - self.ttl,)
+        ) as cur:
+            found = await cur.fetchall()
+        now = time.monotonic()
+        for k, state, data in found:
+            self._rows.setdefault(k, [state, json.loads(data or "{}"), now])
+        return len(found)
+
+    async def close(self):
+        for task in self._tasks: task.cancel()
+        # Ждём, пока фоновый сброс остановится: иначе его запись смешается с финальной на том же соединении
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db:
+            await self.flush()
+            await self._db.close()
+            self._db = None
+
+    # --- ФОНОВАЯ РАБОТА ---
+
+    async def flush(self):
+        """Пишет все изменённые строки одной транзакцией; не вышло — по одной, чтобы сбойная не держала остальные."""
+        if not self._dirty or not self._db: return
+        dirty, self._dirty = self._dirty, set()
+        failed, error = [], None
+        try:
+            rows = self._serialize(dirty)
+            try:
+                await self._write(rows)
+                return
+            except Exception:
+                await self._db.rollback()
+
+            for row in rows:
+                try:
+                    await self._write([row])
+                except Exception as e:
+                    await self._db.rollback()
+                    failed.append(row[0])
+                    error = e
+        except BaseException:
+            # Отмена посреди записи: ничего из пачки не считаем сохранённым, запишем заново
+            self._dirty.update(dirty)
+            raise
+        if failed:
+            # Не теряем изменения: эти ключи попробуем на следующем тике
+            self._dirty.update(failed)
+            raise error
+
+    def _serialize(self, dirty):
+        """[(key, state, data в JSON или None — удалить)]. Строку, которую не сохранить в JSON, пропускаем с логом."""
+        rows = []
+        for k in dirty:
+            row = self._rows.get(k)
+            if row is None: continue
+            state, data, _ = row
+            if state is None and not data:
+                rows.append((k, None, None))
+                continue
+            try:
+                rows.append((k, state, json.dumps(data, ensure_ascii=False)))
+            except (TypeError, ValueError) as e:
+                print(f"❌ FSM state '{k}' is not saved: {e}")
+        return rows
+
+    async def _write(self, rows):
+        now = time.time()
+        upserts = [(k, state, data, now) for k, state, data in rows if data is not None]
+        deletes = [(k,) for k, _, data in rows if data is None]
+
+        if upserts:
+            await self._db.executemany(
+                "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                upserts,
+            )
+        if deletes:
+            await self._db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+        await self._db.commit()
+
+    def _evict_idle(self):
+        """Давно не тронутые чистые строки в памяти не держим — они есть в БД."""
+        idle_before = time.monotonic() - MEMORY_IDLE
+        for k in [k for k, row in self._rows.items() if row[2] < idle_before and k not in self._dirty]:
+            del self._rows[k]
+
+    async def sweep(self):
+        """Удаляет состояния, к которым не возвращались дольше TTL."""
+        if not self._db: return
+        await self._db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (time.time() - self.ttl,))
+        await self._db.commit()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try: await self.flush()
+            except Exception as e: print(f"❌ FSM flush error: {e}")
+            self._evict_idle()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try: await self.sweep()
+            except Exception as e: print(f"❌ FSM sweep error: {e}")
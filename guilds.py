@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from cachetools import LRUCache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+# Описание гильдий (см. guilds.example.json). Если файла нет — одна гильдия из .env, как раньше.
+GUILDS_FILE = os.getenv("GUILDS_FILE", "guilds.json")
+# Общая база бота (не гильдии): привязка "игрок -> гильдия", аренда лидера, задачи планировщика
+ROUTER_DB_PATH = os.getenv("ROUTER_DB_PATH", "router.db")
+# Мастера гильдии из .env (через запятую), если guilds.json нет
+MASTER_IDS = [int(x) for x in os.getenv("MASTER_IDS", "").replace(" ", "").split(",") if x]
+
+DEFAULT_GUILD = "default"
+
+# "Название очереди в боте" : "Название вкладки в Google"
+DEFAULT_QUEUES = {
+    "Камень доблести": "Камень доблести",
+    "Метеориты": "Метеориты",
+    "Жемчужины Фу Си": "Фу Си",
+    "Опыт в диск": "Опыт в диск",
+    "Проходки в УФ": "Проходки в УФ",
+    "Знаки Единства": "Знак Единства",
+    "Колода карт": "Колода",
+    "Сущность карты": "Сущность карты",
+    "Камень божества": "Камень божика",
+    "Камни бессмертных": "Камни бессмертных",
+    "Цилинь": "Цилинь"
+}
+
+
+@dataclass
+class GuildConfig:
+    id: str
+    # По умолчанию — guild_bot.db у гильдии из .env и guild_<id>.db у остальных
+    db_path: str = None
+    spreadsheet_url: str = None
+    # Какой по счету столбец ростера читать (0 = A) и сколько первых строк пропускать
+    target_col_index: int = 1
+    skip_rows: int = 1
+    # Каталог очередей: "Название в боте" : "Вкладка в Google"
+    queues: dict = field(default_factory=lambda: dict(DEFAULT_QUEUES))
+    # Групповые чаты гильдии — апдейты оттуда сразу относятся к ней
+    chats: list = field(default_factory=list)
+    board_chat_id: int = None
+    # Telegram id мастеров: становятся мастерами при первом входе
+    masters: list = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.db_path:
+            self.db_path = "guild_bot.db" if self.id == DEFAULT_GUILD else f"guild_{self.id}.db"
+
+
+def load_guilds():
+    if not os.path.exists(GUILDS_FILE):
+        board_chat = int(os.getenv("BOARD_CHAT_ID", "0")) or None
+        return {DEFAULT_GUILD: GuildConfig(
+            id=DEFAULT_GUILD,
+            spreadsheet_url=os.getenv("SPREADSHEET_URL"),
+            chats=[board_chat] if board_chat else [],
+            board_chat_id=board_chat,
+            masters=MASTER_IDS,
+        )}
+
+    with open(GUILDS_FILE, encoding="utf-8") as f:
+        raw = json.load(f)
+    guilds = {gid: GuildConfig(id=gid, **cfg) for gid, cfg in raw.items()}
+    # Иначе мастером пустой гильдии стал бы первый, кто откроет её ссылку-приглашение
+    for g in guilds.values():
+        if not g.masters: exit(f"Error: guild '{g.id}' in {GUILDS_FILE} has no masters (list of Telegram ids)")
+    return guilds
+
+
+GUILDS = load_guilds()
+for g in GUILDS.values():
+    if not g.spreadsheet_url:
+        print(f"⚠️ WARNING: spreadsheet_url is not set for guild '{g.id}'!")
+
+# Гильдия, в контексте которой обрабатывается текущий апдейт / задача
+current_guild = ContextVar("current_guild", default=next(iter(GUILDS)))
+
+
+def get_guild():
+    return GUILDS[current_guild.get()]
+
+
+# guild_id -> сколько апдейтов и задач сейчас работают в гильдии (её базу нельзя закрывать)
+in_use = Counter()
+
+
+@contextmanager
+def enter_guild(gid):
+    """Выполняет блок в контексте гильдии и держит её базу открытой, пока блок не закончится."""
+    token = current_guild.set(gid)
+    in_use[gid] += 1
+    try:
+        yield
+    finally:
+        in_use[gid] -= 1
+        current_guild.reset(token)
+
+
+# --- ПРИВЯЗКА ИГРОКОВ ---
+# Чат гильдии -> гильдия
+_chat_guilds = {chat_id: g.id for g in GUILDS.values() for chat_id in g.chats}
+# telegram_id -> гильдия (горячие записи; полный список — в ROUTER_DB_PATH)
+_user_guilds = LRUCache(maxsize=50000)
+_router = None
+
+
+def _router_db():
+    global _router
+    if _router is None:
+        _router = sqlite3.connect(ROUTER_DB_PATH)
+        _router.execute("CREATE TABLE IF NOT EXISTS user_guilds (telegram_id INTEGER PRIMARY KEY, guild_id TEXT NOT NULL)")
+    return _router
+
+
+def bind_user(telegram_id, guild_id):
+    """Запоминает, в какой гильдии игрок (переход по ссылке t.me/bot?start=<guild_id>)."""
+    if _user_guilds.get(telegram_id) == guild_id: return
+    with _router_db() as db:
+        db.execute("INSERT OR REPLACE INTO user_guilds (telegram_id, guild_id) VALUES (?, ?)", (telegram_id, guild_id))
+    _user_guilds[telegram_id] = guild_id
+
+
+def preload_bindings():
+    """Загружает привязки игроков в кэш одним запросом (прогрев при старте). Возвращает сколько загружено."""
+    if len(GUILDS) == 1: return 0
+    rows = _router_db().execute("SELECT telegram_id, guild_id FROM user_guilds LIMIT ?", (_user_guilds.maxsize,)).fetchall()
+    for telegram_id, gid in rows:
+        if gid in GUILDS: _user_guilds[telegram_id] = gid
+    return len(rows)
+
+
+def resolve_guild(chat_id=None, telegram_id=None):
+    """Гильдия для апдейта: по групповому чату, иначе по привязке игрока, иначе первая из списка."""
+    if chat_id in _chat_guilds: return _chat_guilds[chat_id]
+    if len(GUILDS) == 1 or telegram_id is None: return next(iter(GUILDS))
+
+    gid = _user_guilds.get(telegram_id)
+    if gid is None:
+        row = _router_db().execute("SELECT guild_id FROM user_guilds WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        gid = row[0] if row and row[0] in GUILDS else next(iter(GUILDS))
+        _user_guilds[telegram_id] = gid
+    return gid
@@ -1,19 +1,27 @@
-import math
 import asyncio
+import html
+import math
+import events
+import jobs
 from datetime import datetime
-from aiogram import Router, F, types
+from aiogram import Router, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from apscheduler.jobstores.base import JobLookupError
 
 # Импорты из других файлов проекта
-from loader import bot, scheduler, MSK
-from database import session, User, Character, QueueEntry, QueueType, RewardHistory, ScheduledAnnouncement, Settings
+from loader import bot, scheduler, MSK, MISFIRE_GRACE_TIME
+from database import session, User, Character, QueueEntry, QueueType, RewardHistory, ScheduledAnnouncement, Settings, get_queue_counts, get_players_page, get_user_active_queues
 from keyboards import get_master_menu, get_back_btn, get_weekdays_kb
+from events import EntryJoined, EntryLeft, RewardIssued, CharacterRemoved, QueueLocked, QueueDescriptionChanged, LimitChanged
+from guilds import get_guild
 from states import MasterManageStates, EditQueueStates, AnnounceStates, LimitStates
-from utils import check_google_sheet, log_reward_to_sheet
+from utils import check_google_sheet, sheets_status
+from callbacks import cb, pack
 
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
+import profiler
+import rewards
 
 router = Router()
 PAGE_SIZE = 10
@@ -24,29 +32,29 @@ def is_master(telegram_id):
     return user and user.is_master
 
 # --- ПАНЕЛЬ МАСТЕРА ---
-@router.callback_query(F.data == "menu_master")
+async def panel_text():
+    """Заголовок панели: связь с Google Sheets и очередь фоновых задач."""
+    text = f"👑 <b>Панель Мастера</b>\n\n{html.escape(await sheets_status())}"
+    queue = await jobs.stats()
+    if queue.get("waiting") or queue.get("dead"):
+        text += f"\n🧰 Фоновые задачи: ждут {queue['waiting']}, выполняются {queue['running']}, с ошибкой {queue['dead']}"
+    return text
+
+@cb.action("menu_master")
 async def master_menu(callback: types.CallbackQuery):
     if not is_master(callback.from_user.id): return
-    await callback.message.edit_text("👑 **Панель Мастера**", reply_markup=get_master_menu(), parse_mode="Markdown")
+    await callback.message.edit_text(await panel_text(), reply_markup=get_master_menu(), parse_mode="HTML")
 
 # --- УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ---
-@router.callback_query(F.data.startswith("m_users_list"))
-async def m_users_list(callback: types.CallbackQuery):
-    try:
-        page = int(callback.data.split(":")[1])
-    except:
-        page = 0
-
-    users = session.query(User).join(Character).distinct().all()
+@cb.action("m_users_list", int)
+async def m_users_list(callback: types.CallbackQuery, page: int = 0):
+    # Игроки с персонажами; из базы берём только текущую страницу, персонажей — одним запросом на всю страницу
+    total, current_users = get_players_page(page * PAGE_SIZE, PAGE_SIZE)
     
-    if not users:
+    if not total:
         return await callback.message.edit_text("🤷‍♂️ В базе пока нет игроков с персонажами.", reply_markup=get_back_btn("menu_master"))
 
-    total_pages = math.ceil(len(users) / PAGE_SIZE)
-    
-    start_idx = page * PAGE_SIZE
-    end_idx = start_idx + PAGE_SIZE
-    current_users = users[start_idx:end_idx]
+    total_pages = math.ceil(total / PAGE_SIZE)
     
     text = f"👥 <b>Список игроков</b> (Стр. {page + 1}/{total_pages})\n"
     text += "<i>Нажмите на кнопку с ником, чтобы управлять профилем.</i>\n\n"
@@ -56,9 +64,9 @@ async def m_users_list(callback: types.CallbackQuery):
     # --- 1. КНОПКИ НАВИГАЦИИ (Теперь сверху) ---
     nav = []
     if page > 0:
-        nav.append(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=f"m_users_list:{page - 1}"))
+        nav.append(types.InlineKeyboardButton(text="⬅️ Назад", callback_data=pack("m_users_list", page - 1)))
     if page < total_pages - 1:
-        nav.append(types.InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"m_users_list:{page + 1}"))
+        nav.append(types.InlineKeyboardButton(text="Вперёд ➡️", callback_data=pack("m_users_list", page + 1)))
     
     # Добавляем навигацию первой строкой, если она есть
     if nav:
@@ -68,12 +76,9 @@ async def m_users_list(callback: types.CallbackQuery):
     # --- 2. СПИСОК ПОЛЬЗОВАТЕЛЕЙ ---
     for u in current_users:
         # Данные игрока
-        main_char = next((c for c in u.characters if c.is_main), None)
-        alts = [c.nickname for c in u.characters if not c.is_main]
-        
-        main_nick = main_char.nickname if main_char else "Без основы"
+        main_nick = u.main_nick or "Без основы"
         user_tag = f"@{u.username}" if u.username else f"ID {u.telegram_id}"
-        alts_str = ", ".join(alts) if alts else "нет"
+        alts_str = ", ".join(u.alts) if u.alts else "нет"
         
         # Текст
         text += f"🔹 <b>{main_nick}</b> ({user_tag})\n"
@@ -81,7 +86,7 @@ async def m_users_list(callback: types.CallbackQuery):
         
         # Кнопка
         btn_text = f"{main_nick} ({user_tag})"
-        kb.append([types.InlineKeyboardButton(text=btn_text, callback_data=f"m_u_manage_{u.id}_{page}")]) 
+        kb.append([types.InlineKeyboardButton(text=btn_text, callback_data=pack("m_u_manage", u.id, page))]) 
 
     # --- 3. КНОПКА ВЫХОДА (Снизу) ---
     kb.append([types.InlineKeyboardButton(text="🔙 В меню мастера", callback_data="menu_master")])
@@ -92,10 +97,8 @@ async def m_users_list(callback: types.CallbackQuery):
         reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb)
     )
 
-@router.callback_query(F.data.startswith("m_u_manage_"))
-async def m_user_manage(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    uid, page = int(parts[3]), int(parts[4])
+@cb.action("m_u_manage", int, int)
+async def m_user_manage(callback: types.CallbackQuery, uid: int, page: int):
     user = session.get(User, uid)
     if not user: return await callback.answer("Пользователь не найден.", show_alert=True)
     
@@ -105,45 +108,47 @@ async def m_user_manage(callback: types.CallbackQuery):
     ban_text = "🕊 Разбанить" if user.is_banned else "🔨 ЗАБАНИТЬ"
     
     text = f"👤 <b>Управление профилем:</b>\nИгрок: {user_link}\nСтатус: <b>{status_emoji}</b>\n\n👇 <b>Список персонажей:</b>"
-    kb = [[types.InlineKeyboardButton(text=ban_text, callback_data=f"m_ban_toggle_{uid}_{page}")]]
+    kb = [[types.InlineKeyboardButton(text=ban_text, callback_data=pack("m_ban_toggle", uid, page))]]
     for c in chars:
-        kb.append([types.InlineKeyboardButton(text=f"❌ {'👑' if c.is_main else '👤'} {c.nickname}", callback_data=f"m_del_char_{c.id}_{uid}_{page}")])
-    kb.append([types.InlineKeyboardButton(text="🔙 К списку", callback_data=f"m_users_list:{page}")])
+        kb.append([types.InlineKeyboardButton(text=f"❌ {'👑' if c.is_main else '👤'} {c.nickname}", callback_data=pack("m_del_char", c.id, uid, page))])
+    kb.append([types.InlineKeyboardButton(text="🔙 К списку", callback_data=pack("m_users_list", page))])
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("m_ban_toggle_"))
-async def m_toggle_ban(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    uid, page = int(parts[3]), int(parts[4])
+@cb.action("m_ban_toggle", int, int)
+async def m_toggle_ban(callback: types.CallbackQuery, uid: int, page: int):
     user = session.get(User, uid)
     if user:
         if user.is_master: return await callback.answer("❌ Нельзя забанить Мастера!", show_alert=True)
         user.is_banned = not user.is_banned
-        if user.is_banned: session.query(QueueEntry).filter_by(user_id=uid).delete()
+        removed = []
+        if user.is_banned:
+            removed = [EntryLeft(e.queue_type_id, e.queue_name, e.character_name, e.character_name, callback.from_user.username, "banned")
+                       for e in get_user_active_queues(uid)]
+            session.query(QueueEntry).filter_by(user_id=uid).delete()
         session.commit()
+        await events.emit(*removed)
         await callback.answer(f"Пользователь {'забанен' if user.is_banned else 'разбанен'}.")
-        callback.data = f"m_u_manage_{uid}_{page}"
-        await m_user_manage(callback)
+        await m_user_manage(callback, uid, page)
 
-@router.callback_query(F.data.startswith("m_del_char_"))
-async def m_delete_char_admin(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    cid, uid, page = int(parts[3]), int(parts[4]), int(parts[5])
+@cb.action("m_del_char", int, int, int)
+async def m_delete_char_admin(callback: types.CallbackQuery, cid: int, uid: int, page: int):
     char = session.get(Character, cid)
     if char:
-        nick = char.nickname
+        nick, owner = char.nickname, char.user_id
+        removed = [EntryLeft(e.queue_type_id, e.queue_name, nick, nick, callback.from_user.username, "character_removed")
+                   for e in get_user_active_queues(owner) if e.character_name == nick]
         session.delete(char)
         session.query(QueueEntry).filter_by(character_name=nick).delete()
         session.commit()
+        await events.emit(*removed, CharacterRemoved(owner, nick, callback.from_user.username))
         await callback.answer(f"✅ Ник {nick} отвязан.")
     else: await callback.answer("Уже удален.")
     
-    callback.data = f"m_u_manage_{uid}_{page}"
-    await m_user_manage(callback)
+    await m_user_manage(callback, uid, page)
 
 # --- ДОБАВЛЕНИЕ АДМИНА ---
-@router.callback_query(F.data == "m_add_admin_start")
+@cb.action("m_add_admin_start")
 async def m_add_admin_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("👑 Введи **Telegram Username** игрока (без @):", parse_mode="Markdown", reply_markup=get_back_btn("menu_master"))
     await state.set_state(MasterManageStates.waiting_for_admin_username)
@@ -160,19 +165,19 @@ async def m_add_admin_save(message: types.Message, state: FSMContext):
     await state.clear()
 
 # --- РАЗДАЧА НАГРАД ---
-@router.callback_query(F.data == "m_distribute")
+@cb.action("m_distribute")
 async def m_dist_start(callback: types.CallbackQuery):
     queues = session.query(QueueType).all()
+    counts = get_queue_counts()
     kb = []
     for q in queues:
-        count = session.query(QueueEntry).filter_by(queue_type_id=q.id).count()
-        kb.append([types.InlineKeyboardButton(text=f"{q.name} ({count})", callback_data=f"dist_{q.id}")])
+        count = counts.get(q.id, 0)
+        kb.append([types.InlineKeyboardButton(text=f"{q.name} ({count})", callback_data=pack("dist", q.id))])
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text("🎁 <b>Выберите очередь:</b>", parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("dist_"))
-async def m_show_dist_list(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[1])
+@cb.action("dist", int)
+async def m_show_dist_list(callback: types.CallbackQuery, qid: int):
     q = session.get(QueueType, qid)
     entries = session.query(QueueEntry).filter_by(queue_type_id=qid).all()
     
@@ -180,20 +185,20 @@ async def m_show_dist_list(callback: types.CallbackQuery):
     
     nick_list = "\n".join([e.character_name for e in entries])
     text = f"🎁 <b>Раздача: {q.name}</b>\nСписок:\n<code>{nick_list}</code>\n\n👇 Нажми на ник, после того, как выдашь награду в игре. Я отправлю игроку уведомление:"
-    kb = [[types.InlineKeyboardButton(text=f"💰 {e.character_name}", callback_data=f"issue_{e.id}")] for e in entries]
+    kb = [[types.InlineKeyboardButton(text=f"💰 {e.character_name}", callback_data=pack("issue", e.id))] for e in entries]
+    plan_all = (types.InlineKeyboardButton(text="🧮 План на всех", callback_data=pack("plan", qid, len(entries))) if len(entries) <= PLAN_MAX
+                else types.InlineKeyboardButton(text=f"🧮 План на {PLAN_MAX}", callback_data=pack("plan", qid, PLAN_MAX)))
+    kb.append([types.InlineKeyboardButton(text=f"🧮 План на {n}", callback_data=pack("plan", qid, n)) for n in PLAN_SIZES if n < len(entries)] + [plan_all])
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="m_distribute")])
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("issue_"))
-async def m_issue_reward(callback: types.CallbackQuery):
-    try: eid = int(callback.data.split("_")[1])
-    except: return
-    entry = session.get(QueueEntry, eid)
-    if not entry: return await callback.answer("Уже выдано/удалено.")
-    
+def _issue(entry, master):
+    """
+    История и удаление записи (без commit). Возвращает (событие для emit, telegram_id игрока).
+    Игроку пишем только после commit (см. _notify_issued) — иначе он узнает о награде, которой нет в базе.
+    """
     qid, q_name, char_nick = entry.queue_type_id, entry.queue.name, entry.character_name
     user = session.get(User, entry.user_id)
-    master = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
     
     # Логика поиска основы
     main_nick = char_nick
@@ -201,26 +206,79 @@ async def m_issue_reward(callback: types.CallbackQuery):
         main_char = session.query(Character).filter_by(user_id=user.id, is_main=True).first()
         if main_char: main_nick = main_char.nickname
     
-    # 1. История
+    # История
     session.add(RewardHistory(user_id=entry.user_id, character_name=char_nick, queue_name=q_name, issued_by=master.username))
-    # 2. Гугл таблица
-    asyncio.create_task(log_reward_to_sheet(q_name, main_nick, char_nick, master.username))
-    # 3. Уведомление
-    if user:
-        try:
-            kb_notify = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="🔄 Записаться в эту же очередь", callback_data=f"pre_join_{qid}")], [types.InlineKeyboardButton(text="📋 Выбрать новую очередь", callback_data="menu_join")]])
-            await bot.send_message(user.telegram_id, f"🎉 <b>Мастер выдал тебе награду:</b> {q_name} ({char_nick})\nЗабери из Клан листа до Вс 23:30 и снова запишись в эту или другую очередь:", parse_mode="HTML", reply_markup=kb_notify)
-        except: pass
-    
+    issued = RewardIssued(qid, q_name, char_nick, main_nick, master.username, entry.user_id)
     session.delete(entry)
+    return issued, user.telegram_id if user else None
+
+async def _notify_issued(telegram_id, issued):
+    """Уведомление игроку о выданной (уже записанной в базу) награде."""
+    if not telegram_id: return
+    try:
+        kb_notify = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="🔄 Записаться в эту же очередь", callback_data=pack("pre_join", issued.queue_id))], [types.InlineKeyboardButton(text="📋 Выбрать новую очередь", callback_data="menu_join")]])
+        await bot.send_message(telegram_id, f"🎉 <b>Мастер выдал тебе награду:</b> {issued.queue_name} ({issued.character})\nЗабери из Клан листа до Вс 23:30 и снова запишись в эту или другую очередь:", parse_mode="HTML", reply_markup=kb_notify)
+    except: pass
+
+@cb.action("issue", int)
+async def m_issue_reward(callback: types.CallbackQuery, eid: int):
+    entry = session.get(QueueEntry, eid)
+    if not entry: return await callback.answer("Уже выдано/удалено.")
+    
+    master = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
+    issued, telegram_id = _issue(entry, master)
     session.commit()
-    await callback.answer(f"✅ Выдано: {char_nick}")
+    await _notify_issued(telegram_id, issued)
+    # Гугл таблица, табло и API — подписчики события
+    await events.emit(issued)
+    await callback.answer(f"✅ Выдано: {issued.character}")
     
-    callback.data = f"dist_{qid}"
-    await m_show_dist_list(callback)
+    await m_show_dist_list(callback, issued.queue_id)
+
+# --- ПЛАН РАЗДАЧИ ---
+PLAN_SIZES = (3, 5, 10)
+# Больше не планируем за раз: строка плана — до ~100 символов, а сообщение Telegram — не длиннее 4096
+PLAN_MAX = 30
+
+@cb.action("plan", int, int)
+async def m_plan_rewards(callback: types.CallbackQuery, qid: int, count: int, state: FSMContext):
+    q = session.get(QueueType, qid)
+    plan = rewards.plan(qid, q.name, min(count, PLAN_MAX))
+    if not plan: return await m_show_dist_list(callback, qid)
+    # Подтверждается ровно тот порядок, что показан мастеру
+    await state.update_data(reward_plan=[qid, [r.entry_id for r in plan]])
+
+    now = datetime.utcnow()
+    text = f"🧮 <b>План раздачи: {q.name}</b> ({len(plan)} шт.)\nПервыми — кто дольше всех без этой награды:\n\n"
+    for i, r in enumerate(plan, 1):
+        last = r.last_reward.strftime("%d.%m.%Y") if r.last_reward else "ни разу"
+        waited = f", в очереди {(now - r.joined_at).days} дн." if r.joined_at else ""
+        text += f"{i}. <b>{html.escape(r.character_name)}</b> — награда: {last}{waited}\n"
+    kb = [[types.InlineKeyboardButton(text=f"✅ Выдать всем ({len(plan)})", callback_data=pack("plan_ok", qid))],
+          [types.InlineKeyboardButton(text="🔙 Назад", callback_data=pack("dist", qid))]]
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
+
+@cb.action("plan_ok", int)
+async def m_plan_confirm(callback: types.CallbackQuery, qid: int, state: FSMContext):
+    data = await state.get_data()
+    plan_qid, entry_ids = data.get("reward_plan") or (None, [])
+    if plan_qid != qid: return await callback.answer("⚠️ План устарел, составь заново.", show_alert=True)
+    await state.update_data(reward_plan=None)
+
+    master = session.query(User).filter_by(telegram_id=callback.from_user.id).first()
+    issued = []
+    for eid in entry_ids:
+        entry = session.get(QueueEntry, eid)
+        # Запись могли выдать или удалить, пока мастер смотрел план
+        if entry and entry.queue_type_id == qid: issued.append(_issue(entry, master))
+    session.commit()
+    for event, telegram_id in issued: await _notify_issued(telegram_id, event)
+    await events.emit(*(event for event, _ in issued))
+    await callback.answer(f"✅ Выдано: {len(issued)} из {len(entry_ids)}")
+    await m_show_dist_list(callback, qid)
 
 # --- ЛИМИТЫ, ОПИСАНИЕ, LOCKS ---
-@router.callback_query(F.data == "m_limits_menu")
+@cb.action("m_limits_menu")
 async def m_limits_menu(callback: types.CallbackQuery):
     g_limit = session.query(Settings).filter_by(key="default_limit").first().value
     kb = [
@@ -231,17 +289,19 @@ async def m_limits_menu(callback: types.CallbackQuery):
     ]
     await callback.message.edit_text("⚙️ <b>Настройки лимитов</b>", parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data == "m_list_limits")
+@cb.action("m_list_limits")
 async def m_list_personal_limits(callback: types.CallbackQuery):
-    users = session.query(User).filter(User.personal_limit != None).all()
-    text = "📋 <b>Особые лимиты:</b>\n\n" + ("Нет." if not users else "")
-    for u in users:
-        mc = session.query(Character).filter_by(user_id=u.id, is_main=True).first()
-        name = mc.nickname if mc else u.username
+    # Игрок и ник его основы (если есть) — одним запросом
+    rows = (session.query(User, Character.nickname)
+            .outerjoin(Character, (Character.user_id == User.id) & (Character.is_main == True))
+            .filter(User.personal_limit != None).all())
+    text = "📋 <b>Особые лимиты:</b>\n\n" + ("Нет." if not rows else "")
+    for u, main_nick in rows:
+        name = main_nick or u.username
         text += f"👤 <b>{name}</b>: {u.personal_limit}\n"
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_back_btn("m_limits_menu"))
 
-@router.callback_query(F.data == "m_set_global")
+@cb.action("m_set_global")
 async def m_set_global_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("🌐 Введи число для <b>ОБЩЕГО</b> лимита:", parse_mode="HTML", reply_markup=get_back_btn("m_limits_menu"))
     await state.set_state(LimitStates.waiting_for_global_limit)
@@ -254,11 +314,12 @@ async def m_set_global_save(message: types.Message, state: FSMContext):
         setting = session.query(Settings).filter_by(key="default_limit").first()
         setting.value = str(val)
         session.commit()
+        await events.emit(LimitChanged(None, val))
         await message.answer(f"✅ Общий лимит: {val}", reply_markup=get_master_menu())
         await state.clear()
     except: await message.answer("❌ Введи число > 0.")
 
-@router.callback_query(F.data == "m_set_personal")
+@cb.action("m_set_personal")
 async def m_set_personal_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("👤 Введи <b>никнейм</b> игрока:", parse_mode="HTML", reply_markup=get_back_btn("m_limits_menu"))
     await state.set_state(LimitStates.waiting_for_nick_limit)
@@ -279,39 +340,39 @@ async def m_set_personal_save(message: types.Message, state: FSMContext):
         user = session.get(User, data['user_id'])
         user.personal_limit = val if val > 0 else None
         session.commit()
+        await events.emit(LimitChanged(user.id, user.personal_limit))
         await message.answer(f"✅ Лимит для {data['nick']} {'обновлен' if val>0 else 'сброшен'}.", reply_markup=get_master_menu())
         await state.clear()
     except: await message.answer("❌ Число.")
 
-@router.callback_query(F.data == "m_lock_menu")
+@cb.action("m_lock_menu")
 async def m_lock_menu(callback: types.CallbackQuery):
     queues = session.query(QueueType).filter_by(is_active=True).all()
     kb = []
     for q in queues:
         icon = "🔴 ЗАКРЫТО" if q.is_locked else "🟢 ОТКРЫТО"
-        kb.append([types.InlineKeyboardButton(text=f"{icon} {q.name}", callback_data=f"toggle_lock_{q.id}")])
+        kb.append([types.InlineKeyboardButton(text=f"{icon} {q.name}", callback_data=pack("toggle_lock", q.id))])
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text("🔒 <b>Управление доступом:</b>", parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("toggle_lock_"))
-async def m_toggle_lock(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[2])
+@cb.action("toggle_lock", int)
+async def m_toggle_lock(callback: types.CallbackQuery, qid: int):
     q = session.get(QueueType, qid)
     q.is_locked = not q.is_locked
     session.commit()
+    await events.emit(QueueLocked(qid, q.name, q.is_locked))
     await callback.answer(f"{q.name}: {'Закрыто' if q.is_locked else 'Открыто'}")
     await m_lock_menu(callback)
 
-@router.callback_query(F.data == "m_edit_desc")
+@cb.action("m_edit_desc")
 async def m_edit_desc(callback: types.CallbackQuery):
     queues = session.query(QueueType).all()
-    kb = [[types.InlineKeyboardButton(text=q.name, callback_data=f"edit_d_{q.id}")] for q in queues]
+    kb = [[types.InlineKeyboardButton(text=q.name, callback_data=pack("edit_d", q.id))] for q in queues]
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text("✏️ Выбери очередь:", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("edit_d_"))
-async def m_edit_input(callback: types.CallbackQuery, state: FSMContext):
-    qid = int(callback.data.split("_")[2])
+@cb.action("edit_d", int)
+async def m_edit_input(callback: types.CallbackQuery, qid: int, state: FSMContext):
     q = session.get(QueueType, qid)
     await state.update_data(qid=qid)
     await callback.message.edit_text(f"Текущее: {q.description}\n👇 **Новое описание:**", parse_mode="Markdown", reply_markup=get_back_btn("menu_master"))
@@ -323,11 +384,12 @@ async def m_edit_save(message: types.Message, state: FSMContext):
     q = session.get(QueueType, data['qid'])
     q.description = message.text
     session.commit()
+    await events.emit(QueueDescriptionChanged(q.id))
     await message.answer("✅ Сохранено.", reply_markup=get_master_menu())
     await state.clear()
 
 # --- FORCE ADD/DEL & LOGS ---
-@router.callback_query(F.data == "m_force_add")
+@cb.action("m_force_add")
 async def m_force_add(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("➕ Никнейм:", reply_markup=get_back_btn("menu_master"))
     await state.set_state(MasterManageStates.waiting_for_nickname_add)
@@ -336,13 +398,12 @@ async def m_force_add(callback: types.CallbackQuery, state: FSMContext):
 async def m_force_nick(message: types.Message, state: FSMContext):
     if not await check_google_sheet(message.text): return await message.answer("❌ Невалидный ник.")
     await state.update_data(nick=message.text)
-    kb = [[types.InlineKeyboardButton(text=q.name, callback_data=f"f_add_{q.id}")] for q in session.query(QueueType).all()]
+    kb = [[types.InlineKeyboardButton(text=q.name, callback_data=pack("f_add", q.id))] for q in session.query(QueueType).all()]
     await message.answer("Куда?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
     await state.set_state(MasterManageStates.waiting_for_queue_add)
 
-@router.callback_query(F.data.startswith("f_add_"))
-async def m_force_add_final(callback: types.CallbackQuery, state: FSMContext):
-    qid = int(callback.data.split("_")[2])
+@cb.action("f_add", int)
+async def m_force_add_final(callback: types.CallbackQuery, qid: int, state: FSMContext):
     data = await state.get_data()
     nick = data['nick']
     
@@ -355,43 +416,42 @@ async def m_force_add_final(callback: types.CallbackQuery, state: FSMContext):
     session.add(QueueEntry(user_id=uid, queue_type_id=qid, character_name=nick))
     session.commit()
     q_name = session.get(QueueType, qid).name
-    asyncio.create_task(log_reward_to_sheet(q_name, main_nick, nick, callback.from_user.username, "👑 Мастер добавил"))
+    await events.emit(EntryJoined(qid, q_name, nick, main_nick, callback.from_user.username, by_master=True))
     await callback.message.edit_text(f"✅ {nick} добавлен.", reply_markup=get_master_menu())
     await state.clear()
 
-@router.callback_query(F.data == "m_force_del")
+@cb.action("m_force_del")
 async def m_force_del(callback: types.CallbackQuery):
     queues = session.query(QueueType).all()
+    counts = get_queue_counts()
     kb = []
     for q in queues:
-        if session.query(QueueEntry).filter_by(queue_type_id=q.id).count() > 0:
-            kb.append([types.InlineKeyboardButton(text=f"{q.name}", callback_data=f"sel_del_{q.id}")])
+        if counts.get(q.id):
+            kb.append([types.InlineKeyboardButton(text=f"{q.name}", callback_data=pack("sel_del", q.id))])
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text("❌ Выбери очередь:", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("sel_del_"))
-async def m_force_del_list(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[2])
+@cb.action("sel_del", int)
+async def m_force_del_list(callback: types.CallbackQuery, qid: int):
     entries = session.query(QueueEntry).filter_by(queue_type_id=qid).all()
-    kb = [[types.InlineKeyboardButton(text=f"❌ {e.character_name}", callback_data=f"kill_{e.id}")] for e in entries]
+    kb = [[types.InlineKeyboardButton(text=f"❌ {e.character_name}", callback_data=pack("kill", e.id))] for e in entries]
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text("Кого удалить?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("kill_"))
-async def m_kill(callback: types.CallbackQuery):
-    eid = int(callback.data.split("_")[1])
+@cb.action("kill", int)
+async def m_kill(callback: types.CallbackQuery, eid: int):
     e = session.get(QueueEntry, eid)
     if e:
         qid = e.queue_type_id
-        asyncio.create_task(log_reward_to_sheet(e.queue.name, e.character_name, e.character_name, callback.from_user.username, "⛔ Кик Мастером"))
+        kicked = EntryLeft(qid, e.queue.name, e.character_name, e.character_name, callback.from_user.username, "kicked")
         session.delete(e)
         session.commit()
+        await events.emit(kicked)
         await callback.answer("✅ Удалено.")
-        callback.data = f"sel_del_{qid}"
-        await m_force_del_list(callback)
+        await m_force_del_list(callback, qid)
     else: await callback.answer("Уже удален.")
 
-@router.callback_query(F.data == "m_global_log")
+@cb.action("m_global_log")
 async def m_global_log(callback: types.CallbackQuery):
     hist = session.query(RewardHistory).order_by(RewardHistory.timestamp.desc()).limit(15).all()
     text = "🗄 <b>Лог последних выдач:</b>\n\n" + ("Архив пуст." if not hist else "")
@@ -400,34 +460,65 @@ async def m_global_log(callback: types.CallbackQuery):
 
 # --- ОБЪЯВЛЕНИЯ (BROADCAST) ---
 # Вспомогательные функции для шедулера
-async def run_broadcast(ann_id, bot_instance):
+# Задачи лежат в базе (pickle), поэтому в аргументах только id — бот берём из loader
+async def run_broadcast(guild_id, ann_id):
+    # Рассылку делает воркер (см. jobs.py); ключ не даёт одному объявлению уйти дважды параллельно
+    await jobs.enqueue("broadcast", {"ann_id": ann_id}, guild_id, key=f"broadcast:{guild_id}:{ann_id}")
+
+@jobs.handler("broadcast")
+async def _broadcast_job(ann_id):
     with session.no_autoflush:
         ann = session.get(ScheduledAnnouncement, ann_id)
         if not ann or not ann.is_active: return
-        users = session.query(User).all()
+        # Повтор после сбоя продолжает с игрока, на котором остановились, а не шлёт всем заново
+        users = session.query(User).filter(User.id > (jobs.progress() or 0)).order_by(User.id).all()
         for u in users:
-            try: await bot_instance.send_message(u.telegram_id, f"📢 <b>ОБЪЯВЛЕНИЕ</b>\n\n{ann.text}", parse_mode="HTML")
+            try: await bot.send_message(u.telegram_id, f"📢 <b>ОБЪЯВЛЕНИЕ</b>\n\n{ann.text}", parse_mode="HTML")
             except: pass
+            await jobs.checkpoint(u.id)
         if ann.schedule_type == 'once_future':
             ann.is_active = False
             session.commit()
 
-def schedule_job(ann, bot_instance):
-    job_id = f"ann_{ann.id}"
+def job_id_for(ann_id):
+    return f"ann_{get_guild().id}_{ann_id}"
+
+def schedule_job(ann):
+    job_id = job_id_for(ann.id)
+    args = [get_guild().id, ann.id]
     try:
         if ann.schedule_type == 'daily':
             h, m = map(int, ann.run_time.split(':'))
-            scheduler.add_job(run_broadcast, 'cron', hour=h, minute=m, id=job_id, replace_existing=True, args=[ann.id, bot_instance])
+            scheduler.add_job(run_broadcast, 'cron', hour=h, minute=m, id=job_id, replace_existing=True, args=args)
         elif ann.schedule_type == 'weekly':
             h, m = map(int, ann.run_time.split(':'))
-            scheduler.add_job(run_broadcast, 'cron', day_of_week=ann.days_of_week, hour=h, minute=m, id=job_id, replace_existing=True, args=[ann.id, bot_instance])
+            scheduler.add_job(run_broadcast, 'cron', day_of_week=ann.days_of_week, hour=h, minute=m, id=job_id, replace_existing=True, args=args)
         elif ann.schedule_type == 'once_future':
             dt = datetime.strptime(ann.run_time, "%d.%m.%Y %H:%M")
             dt_msk = MSK.localize(dt)
-            scheduler.add_job(run_broadcast, 'date', run_date=dt_msk, id=job_id, replace_existing=True, args=[ann.id, bot_instance])
+            scheduler.add_job(run_broadcast, 'date', run_date=dt_msk, id=job_id, replace_existing=True, args=args)
     except Exception as e: print(f"❌ Error scheduling {job_id}: {e}")
 
-@router.callback_query(F.data == "m_announce")
+def restore_jobs():
+    """
+    Задачи живут в базе планировщика и переживают рестарт сами.
+    Досоздаём только те, которых там нет (старые объявления, ручные правки базы).
+    """
+    count = 0
+    for ann in session.query(ScheduledAnnouncement).filter_by(is_active=True).all():
+        if ann.schedule_type == 'once_now' or scheduler.get_job(job_id_for(ann.id)): continue
+        if ann.schedule_type == 'once_future':
+            run_at = MSK.localize(datetime.strptime(ann.run_time, "%d.%m.%Y %H:%M"))
+            # Разовое объявление, которое давно пропущено, уже не отправляем
+            if (datetime.now(MSK) - run_at).total_seconds() > MISFIRE_GRACE_TIME:
+                ann.is_active = False
+                continue
+        schedule_job(ann)
+        count += 1
+    session.commit()
+    return count
+
+@cb.action("m_announce")
 async def m_ann_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("📢 Текст объявления:", reply_markup=get_back_btn("menu_master"))
     await state.set_state(AnnounceStates.waiting_for_text)
@@ -436,23 +527,22 @@ async def m_ann_start(callback: types.CallbackQuery, state: FSMContext):
 async def m_ann_text(message: types.Message, state: FSMContext):
     await state.update_data(text=message.text)
     kb = [
-        [types.InlineKeyboardButton(text="⚡ Прямо сейчас", callback_data="ann_now")],
-        [types.InlineKeyboardButton(text="📅 Разово в будущем", callback_data="ann_future")],
-        [types.InlineKeyboardButton(text="⏰ Ежедневно", callback_data="ann_daily")],
-        [types.InlineKeyboardButton(text="📆 По дням недели", callback_data="ann_weekly")]
+        [types.InlineKeyboardButton(text="⚡ Прямо сейчас", callback_data=pack("ann", "now"))],
+        [types.InlineKeyboardButton(text="📅 Разово в будущем", callback_data=pack("ann", "future"))],
+        [types.InlineKeyboardButton(text="⏰ Ежедневно", callback_data=pack("ann", "daily"))],
+        [types.InlineKeyboardButton(text="📆 По дням недели", callback_data=pack("ann", "weekly"))]
     ]
     await message.answer("Когда отправить?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
     await state.set_state(AnnounceStates.waiting_for_type)
 
-@router.callback_query(F.data.startswith("ann_"))
-async def m_ann_type(callback: types.CallbackQuery, state: FSMContext):
-    atype = callback.data.split("_")[1]
+@cb.action("ann", str)
+async def m_ann_type(callback: types.CallbackQuery, atype: str, state: FSMContext):
     if atype == "now":
         data = await state.get_data()
         ann = ScheduledAnnouncement(text=data['text'], schedule_type='once_now', run_time='now', is_active=True)
         session.add(ann); session.commit()
-        await run_broadcast(ann.id, callback.bot)
-        await callback.message.edit_text("✅ Отправлено.", reply_markup=get_master_menu())
+        await run_broadcast(get_guild().id, ann.id)
+        await callback.message.edit_text("✅ Рассылка запущена.", reply_markup=get_master_menu())
         await state.clear()
     elif atype == "future":
         await callback.message.edit_text("📅 Формат: `ДД.ММ.ГГГГ ЧЧ:ММ`", parse_mode="Markdown", reply_markup=get_back_btn("menu_master"))
@@ -474,14 +564,13 @@ async def process_future_datetime(message: types.Message, state: FSMContext):
         data = await state.get_data()
         ann = ScheduledAnnouncement(text=data['text'], schedule_type='once_future', run_time=dt, is_active=True)
         session.add(ann); session.commit()
-        schedule_job(ann, message.bot)
+        schedule_job(ann)
         await message.answer(f"✅ Запланировано на {dt}", reply_markup=get_master_menu())
         await state.clear()
     except: await message.answer("❌ Формат: ДД.ММ.ГГГГ ЧЧ:ММ")
 
-@router.callback_query(F.data.startswith("toggle_day_"))
-async def toggle_day(callback: types.CallbackQuery, state: FSMContext):
-    code = callback.data.split("_")[2]
+@cb.action("toggle_day", str)
+async def toggle_day(callback: types.CallbackQuery, code: str, state: FSMContext):
     data = await state.get_data()
     days = data.get('days', [])
     if code in days: days.remove(code)
@@ -489,7 +578,7 @@ async def toggle_day(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(days=days)
     await callback.message.edit_reply_markup(reply_markup=get_weekdays_kb(days))
 
-@router.callback_query(F.data == "days_confirm")
+@cb.action("days_confirm")
 async def confirm_days(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     if not data.get('days', []): return await callback.answer("Выберите дни!", show_alert=True)
@@ -506,12 +595,12 @@ async def process_time_only(message: types.Message, state: FSMContext):
         sch_type, days_str = ('weekly', ",".join(days_list)) if days_list else ('daily', None)
         ann = ScheduledAnnouncement(text=data['text'], schedule_type=sch_type, run_time=t_str, days_of_week=days_str, is_active=True)
         session.add(ann); session.commit()
-        schedule_job(ann, message.bot)
+        schedule_job(ann)
         await message.answer(f"✅ Расписание создано: {t_str}", reply_markup=get_master_menu())
         await state.clear()
     except: await message.answer("❌ Формат: ЧЧ:ММ")
 
-@router.callback_query(F.data == "m_schedule")
+@cb.action("m_schedule")
 async def m_show_schedule(callback: types.CallbackQuery):
     tasks = session.query(ScheduledAnnouncement).filter_by(is_active=True).all()
     text = "🗓 <b>Активные задачи:</b>\n\n" + ("Пусто" if not tasks else "")
@@ -519,42 +608,95 @@ async def m_show_schedule(callback: types.CallbackQuery):
     for t in tasks:
         desc = f"⏰ Ежедневно" if t.schedule_type == 'daily' else (f"📆 {t.days_of_week}" if t.schedule_type == 'weekly' else f"📅 {t.run_time}")
         text += f"{desc} в {t.run_time} — {t.text[:10]}...\n"
-        kb.append([types.InlineKeyboardButton(text=f"❌ Удалить ({desc})", callback_data=f"del_sch_{t.id}")])
+        kb.append([types.InlineKeyboardButton(text=f"❌ Удалить ({desc})", callback_data=pack("del_sch", t.id))])
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("del_sch_"))
-async def m_del_schedule(callback: types.CallbackQuery):
-    aid = int(callback.data.split("_")[2])
+@cb.action("del_sch", int)
+async def m_del_schedule(callback: types.CallbackQuery, aid: int):
     task = session.get(ScheduledAnnouncement, aid)
     if task:
         task.is_active = False
         session.commit()
-        try: scheduler.remove_job(f"ann_{aid}")
+        try: scheduler.remove_job(job_id_for(aid))
         except JobLookupError: pass
         await callback.answer("Отключено.")
         await m_show_schedule(callback)
     else: await m_show_schedule(callback)
 
 # --- БЭКАП БД ---
-@router.callback_query(F.data == "m_backup")
+@cb.action("m_backup")
 async def m_send_backup(callback: types.CallbackQuery):
-    # Формируем красивое имя файла с датой: backup_2023-10-25_14-30.db
+    # Снимок и сжатие базы — в воркере, файл придёт отдельным сообщением
+    await jobs.enqueue("backup", {"chat_id": callback.message.chat.id})
+    await callback.answer("Готовлю бэкап, файл придёт через пару секунд.")
+
+def _snapshot(db_path):
+    """Согласованная копия живой базы (sqlite backup API) в gzip — блокирующее, в потоке."""
+    import gzip
+    import sqlite3
+    import tempfile
+
+    with tempfile.NamedTemporaryFile(suffix=".db") as tmp:
+        src, dst = sqlite3.connect(db_path), sqlite3.connect(tmp.name)
+        try: src.backup(dst)
+        finally: src.close(); dst.close()
+        with open(tmp.name, "rb") as f:
+            return gzip.compress(f.read())
+
+@jobs.handler("backup")
+async def _backup_job(chat_id):
+    # Формируем красивое имя файла с датой: backup_2023-10-25_14-30.db.gz
     date_str = datetime.now().strftime("%Y-%m-%d_%H-%M")
-    filename = f"backup_{date_str}.db"
-    
-    # Путь к файлу внутри контейнера (у тебя он лежит в корне /app/guild_bot.db)
-    db_path = "guild_bot.db"
-    
-    try:
-        # Создаем объект файла для отправки
-        backup_file = FSInputFile(db_path, filename=filename)
-        
-        await callback.message.answer_document(
-            backup_file, 
-            caption=f"📦 <b>Резервная копия базы данных</b>\n📅 {date_str}\n\nСохрани этот файл в надежное место!",
-            parse_mode="HTML"
+    # Файл базы текущей гильдии (по умолчанию /app/guild_bot.db)
+    data = await asyncio.to_thread(_snapshot, get_guild().db_path)
+    await bot.send_document(
+        chat_id,
+        BufferedInputFile(data, filename=f"backup_{date_str}.db.gz"),
+        caption=f"📦 <b>Резервная копия базы данных</b>\n📅 {date_str}\n\nСохрани этот файл в надежное место!",
+        parse_mode="HTML"
+    )
+
+# --- ПРОФИЛИРОВАНИЕ ---
+PROFILE_OPTIONS = [
+    ("📊 Сэмплинг стеков, 1 мин", profiler.SAMPLE, 60),
+    ("📊 Сэмплинг стеков, 5 мин", profiler.SAMPLE, 300),
+    ("🧪 cProfile части апдейтов, 1 мин", profiler.CPROFILE, 60),
+    ("🧪 cProfile части апдейтов, 5 мин", profiler.CPROFILE, 300),
+]
+
+@cb.action("m_profile")
+async def m_profile_menu(callback: types.CallbackQuery):
+    if not is_master(callback.from_user.id): return
+    run = profiler.current()
+    if run:
+        text = f"🔬 Идёт профилирование ({run.mode}, {run.seconds} с). Файл придёт сюда, когда окно закончится."
+        kb = [[types.InlineKeyboardButton(text="⏹ Остановить и прислать", callback_data="prof_stop")]]
+    else:
+        text = "🔬 <b>Профилирование</b>\n\nСэмплинг почти не нагружает бота. cProfile точнее, но замедляет выбранные апдейты."
+        kb = [[types.InlineKeyboardButton(text=title, callback_data=pack("prof", mode, sec))] for title, mode, sec in PROFILE_OPTIONS]
+    kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_master")])
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
+
+@cb.action("prof", str, int)
+async def m_profile_start(callback: types.CallbackQuery, mode: str, seconds: int):
+    if not is_master(callback.from_user.id): return
+    if profiler.current(): return await callback.answer("Профилирование уже идёт.", show_alert=True)
+    chat_id = callback.from_user.id
+
+    async def send_report(filename, data, summary):
+        await bot.send_document(
+            chat_id, BufferedInputFile(data, filename=filename),
+            caption=f"🔬 <b>Профиль готов</b>\n<pre>{html.escape(summary[:900])}</pre>", parse_mode="HTML"
         )
-        await callback.answer("Файл отправлен.")
-    except Exception as e:
-        await callback.answer(f"Ошибка при создании бэкапа: {e}", show_alert=True)
\ No newline at end of file
+
+    profiler.start(mode, seconds, send_report)
+    await callback.answer("Профилирование включено.")
+    await m_profile_menu(callback)
+
+@cb.action("prof_stop")
+async def m_profile_stop(callback: types.CallbackQuery):
+    if not is_master(callback.from_user.id): return
+    profiler.stop()
+    await callback.answer("Останавливаю, файл придёт через пару секунд.")
+    await callback.message.edit_text(await panel_text(), reply_markup=get_master_menu(), parse_mode="HTML")
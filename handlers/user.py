@@ -1,14 +1,17 @@
-from aiogram import Router, F, types
+from aiogram import Router, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-import asyncio
+import events
+from events import EntryJoined, EntryLeft, EntrySwapped, CharacterRemoved
 
 # Импорты из корня проекта
-from database import session, User, Character, QueueEntry, QueueType, RewardHistory, ensure_user, get_user_active_queues, get_effective_limit_logic
+from database import session, User, Character, QueueEntry, QueueType, RewardHistory, ensure_user, get_user_active_queues, get_effective_limit_logic, get_queue_counts, get_active_queues, get_queue_nicks, get_characters
 from keyboards import get_main_menu, get_back_btn
 from helpers import get_menu_text
 from states import Registration
-from utils import check_google_sheet, log_reward_to_sheet
+from utils import check_google_sheet
+from callbacks import cb, pack
 
 router = Router()
 
@@ -22,7 +25,7 @@ async def cmd_start(message: types.Message):
     text = get_menu_text(user)
     await message.answer(text, reply_markup=get_main_menu(user), parse_mode="HTML")
 
-@router.callback_query(F.data == "back_to_main")
+@cb.action("back_to_main")
 async def back_to_menu(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     user = ensure_user(callback.from_user.id, callback.from_user.username)
@@ -38,7 +41,7 @@ async def back_to_menu(callback: types.CallbackQuery, state: FSMContext):
 
 # --- УПРАВЛЕНИЕ ПЕРСОНАЖАМИ ---
 
-@router.callback_query(F.data == "menu_chars")
+@cb.action("menu_chars")
 async def chars_menu(callback: types.CallbackQuery):
     # Получаем пользователя
     user = ensure_user(callback.from_user.id, callback.from_user.username)
@@ -55,7 +58,7 @@ async def chars_menu(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb), parse_mode="HTML")
 
-@router.callback_query(F.data == "add_main")
+@cb.action("add_main")
 async def add_main_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("✍️ Введи никнейм **ОСНОВЫ**:", reply_markup=get_back_btn("menu_chars"), parse_mode="Markdown")
     await state.set_state(Registration.waiting_for_main_nickname)
@@ -95,8 +98,10 @@ async def process_main_input(message: types.Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
     await state.set_state(Registration.waiting_for_main_confirm)
 
-@router.callback_query(F.data == "confirm_main_change", Registration.waiting_for_main_confirm)
+@cb.action("confirm_main_change")
 async def process_main_confirm(callback: types.CallbackQuery, state: FSMContext):
+    if await state.get_state() != Registration.waiting_for_main_confirm.state:
+        return await callback.answer()
     data = await state.get_data()
     new_nick = data.get("new_nick")
     old_nick = data.get("old_nick")
@@ -110,18 +115,18 @@ async def process_main_confirm(callback: types.CallbackQuery, state: FSMContext)
     else: session.add(Character(user_id=user.id, nickname=new_nick, is_main=True)) 
         
     entries = session.query(QueueEntry).filter_by(user_id=user.id).all()
-    count = 0
+    changed = []
     for entry in entries:
         if entry.character_name != new_nick:
-            prev_name = entry.character_name
+            changed.append(EntrySwapped(entry.queue_type_id, entry.queue.name, entry.character_name, new_nick, new_nick, user.username, "main_changed"))
             entry.character_name = new_nick
-            count += 1
-            asyncio.create_task(log_reward_to_sheet(queue_name=entry.queue.name, main_nick=new_nick, char_nick=new_nick, manager_name=user.username, status=f"🔄 Смена основы ({prev_name})"))
     session.commit()
+    await events.emit(*changed)
+    count = len(changed)
     await callback.message.edit_text(f"✅ <b>Готово!</b>\nНовая основа: {new_nick}\nОбновлено записей: {count}", parse_mode="HTML", reply_markup=get_main_menu(user))
     await state.clear()
 
-@router.callback_query(F.data == "add_alt")
+@cb.action("add_alt")
 async def add_alt_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("✍️ Введи никнейм **ТВИНА**:", reply_markup=get_back_btn("menu_chars"), parse_mode="Markdown")
     await state.set_state(Registration.waiting_for_alt_nickname)
@@ -144,18 +149,17 @@ async def process_alt(message: types.Message, state: FSMContext):
     await message.answer(f"✅ Твин добавлен: <b>{nick}</b>", parse_mode="HTML", reply_markup=get_main_menu(user))
     await state.clear()
 
-@router.callback_query(F.data == "del_alt_menu")
+@cb.action("del_alt_menu")
 async def del_alt_menu(callback: types.CallbackQuery):
     user = ensure_user(callback.from_user.id, callback.from_user.username)
     alts = session.query(Character).filter_by(user_id=user.id, is_main=False).all()
     if not alts: return await callback.answer("Нет твинов.", show_alert=True)
-    kb = [[types.InlineKeyboardButton(text=f"❌ {c.nickname}", callback_data=f"del_c_{c.id}")] for c in alts]
+    kb = [[types.InlineKeyboardButton(text=f"❌ {c.nickname}", callback_data=pack("del_c", c.id))] for c in alts]
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="menu_chars")])
     await callback.message.edit_text("Кого удалить?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("del_c_"))
-async def del_char_action(callback: types.CallbackQuery):
-    cid = int(callback.data.split("_")[2])
+@cb.action("del_c", int)
+async def del_char_action(callback: types.CallbackQuery, cid: int):
     char = session.get(Character, cid)
     if not char: return await callback.answer("Не найден.")
     
@@ -167,10 +171,10 @@ async def del_char_action(callback: types.CallbackQuery):
         kb = []
         if main_char:
             text += f"Я заменю его на основу: <b>{main_char.nickname}</b>."
-            kb.append([types.InlineKeyboardButton(text=f"✅ Заменить на {main_char.nickname} и удалить", callback_data=f"conf_del_{cid}_swap")])
+            kb.append([types.InlineKeyboardButton(text=f"✅ Заменить на {main_char.nickname} и удалить", callback_data=pack("conf_del", cid, "swap"))])
         else:
             text += "Он исчезнет из всех очередей."
-            kb.append([types.InlineKeyboardButton(text="🗑 Удалить отовсюду", callback_data=f"conf_del_{cid}_kill")])
+            kb.append([types.InlineKeyboardButton(text="🗑 Удалить отовсюду", callback_data=pack("conf_del", cid, "kill"))])
         kb.append([types.InlineKeyboardButton(text="🔙 Отмена", callback_data="menu_chars")])
         await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
     else:
@@ -179,10 +183,8 @@ async def del_char_action(callback: types.CallbackQuery):
         await callback.answer(f"{char.nickname} удален.")
         await del_alt_menu(callback)
 
-@router.callback_query(F.data.startswith("conf_del_"))
-async def confirm_del_char_complex(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    cid, action = int(parts[2]), parts[3]
+@cb.action("conf_del", int, str)
+async def confirm_del_char_complex(callback: types.CallbackQuery, cid: int, action: str):
     char = session.get(Character, cid)
     if not char: return await callback.answer("Уже удален.")
     
@@ -190,37 +192,42 @@ async def confirm_del_char_complex(callback: types.CallbackQuery):
     user = session.get(User, user_id)
     entries = session.query(QueueEntry).filter_by(character_name=nick_to_del).all()
     
+    changes = []
     for e in entries:
         q_name = e.queue.name
         if action == "swap":
             main_char = session.query(Character).filter_by(user_id=user_id, is_main=True).first()
             if main_char:
                 e.character_name = main_char.nickname
-                asyncio.create_task(log_reward_to_sheet(queue_name=q_name, main_nick=main_char.nickname, char_nick=main_char.nickname, manager_name=user.username, status=f"♻️ Авто-замена ({nick_to_del})"))
-            else: session.delete(e)
+                changes.append(EntrySwapped(e.queue_type_id, q_name, nick_to_del, main_char.nickname, main_char.nickname, user.username, "character_removed"))
+            else:
+                session.delete(e)
+                changes.append(EntryLeft(e.queue_type_id, q_name, nick_to_del, nick_to_del, user.username, "character_removed"))
         elif action == "kill":
             session.delete(e)
-            asyncio.create_task(log_reward_to_sheet(queue_name=q_name, main_nick=nick_to_del, char_nick=nick_to_del, manager_name=user.username, status="❌ Ушел (удаление перса)"))
+            changes.append(EntryLeft(e.queue_type_id, q_name, nick_to_del, nick_to_del, user.username, "character_removed"))
 
     session.delete(char)
     session.commit()
+    await events.emit(*changes, CharacterRemoved(user_id, nick_to_del, user.username))
     await callback.message.edit_text(f"✅ {nick_to_del} удален.", reply_markup=get_back_btn("menu_chars"))
 
 
 # --- ОЧЕРЕДИ ---
 
-@router.callback_query(F.data == "menu_join")
+@cb.action("menu_join")
 async def join_menu(callback: types.CallbackQuery):
     # Получаем пользователя для генерации текста
     user = ensure_user(callback.from_user.id, callback.from_user.username)
 
-    queues = session.query(QueueType).filter_by(is_active=True).all()
+    queues = get_active_queues()
+    counts = get_queue_counts()
     kb = []
     
     for q in queues:
-        count = session.query(QueueEntry).filter_by(queue_type_id=q.id).count()
+        count = counts.get(q.id, 0)
         status = "🔒 ЗАКРЫТА" if q.is_locked else f"({count})"
-        kb.append([types.InlineKeyboardButton(text=f"{q.name} {status}", callback_data=f"view_q_{q.id}")])
+        kb.append([types.InlineKeyboardButton(text=f"{q.name} {status}", callback_data=pack("view_q", q.id))])
         
     kb.append([types.InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")])
     
@@ -229,44 +236,46 @@ async def join_menu(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("view_q_"))
-async def view_queue(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[2])
+@cb.action("view_q", int)
+async def view_queue(callback: types.CallbackQuery, qid: int):
     q = session.get(QueueType, qid)
     user = ensure_user(callback.from_user.id, callback.from_user.username)
-    entries = session.query(QueueEntry).filter_by(queue_type_id=qid).all()
+    nicks = get_queue_nicks(qid)
     
     text = f"🛡 <b>Очередь: {q.name}</b>\n\n"
-    if not entries: text += "<i>Пока пусто.</i>"
+    if not nicks: text += "<i>Пока пусто.</i>"
     else:
-        for i, e in enumerate(entries, 1): text += f"{i}. {e.character_name}\n"
+        for i, nick in enumerate(nicks, 1): text += f"{i}. {nick}\n"
     
     kb = []
-    user_entry = session.query(QueueEntry).filter_by(queue_type_id=qid, user_id=user.id).first()
-    if user_entry: kb.append([types.InlineKeyboardButton(text="🏃 Выйти из очереди", callback_data=f"leave_q_{qid}")])
-    else: kb.append([types.InlineKeyboardButton(text="✍️ Записаться", callback_data=f"pre_join_{qid}")])
+    user_entry = session.query(QueueEntry.id).filter_by(queue_type_id=qid, user_id=user.id).first()
+    if user_entry: kb.append([types.InlineKeyboardButton(text="🏃 Выйти из очереди", callback_data=pack("leave_q", qid))])
+    else: kb.append([types.InlineKeyboardButton(text="✍️ Записаться", callback_data=pack("pre_join", qid))])
     kb.append([types.InlineKeyboardButton(text="🔙 К списку", callback_data="menu_join")])
-    try: await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
-    except: pass
-
-@router.callback_query(F.data.startswith("pre_join_"))
-async def pre_join(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[2])
+    markup = types.InlineKeyboardMarkup(inline_keyboard=kb)
+    # Повторную отрисовку без изменений обычно отсекает RenderCacheMiddleware, но он может быть выключен
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" in e.message: return
+        # Сообщение уже не отредактировать (слишком старое, удалено) — присылаем очередь заново
+        await callback.message.answer(text, parse_mode="HTML", reply_markup=markup)
+
+@cb.action("pre_join", int)
+async def pre_join(callback: types.CallbackQuery, qid: int):
     q = session.get(QueueType, qid)
     if q.is_locked: return await callback.answer("⛔ Очередь закрыта Мастером!", show_alert=True)
     
     user = ensure_user(callback.from_user.id, callback.from_user.username)
-    chars = session.query(Character).filter_by(user_id=user.id).all()
+    chars = get_characters(user.id)
     if not chars: return await callback.answer("Нет персонажей!", show_alert=True)
     
-    kb = [[types.InlineKeyboardButton(text=f"{'👑' if c.is_main else '👤'} {c.nickname}", callback_data=f"do_join_{qid}_{c.id}")] for c in chars]
-    kb.append([types.InlineKeyboardButton(text="🔙 Отмена", callback_data=f"view_q_{qid}")])
+    kb = [[types.InlineKeyboardButton(text=f"{'👑' if c.is_main else '👤'} {c.nickname}", callback_data=pack("do_join", qid, c.id))] for c in chars]
+    kb.append([types.InlineKeyboardButton(text="🔙 Отмена", callback_data=pack("view_q", qid))])
     await callback.message.edit_text("Кем записаться?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("do_join_"))
-async def do_join(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    qid, cid = int(parts[2]), int(parts[3])
+@cb.action("do_join", int, int)
+async def do_join(callback: types.CallbackQuery, qid: int, cid: int):
     user = ensure_user(callback.from_user.id, callback.from_user.username)
     char = session.get(Character, cid)
     
@@ -283,31 +292,31 @@ async def do_join(callback: types.CallbackQuery):
     
     main_char = session.query(Character).filter_by(user_id=user.id, is_main=True).first()
     main_nick = main_char.nickname if main_char else char.nickname
-    asyncio.create_task(log_reward_to_sheet(queue_name=session.get(QueueType, qid).name, main_nick=main_nick, char_nick=char.nickname, manager_name=user.username, status="В очереди"))
+    await events.emit(EntryJoined(qid, session.get(QueueType, qid).name, char.nickname, main_nick, user.username))
     
     await callback.answer(f"Записан: {char.nickname}")
-    await view_queue(callback)
+    await view_queue(callback, qid)
 
-@router.callback_query(F.data.startswith("leave_q_"))
-async def leave_queue(callback: types.CallbackQuery):
-    qid = int(callback.data.split("_")[2])
+@cb.action("leave_q", int)
+async def leave_queue(callback: types.CallbackQuery, qid: int):
     user = ensure_user(callback.from_user.id, callback.from_user.username)
     entry = session.query(QueueEntry).filter_by(queue_type_id=qid, user_id=user.id).first()
     
     if entry:
         main_char = session.query(Character).filter_by(user_id=user.id, is_main=True).first()
         main_nick = main_char.nickname if main_char else entry.character_name
-        asyncio.create_task(log_reward_to_sheet(queue_name=entry.queue.name, main_nick=main_nick, char_nick=entry.character_name, manager_name=user.username, status="❌ Вышел"))
+        left = EntryLeft(qid, entry.queue.name, entry.character_name, main_nick, user.username)
         session.delete(entry)
         session.commit()
+        await events.emit(left)
         await callback.answer("Вы вышли.")
     else: await callback.answer("Уже вышли.", show_alert=True)
-    await view_queue(callback)
+    await view_queue(callback, qid)
 
-@router.callback_query(F.data == "my_active_queues")
+@cb.action("my_active_queues")
 async def show_my_active_queues(callback: types.CallbackQuery):
     user = ensure_user(callback.from_user.id, callback.from_user.username)
-    entries = session.query(QueueEntry).filter_by(user_id=user.id).all()
+    entries = get_user_active_queues(user.id)
     
     if not entries: 
         return await callback.message.edit_text("📭 <b>Нет активных записей.</b>", parse_mode="HTML", reply_markup=get_back_btn())
@@ -316,14 +325,14 @@ async def show_my_active_queues(callback: types.CallbackQuery):
     kb = []
     
     for e in entries:
-        text += f"🔹 <b>{e.queue.name}</b> — {e.character_name}\n"
+        text += f"🔹 <b>{e.queue_name}</b> — {e.character_name}\n"
         
-        q_name = e.queue.name
+        q_name = e.queue_name
         short_name = (q_name[:12] + '..') if len(q_name) > 12 else q_name
         
         row = [
-            types.InlineKeyboardButton(text=f"🔄 {short_name}", callback_data=f"swap_start_{e.id}"),
-            types.InlineKeyboardButton(text="❌ Выйти", callback_data=f"leave_q_{e.queue_type_id}")
+            types.InlineKeyboardButton(text=f"🔄 {short_name}", callback_data=pack("swap_start", e.id)),
+            types.InlineKeyboardButton(text="❌ Выйти", callback_data=pack("leave_q", e.queue_type_id))
         ]
         kb.append(row)
         
@@ -338,10 +347,8 @@ async def show_my_active_queues(callback: types.CallbackQuery):
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("swap_start_"))
-async def swap_start(callback: types.CallbackQuery):
-    try: eid = int(callback.data.split("_")[2])
-    except: return
+@cb.action("swap_start", int)
+async def swap_start(callback: types.CallbackQuery, eid: int):
     entry = session.get(QueueEntry, eid)
     if not entry: return await callback.answer("Не найдено.", show_alert=True)
     
@@ -351,14 +358,12 @@ async def swap_start(callback: types.CallbackQuery):
     kb = []
     for c in chars:
         if c.nickname == entry.character_name: continue
-        kb.append([types.InlineKeyboardButton(text=f"🔄 На: {c.nickname}", callback_data=f"do_swap_{eid}_{c.id}")])
+        kb.append([types.InlineKeyboardButton(text=f"🔄 На: {c.nickname}", callback_data=pack("do_swap", eid, c.id))])
     kb.append([types.InlineKeyboardButton(text="🔙 Отмена", callback_data="my_active_queues")])
     await callback.message.edit_text(f"👇 Выберите замену для <b>{entry.character_name}</b>:", parse_mode="HTML", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=kb))
 
-@router.callback_query(F.data.startswith("do_swap_"))
-async def do_swap_finish(callback: types.CallbackQuery):
-    parts = callback.data.split("_")
-    eid, cid = int(parts[2]), int(parts[3])
+@cb.action("do_swap", int, int)
+async def do_swap_finish(callback: types.CallbackQuery, eid: int, cid: int):
     entry = session.get(QueueEntry, eid)
     new_char = session.get(Character, cid)
     
@@ -370,13 +375,13 @@ async def do_swap_finish(callback: types.CallbackQuery):
         user = session.get(User, entry.user_id)
         main_char = session.query(Character).filter_by(user_id=user.id, is_main=True).first()
         main_nick = main_char.nickname if main_char else new_char.nickname
-        asyncio.create_task(log_reward_to_sheet(queue_name=entry.queue.name, main_nick=main_nick, char_nick=new_char.nickname, manager_name=user.username, status=f"🔄 Замена ({old_nick})"))
+        await events.emit(EntrySwapped(entry.queue_type_id, entry.queue.name, old_nick, new_char.nickname, main_nick, user.username))
         
         await callback.answer(f"✅ {old_nick} -> {new_char.nickname}")
         await show_my_active_queues(callback)
     else: await show_my_active_queues(callback)
 
-@router.callback_query(F.data == "menu_history")
+@cb.action("menu_history")
 async def my_history(callback: types.CallbackQuery):
     user = ensure_user(callback.from_user.id, callback.from_user.username)
     hist = session.query(RewardHistory).filter_by(user_id=user.id).order_by(RewardHistory.timestamp.desc()).limit(10).all()
@@ -384,9 +389,9 @@ async def my_history(callback: types.CallbackQuery):
     for h in hist: text += f"🔹 {h.timestamp.strftime('%d.%m')} — {h.queue_name} ({h.character_name})\n"
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_back_btn())
 
-@router.callback_query(F.data == "menu_info")
+@cb.action("menu_info")
 async def info_queues(callback: types.CallbackQuery):
-    queues = session.query(QueueType).filter_by(is_active=True).all()
+    queues = get_active_queues()
     text = "ℹ️ <b>Справка:</b>\n\n"
     for q in queues: text += f"🔹 <b>{q.name}</b>\n{q.description}\n\n"
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_back_btn())
\ No newline at end of file
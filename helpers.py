@@ -1,5 +1,4 @@
-from database import get_user_active_queues, get_effective_limit_logic
-
+from database import get_user_active_queues, get_effective_limit_logic, get_characters
 def get_menu_text(user, custom_title=None):
     """
     Генерирует текст меню.
@@ -7,7 +6,8 @@ def get_menu_text(user, custom_title=None):
     :param custom_title: (Опционально) Заголовок сообщения. Если None — ставит приветствие.
     """
     # Если нет персонажей — всегда показываем инструкцию, заголовки тут не важны
-    if not user.characters:
+    chars = get_characters(user.id)
+    if not chars:
         return (
             "👋 <b>Привет!</b>\n\n"
             "Чтобы получить ресы с КХ, следуй простой инструкции:\n"
@@ -24,11 +24,11 @@ def get_menu_text(user, custom_title=None):
     available_slots = limit - current_count
     if available_slots < 0: available_slots = 0
     
-    chars_names = [char.nickname for char in user.characters]
+    chars_names = [char.nickname for char in chars]
     chars_str = ", ".join(chars_names)
     
     if active_queues:
-        q_list = [f"- {q.queue.name} ({q.character_name})" for q in active_queues]
+        q_list = [f"- {q.queue_name} ({q.character_name})" for q in active_queues]
         queues_display = "\n".join(q_list)
     else:
         queues_display = "Нет активных записей"
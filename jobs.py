@@ -0,0 +1,328 @@
+"""
+Очередь задач в SQLite (JOBS_DB_PATH, общий для реплик и воркера) для медленного ввода-вывода:
+записи в Google Sheets, рассылки, бэкапы. Хендлер только кладёт задачу — выполняет её воркер.
+
+    @jobs.handler("broadcast")
+    async def _broadcast_job(ann_id): ...      # выполняется в контексте гильдии задачи
+
+    await jobs.enqueue("broadcast", {"ann_id": 5})
+
+Воркер берёт задачу в аренду на JOB_LEASE секунд и продлевает её, пока работает. Упал воркер —
+аренда истекает и задачу берёт другой (задачи должны переживать повтор). Ошибка — повтор
+с растущей паузой, после JOB_MAX_ATTEMPTS попыток задача остаётся в таблице как "мёртвая".
+Длинная задача отмечает, докуда дошла (checkpoint), и повтор продолжает с этого места.
+
+База — отдельный файл в режиме WAL: чтение не ждёт записи, а запись (воркер в другом процессе
+может держать блокировку до 5 с) идёт в потоке и не останавливает цикл событий с кнопками.
+
+WORKER_MODE=inline (по умолчанию) — задачи выполняет сам бот в фоне, как раньше;
+external — только отдельный процесс `python worker.py` (второе ядро, свой цикл событий).
+"""
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+import lag_watchdog
+import tracing
+from guilds import enter_guild, get_guild
+from metrics import Counter, Histogram, Gauge, refresh_before_render
+
+# --- CONFIGURATION ---
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+WORKER_MODE = os.getenv("WORKER_MODE", "inline")
+# Сколько задач воркер выполняет одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+# Аренда задачи, секунд: не продлили за это время — задача снова свободна
+JOB_LEASE = float(os.getenv("JOB_LEASE", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Как часто свободный воркер заглядывает в очередь, секунд
+JOB_POLL = float(os.getenv("JOB_POLL", "1"))
+# Пауза перед повтором: 30 с, 1 мин, 2 мин... не больше часа
+RETRY_BASE, RETRY_MAX = 30, 60 * 60
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+jobs_total = Counter("bot_jobs_total", "Jobs by kind and result", ("kind", "result"))
+job_seconds = Histogram("bot_job_seconds", "Job duration", ("kind",))
+
+# kind -> async-функция
+_handlers = {}
+# У каждого потока своё соединение (запись идёт из потоков asyncio.to_thread)
+_local = threading.local()
+# (id задачи, отметка прошлой попытки) — для checkpoint/progress внутри обработчика
+_current = ContextVar("current_job", default=None)
+# Будит свой воркер сразу после enqueue (inline-режим), не дожидаясь JOB_POLL
+_wakeup = None
+_task = None
+_stop = None
+
+
+def _conn():
+    db = getattr(_local, "db", None)
+    if db is None:
+        db = _local.db = sqlite3.connect(JOBS_DB_PATH, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                guild_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                -- Одна невыполненная задача на ключ (например, дозапись outbox гильдии)
+                key TEXT UNIQUE,
+                run_after REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                trace TEXT,
+                -- Докуда задача дошла (JSON), см. checkpoint
+                progress TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_jobs_ready ON jobs (dead, run_after);
+            -- Состояние предохранителей каждого процесса (бот, worker.py) — для панели мастера
+            CREATE TABLE IF NOT EXISTS breakers (
+                name TEXT NOT NULL,
+                worker TEXT NOT NULL,
+                state TEXT NOT NULL,
+                opened_at REAL,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (name, worker)
+            );
+        """)
+        db.commit()
+    return db
+
+
+def _counts():
+    try:
+        ready, leased, dead = _conn().execute(
+            "SELECT SUM(dead = 0 AND (lease_until IS NULL OR lease_until < ?)), "
+            "SUM(dead = 0 AND lease_until >= ?), SUM(dead) FROM jobs", (time.time(), time.time())).fetchone()
+    except sqlite3.Error:
+        return {}
+    return {"waiting": ready or 0, "running": leased or 0, "dead": dead or 0}
+
+
+# Последние подсчитанные stats(): гейдж читает их, а не базу (он вызывается на цикле событий)
+_last_counts = {}
+Gauge("bot_jobs", "Jobs in the queue by state", lambda: _last_counts, "state")
+
+
+def handler(kind):
+    """Декоратор: функция выполняет задачи этого вида (аргументы — из payload)."""
+    def decorator(fn):
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def _insert(row):
+    db = _conn()
+    with db:
+        cur = db.execute(
+            "INSERT INTO jobs (kind, guild_id, payload, key, run_after, trace, created_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO NOTHING", row)
+    return cur.lastrowid if cur.rowcount else None
+
+
+async def enqueue(kind, payload=None, guild_id=None, key=None, delay=0):
+    """
+    Кладёт задачу в очередь (гильдия — текущая, если не указана). С key задача не дублируется,
+    пока предыдущая с тем же ключом не выполнена. Возвращает id задачи или None (дубль).
+    """
+    now = time.time()
+    row = (kind, guild_id or get_guild().id, json.dumps(payload or {}, ensure_ascii=False), key, now + delay,
+           tracing.correlation_id(), now)
+    job_id = await asyncio.to_thread(_insert, row)
+    if _wakeup: _wakeup.set()
+    return job_id
+
+
+def progress():
+    """Отметка, сохранённая прошлой попыткой этой задачи (см. checkpoint), или None."""
+    current = _current.get()
+    return current[1] if current else None
+
+
+def _save_progress(job_id, value):
+    db = _conn()
+    with db: db.execute("UPDATE jobs SET progress = ? WHERE id = ? AND worker = ?", (value, job_id, WORKER_ID))
+
+
+async def checkpoint(value):
+    """Запоминает, докуда дошла текущая задача: повтор после ошибки или падения воркера продолжит отсюда."""
+    job_id, _ = _current.get()
+    _current.set((job_id, value))
+    await asyncio.to_thread(_save_progress, job_id, json.dumps(value))
+
+
+def _waiting(kind, guild_id):
+    return _conn().execute("SELECT COUNT(*) FROM jobs WHERE kind = ? AND guild_id = ? AND dead = 0", (kind, guild_id)).fetchone()[0]
+
+
+async def waiting(kind, guild_id):
+    """Сколько задач этого вида гильдии ещё не выполнено."""
+    return await asyncio.to_thread(_waiting, kind, guild_id)
+
+
+def kinds():
+    return sorted(_handlers)
+
+
+@refresh_before_render
+async def stats():
+    """{"waiting": ..., "running": ..., "dead": ...} — для панели мастера и гейджа bot_jobs."""
+    global _last_counts
+    _last_counts = await asyncio.to_thread(_counts)
+    return _last_counts
+
+
+def _save_breaker(row):
+    db = _conn()
+    with db:
+        db.execute("INSERT OR REPLACE INTO breakers (name, worker, state, opened_at, last_error, updated_at) "
+                   "VALUES (?, ?, ?, ?, ?, ?)", row)
+
+
+async def save_breaker(breaker):
+    """Публикует состояние предохранителя этого процесса (on_change у CircuitBreaker)."""
+    row = (breaker.name, WORKER_ID, breaker.state, breaker.opened_at, breaker.last_error, time.time())
+    await asyncio.to_thread(_save_breaker, row)
+
+
+def _breaker_states(name, since):
+    return _conn().execute("SELECT state, opened_at, last_error FROM breakers WHERE name = ? AND updated_at >= ?",
+                           (name, since)).fetchall()
+
+
+async def breaker_states(name, max_age):
+    """[(state, opened_at, last_error)] предохранителя name во всех процессах, обновлённые за max_age секунд."""
+    return await asyncio.to_thread(_breaker_states, name, time.time() - max_age)
+
+
+def _claim():
+    now = time.time()
+    db = _conn()
+    with db:
+        return db.execute(
+            "UPDATE jobs SET lease_until = ?, worker = ?, attempts = attempts + 1 WHERE id = ("
+            "  SELECT id FROM jobs WHERE dead = 0 AND run_after <= ? AND (lease_until IS NULL OR lease_until < ?)"
+            f"  AND kind IN ({','.join('?' * len(_handlers))}) ORDER BY id LIMIT 1"
+            ") RETURNING id, kind, guild_id, payload, attempts, trace, progress",
+            (now + JOB_LEASE, WORKER_ID, now, now, *_handlers)).fetchone()
+
+
+def _extend(job_id):
+    db = _conn()
+    with db:
+        db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?", (time.time() + JOB_LEASE, job_id, WORKER_ID))
+
+
+def _finish(job_id, attempts, error=None):
+    db = _conn()
+    with db:
+        if error is None:
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        elif attempts >= JOB_MAX_ATTEMPTS:
+            # Ключ освобождаем, чтобы такие задачи снова можно было ставить
+            db.execute("UPDATE jobs SET dead = 1, key = NULL, lease_until = NULL, error = ? WHERE id = ?", (error, job_id))
+        else:
+            retry_at = time.time() + min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            db.execute("UPDATE jobs SET run_after = ?, lease_until = NULL, error = ? WHERE id = ?", (retry_at, error, job_id))
+
+
+def _release(job_id):
+    db = _conn()
+    with db: db.execute("UPDATE jobs SET lease_until = NULL, attempts = attempts - 1 WHERE id = ?", (job_id,))
+
+
+async def _run(job):
+    job_id, kind, guild_id, payload, attempts, trace, saved = job
+    with enter_guild(guild_id):
+        await _execute(job_id, kind, payload, attempts, trace, saved)
+
+
+async def _execute(job_id, kind, payload, attempts, trace, saved):
+    lag_watchdog.tag(f"job {kind}")
+    started = time.perf_counter()
+    work = None
+    try:
+        # Битый payload (не JSON, не те аргументы) — обычная ошибка задачи: повтор, потом "мёртвая"
+        _current.set((job_id, json.loads(saved) if saved else None))
+        work = asyncio.create_task(_handlers[kind](**json.loads(payload)))
+        # Продлеваем аренду, пока задача выполняется
+        while not work.done():
+            await asyncio.wait({work}, timeout=JOB_LEASE / 3)
+            if not work.done(): await asyncio.to_thread(_extend, job_id)
+        await work
+    except asyncio.CancelledError:
+        if work: work.cancel()
+        # Остановка воркера: задачу сразу отдаём другим, попытку не засчитываем
+        await asyncio.shield(asyncio.to_thread(_release, job_id))
+        jobs_total.inc(kind, "cancelled")
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        await asyncio.to_thread(_finish, job_id, attempts, error)
+        jobs_total.inc(kind, "dead" if attempts >= JOB_MAX_ATTEMPTS else "retry")
+        print(f"❌ Job {kind} #{job_id} (attempt {attempts}) failed: {error}" + (f" (trace {trace})" if trace else ""))
+    else:
+        await asyncio.to_thread(_finish, job_id, attempts)
+        jobs_total.inc(kind, "ok")
+    finally:
+        job_seconds.observe(time.perf_counter() - started, kind)
+
+
+async def _consume(stop):
+    while not stop.is_set():
+        try:
+            job = await asyncio.to_thread(_claim) if _handlers else None
+        except sqlite3.Error as e:
+            print(f"⚠️ Job queue error: {e}")
+            job = None
+        if job:
+            # Что бы ни случилось с задачей (и с записью её итога), воркер берёт следующую
+            try: await _run(job)
+            except Exception as e: print(f"❌ Job #{job[0]} ({job[1]}) crashed the consumer: {type(e).__name__}: {e}")
+            continue
+        _wakeup.clear()
+        try: await asyncio.wait_for(_wakeup.wait(), JOB_POLL)
+        except asyncio.TimeoutError: pass
+
+
+async def run(stop, concurrency=WORKER_CONCURRENCY):
+    """Выполняет задачи, пока не выставлен stop; начатые задачи доделываются."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    consumers = [asyncio.create_task(_consume(stop)) for _ in range(concurrency)]
+    await stop.wait()
+    _wakeup.set()
+    await asyncio.gather(*consumers, return_exceptions=True)
+
+
+def start():
+    """inline-режим: бот сам выполняет задачи в фоне (вызывать из работающего цикла)."""
+    global _task, _stop
+    if WORKER_MODE != "inline": return
+    _stop = asyncio.Event()
+    _task = asyncio.create_task(run(_stop))
+
+
+async def stop(timeout=30):
+    """Даёт начатым задачам доделаться; не успели — отменяем, задачи вернутся в очередь."""
+    if not _task: return
+    _stop.set()
+    try: await asyncio.wait_for(asyncio.shield(_task), timeout)
+    except asyncio.TimeoutError:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
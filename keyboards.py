@@ -1,8 +1,16 @@
+from functools import lru_cache
 from aiogram import types
 
+from callbacks import pack
+
 # --- INLINE KEYBOARDS ---
+# Статичные клавиатуры собираются один раз и переиспользуются
 
 def get_main_menu(user):
+    return _build_main_menu(bool(user.is_master))
+
+@lru_cache(maxsize=None)
+def _build_main_menu(is_master):
     kb = [
         [types.InlineKeyboardButton(text="👥 Мои персонажи", callback_data="menu_chars")],
         [types.InlineKeyboardButton(text="✍️ Записаться в очередь", callback_data="menu_join")],
@@ -10,10 +18,11 @@ def get_main_menu(user):
         [types.InlineKeyboardButton(text="ℹ️ Инфо об очередях", callback_data="menu_info")],
         [types.InlineKeyboardButton(text="🏃 Управление записями в очереди", callback_data="my_active_queues")]
     ]
-    if user.is_master:
+    if is_master:
         kb.append([types.InlineKeyboardButton(text="👑 Панель Мастера", callback_data="menu_master")])
     return types.InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def get_master_menu():
     kb = [
         [types.InlineKeyboardButton(text="🎁 Выдать награды", callback_data="m_distribute")],
@@ -33,10 +42,12 @@ def get_master_menu():
         [types.InlineKeyboardButton(text="📜 Общий Архив выдачи наград", callback_data="m_global_log")],
         [types.InlineKeyboardButton(text="👑 Добавить Мастера", callback_data="m_add_admin_start")],
         [types.InlineKeyboardButton(text="💾 Скачать Бэкап БД", callback_data="m_backup")],
+        [types.InlineKeyboardButton(text="🔬 Профилирование", callback_data="m_profile")],
         [types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_to_main")]
     ]
     return types.InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=None)
 def get_back_btn(callback_data="back_to_main"):
     return types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="🔙 Назад", callback_data=callback_data)]])
 
@@ -52,7 +63,7 @@ def get_weekdays_kb(selected_days=None):
     for name, code in days:
         # Если день выбран, ставим галочку
         mark = "✅" if code in selected_days else "⬜"
-        kb.append([types.InlineKeyboardButton(text=f"{mark} {name}", callback_data=f"toggle_day_{code}")])
+        kb.append([types.InlineKeyboardButton(text=f"{mark} {name}", callback_data=pack("toggle_day", code))])
     
     # Кнопка Готово
     kb.append([types.InlineKeyboardButton(text="💾 Готово / Далее", callback_data="days_confirm")])
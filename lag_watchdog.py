@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from logging.handlers import RotatingFileHandler
+
+from metrics import Histogram
+
+# --- CONFIGURATION ---
+# Задержка цикла событий, после которой снимаем стек того, кто его держит (секунды). 0 — выключено.
+LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+# Как часто цикл "отмечается" — точность замера задержки
+TICK = 0.05
+# Стеки и сводка задержек пишутся сюда (ротация: 3 файла по 1 МБ)
+LAG_LOG_FILE = os.getenv("LOOP_LAG_LOG", "loop_lag.log")
+# Как часто дописываем в лог сводку по гистограмме
+SUMMARY_INTERVAL = 10 * 60
+
+lag_seconds = Histogram(
+    "bot_loop_lag_seconds", "Event loop lag", (),
+    (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+log = logging.getLogger("loop_lag")
+
+# --- STATE ---
+# Задача -> что она сейчас делает ("callback_query cb:issue"). Ставят tag() из UpdateMetricsMiddleware,
+# HandlerMetricsMiddleware (middlewares/metrics.py) и jobs._execute.
+_tags = weakref.WeakKeyDictionary()
+_loop = None
+_loop_thread_id = None
+# Время последней отметки цикла и отметка, для которой стек уже снят
+_beat = 0.0
+_reported = None
+_last_blocker = None
+_task = None
+_thread = None
+_stop = threading.Event()
+
+
+def tag(label):
+    """Подписывает текущую задачу — эта подпись попадёт в лог, если задача заблокирует цикл."""
+    task = asyncio.current_task()
+    if task: _tags[task] = label
+
+
+def describe_task(task):
+    """Подпись задачи для логов и профиля: тег из tag() или имя корутины."""
+    if task is None: return "loop callback (no task)"
+    label = _tags.get(task)
+    if label: return label
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or task.get_name()
+
+
+def _watch():
+    """Поток-сторож: если цикл не отмечался дольше порога — снимаем стек главного потока."""
+    global _reported, _last_blocker
+    while not _stop.wait(TICK):
+        beat = _beat
+        stalled = time.monotonic() - beat
+        if stalled < LAG_THRESHOLD or beat == _reported: continue
+        _reported = beat
+
+        frame = sys._current_frames().get(_loop_thread_id)
+        # Цикл стоит, поэтому текущая задача не поменяется, пока мы её читаем
+        _last_blocker = describe_task(asyncio.current_task(_loop))
+        stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>\n"
+        log.warning(f"Loop blocked for {stalled * 1000:.0f}+ ms by {_last_blocker}\n{stack}")
+
+
+def _summary():
+    counts, total, count = lag_seconds.values.get((), [[0] * len(lag_seconds.buckets), 0.0, 0])
+    buckets = ", ".join(f"≤{b}s: {c}" for b, c in zip(lag_seconds.buckets, counts) if c)
+    return f"Lag summary: {count} ticks, avg {total / count * 1000 if count else 0:.1f} ms; {buckets}"
+
+
+async def _ticker():
+    global _beat, _last_blocker
+    next_summary = time.monotonic() + SUMMARY_INTERVAL
+    while True:
+        _beat = started = time.monotonic()
+        await asyncio.sleep(TICK)
+        lag = max(time.monotonic() - started - TICK, 0.0)
+        lag_seconds.observe(lag)
+        if lag >= LAG_THRESHOLD:
+            log.warning(f"Loop lag {lag * 1000:.0f} ms (blocker: {_last_blocker or 'unknown'})")
+            _last_blocker = None
+        if time.monotonic() >= next_summary:
+            next_summary += SUMMARY_INTERVAL
+            log.info(_summary())
+
+
+def _setup_log():
+    if log.handlers: return
+    handler = RotatingFileHandler(LAG_LOG_FILE, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+
+def start():
+    """Запускает замер задержки цикла и поток-сторож (вызывать из работающего цикла)."""
+    global _loop, _loop_thread_id, _beat, _task, _thread
+    if not LAG_THRESHOLD: return
+    _setup_log()
+    _loop = asyncio.get_running_loop()
+    _loop_thread_id = threading.get_ident()
+    _beat = time.monotonic()
+    _task = asyncio.create_task(_ticker())
+    _stop.clear()
+    _thread = threading.Thread(target=_watch, name="loop-watchdog", daemon=True)
+    _thread.start()
+
+
+async def stop():
+    if not _task: return
+    _stop.set()
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
+    log.info(_summary())
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+from guilds import ROUTER_DB_PATH
+
+# --- CONFIGURATION ---
+# Аренда лидерства: кто её держит, тот и запускает задачи планировщика.
+# Реплики должны видеть один и тот же файл ROUTER_DB_PATH (общий volume).
+LEASE_NAME = "scheduler"
+LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "15"))
+RENEW_INTERVAL = LEASE_TTL / 3
+
+# Уникальный id этого процесса
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+is_leader = False
+_db = None
+_task = None
+
+
+def _conn():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(ROUTER_DB_PATH, timeout=2)
+        _db.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        _db.commit()
+    return _db
+
+
+def try_acquire(name=LEASE_NAME, holder=HOLDER_ID, ttl=LEASE_TTL):
+    """Берёт или продлевает аренду. True — мы лидер до now + ttl."""
+    now = time.time()
+    db = _conn()
+    with db:
+        db.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (name, holder, now + ttl, now),
+        )
+    row = db.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return bool(row) and row[0] == holder
+
+
+def release(name=LEASE_NAME, holder=HOLDER_ID):
+    """Отдаёт аренду сразу, чтобы резервная реплика не ждала TTL."""
+    db = _conn()
+    with db:
+        db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+async def run_election(on_elected, on_demoted, on_renewed=None):
+    """
+    Фоновый цикл: продлевает аренду и переключает роль при её получении/потере.
+    on_renewed вызывается у лидера после каждого продления (раз в RENEW_INTERVAL).
+    """
+    global is_leader
+    try:
+        while True:
+            try:
+                leader_now = try_acquire()
+            except sqlite3.Error as e:
+                # Не смогли подтвердить аренду — безопаснее считать, что мы её потеряли
+                print(f"⚠️ Leader lease error: {e}")
+                leader_now = False
+
+            if leader_now and not is_leader:
+                is_leader = True
+                print(f"👑 {HOLDER_ID} is now the scheduler leader")
+                on_elected()
+            elif not leader_now and is_leader:
+                is_leader = False
+                print(f"💤 {HOLDER_ID} lost the scheduler lease")
+                on_demoted()
+            elif leader_now and on_renewed:
+                on_renewed()
+
+            await asyncio.sleep(RENEW_INTERVAL)
+    finally:
+        if is_leader:
+            is_leader = False
+            on_demoted()
+            release()
+
+
+def start(on_elected, on_demoted, on_renewed=None):
+    global _task
+    _task = asyncio.create_task(run_election(on_elected, on_demoted, on_renewed))
+
+
+async def stop():
+    """Останавливает выборы и отдаёт аренду (вызывать при остановке бота)."""
+    if not _task: return
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
@@ -1,18 +1,83 @@
 import os
 import pytz
 from aiogram import Bot, Dispatcher
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
 
+from fsm_storage import SQLiteStorage
+from guilds import ROUTER_DB_PATH
+from middlewares.guild import GuildMiddleware
+from middlewares.metrics import ApiMetricsMiddleware, HandlerMetricsMiddleware, UpdateMetricsMiddleware
+from middlewares.profiler import ProfilerMiddleware
+from middlewares.recorder import UpdateRecorder
+from middlewares.render_cache import RENDER_CACHE_SIZE, RenderCacheMiddleware
+from middlewares.throttling import ThrottlingMiddleware
+from middlewares.tracing import TracingApiMiddleware, TracingMiddleware
+
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     exit("Error: BOT_TOKEN not found in .env file")
 
+# Режим получения апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# Сколько апдейтов обрабатываем одновременно, остальным отвечаем 503
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "40"))
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    exit("Error: BOT_MODE=webhook requires WEBHOOK_URL in .env file")
+# Без секрета любой, кто знает адрес, может слать боту поддельные апдейты
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    exit("Error: BOT_MODE=webhook requires WEBHOOK_SECRET in .env file")
+
+# Где храним состояния FSM (отдельный файл, чтобы частые записи не спорили за блокировку с базами гильдий)
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "fsm.db")
+
+# Задачи планировщика хранятся в базе и переживают рестарт
+SCHEDULER_DB_URL = os.getenv("SCHEDULER_DB_URL", f"sqlite:///{ROUTER_DB_PATH}")
+# Пропущенный запуск (бот лежал) выполняем, если опоздали не больше чем на столько секунд
+MISFIRE_GRACE_TIME = int(os.getenv("MISFIRE_GRACE_TIME", str(6 * 60 * 60)))
+
+# Запись входящих апдейтов для tools/replay.py (пусто — выключено). Соль нужна, чтобы обезличить копию базы так же.
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")
+RECORD_SALT = os.getenv("RECORD_SALT")
+
 # Часовой пояс
 MSK = pytz.timezone('Europe/Moscow')
 
 # Инициализация
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
-scheduler = AsyncIOScheduler(timezone=MSK)
\ No newline at end of file
+# Пропускаем edit_text, которые ничего не меняют ("message is not modified"); кэш — на процесс
+if RENDER_CACHE_SIZE: bot.session.middleware(RenderCacheMiddleware())
+# Замеры реальных запросов к Telegram (пропущенные выше edit_text не считаются)
+bot.session.middleware(ApiMetricsMiddleware())
+bot.session.middleware(TracingApiMiddleware())
+dp = Dispatcher(storage=SQLiteStorage(FSM_DB_PATH))
+# Запись трафика — первой, чтобы в лог попали и апдейты, отсечённые антиспамом
+recorder = UpdateRecorder(RECORD_UPDATES, RECORD_SALT) if RECORD_UPDATES else None
+if recorder: dp.update.outer_middleware(recorder)
+# Каждый апдейт обрабатывается в контексте своей гильдии (база, таблица, очереди)
+dp.update.outer_middleware(GuildMiddleware())
+# Трейс апдейта: SQL, Google Sheets, Bot API и фоновые задачи под одним id (см. tracing.py)
+dp.update.outer_middleware(TracingMiddleware())
+# Метрики для Prometheus (см. metrics.py)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+# Профилирование по кнопке из панели мастера (см. profiler.py)
+dp.message.middleware(ProfilerMiddleware())
+dp.callback_query.middleware(ProfilerMiddleware())
+# Антиспам кнопками: срабатывает до хендлеров и базы
+dp.callback_query.outer_middleware(ThrottlingMiddleware())
+# coalesce: несколько пропущенных запусков одной задачи схлопываются в один
+scheduler = AsyncIOScheduler(
+    timezone=MSK,
+    jobstores={"default": SQLAlchemyJobStore(url=SCHEDULER_DB_URL)},
+    job_defaults={"misfire_grace_time": MISFIRE_GRACE_TIME, "coalesce": True, "max_instances": 1},
+)
@@ -1,47 +1,110 @@
+# Первым: от этого момента меряется запуск (см. startup.py)
+import startup
+
 import asyncio
 import logging
 from aiogram import Bot
 
 # Наш новый файл loader, где живут bot, dp и scheduler
-from loader import bot, dp, scheduler
+from loader import bot, dp, scheduler, recorder, BOT_MODE
 
 # Подключаем роутеры из папки handlers
 from handlers import user, admin
-from database import init_db, session, ScheduledAnnouncement
+import callbacks
+import board
+import api
+import metrics
+import lag_watchdog
+import leader
+import background
+import jobs
+import reconcile
+from database import init_db
+import breaker
+from guilds import GUILDS, enter_guild
+
+# Досоздание задач расписания, которых нет в базе планировщика
+from handlers.admin import restore_jobs
 
-# Нужно импортировать функцию schedule_job, чтобы восстановить задачи при старте
-# Поскольку она теперь в handlers/admin.py, импортируем оттуда
-from handlers.admin import schedule_job
+startup.mark("imports")
 
 async def on_startup():
     # 1. Настройка команд меню
     from aiogram.types import BotCommand
-    await bot.set_my_commands([BotCommand(command="/start", description="🏠 Главное меню")])
-    
-    # 2. Восстановление задач расписания
-    tasks = session.query(ScheduledAnnouncement).filter_by(is_active=True).all()
+    with startup.phase("set_commands"):
+        await bot.set_my_commands([BotCommand(command="/start", description="🏠 Главное меню")])
+
+    # 2. Запуск планировщика: задачи подгружаются из его базы. Зарегистрированы
+    # в каждой реплике, но выполняет их только держатель аренды лидера (см. leader.py).
+    # Пропущенные за время простоя запуски сработают один раз после resume.
+    with startup.phase("scheduler"):
+        scheduler.start(paused=True)
+
+    # 3. Недостающие задачи расписания и табло — в каждой гильдии
     count = 0
-    for t in tasks:
-        if t.schedule_type != 'once_now':
-            schedule_job(t, bot)
-            count += 1
-            
-    # 3. Запуск планировщика
-    scheduler.start()
-    print(f"✅ Bot started. Jobs restored: {count}")
+    with startup.phase("jobs_and_boards"):
+        for gid in GUILDS:
+            with enter_guild(gid):
+                count += restore_jobs()
+
+                # 4. Табло очередей в чате гильдии (если включено). Сбой табло не мешает запуску бота
+                try: await board.refresh()
+                except Exception as e: print(f"⚠️ Board refresh failed for guild '{gid}': {e}")
+        # Дозапись отложенных строк и ночная сверка вкладок Google Sheets с базой
+        reconcile.schedule_jobs()
+
+    # 5. Прогрев кэшей (ростер, каталог очередей, игроки) — до приёма первого апдейта
+    await startup.warm_up(dp.storage)
+
+    with startup.phase("services"):
+        # 6. HTTP API очередей для сайта (если включено)
+        await api.start_api()
+        # 7. Метрики для Prometheus (если включены)
+        await metrics.start_metrics()
+        # 8. Сторож цикла событий: стеки блокирующего кода -> loop_lag.log
+        lag_watchdog.start()
+        # 9. Очередь задач (Google Sheets, рассылки, бэкапы): здесь или в отдельном worker.py
+        jobs.start()
+
+    # Задачи в общем хранилище могли добавить или поменять на другой реплике, а планировщик лидера
+    # об этом не знает (APScheduler не следит за чужими записями) — при каждом продлении аренды
+    # он заново смотрит в хранилище, когда ближайший запуск.
+    leader.start(on_elected=scheduler.resume, on_demoted=scheduler.pause, on_renewed=scheduler.wakeup)
+    print(f"✅ Bot started. Guilds: {len(GUILDS)}. Jobs: {len(scheduler.get_jobs())} (new: {count})")
+    startup.report()
 
 async def main():
     # Подключаем логику
     dp.include_router(user.router)
     dp.include_router(admin.router)
+    # Все inline-кнопки разбираются одной таблицей действий (см. callbacks.py)
+    dp.include_router(callbacks.router)
     
-    await bot.delete_webhook(drop_pending_updates=True)
     await on_startup()
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            from webhook import run_webhook
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        await leader.stop()
+        # Доделываем фоновые записи в Google (с ограничением по времени)
+        await background.drain()
+        await jobs.stop()
+        await api.stop_api()
+        await metrics.stop_metrics()
+        await lag_watchdog.stop()
+        await breaker.stop_all()
+        # Досбрасываем накопленные состояния FSM в базу
+        await dp.storage.close()
+        if recorder: recorder.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    init_db()
+    with startup.phase("init_db"):
+        init_db()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,203 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+from sqlalchemy import event
+
+# --- CONFIGURATION ---
+# Порт для Prometheus (/metrics). Пусто — метрики копятся, но наружу не отдаются.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) or None
+# По умолчанию слушаем только локально: метрики не для внешнего мира
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Границы гистограмм времени (секунды)
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Границы гистограммы "запросов к базе на апдейт"
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+# --- ТИПЫ МЕТРИК ---
+# Минимальная реализация текстового формата Prometheus, без сторонних библиотек
+
+_registry = []
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, v in self.values.items():
+            yield f"{self.name}{_fmt_labels(self.labels, labels)} {v}"
+
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        # labels -> [счётчики по корзинам, сумма, количество]
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[0][i] += 1
+                break
+        row[1] += value
+        row[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self.values.items():
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, labels, ('le', bound))} {acc}"
+            yield f"{self.name}_bucket{_fmt_labels(self.labels, labels, ('le', '+Inf'))} {count}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, labels)} {count}"
+
+
+class Gauge:
+    """Значение считается в момент запроса /metrics: fn() -> число или {метка: число}."""
+
+    def __init__(self, name, doc, fn, label=None):
+        self.name, self.doc, self.fn, self.label = name, doc, fn, label
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.fn()
+        if isinstance(value, dict):
+            for k, v in value.items():
+                yield f"{self.name}{_fmt_labels((self.label,), (k,))} {v}"
+        else:
+            yield f"{self.name} {value}"
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        try: lines.extend(metric.render())
+        except Exception as e: print(f"❌ Metric {metric.name} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+
+# --- МЕТРИКИ БОТА ---
+
+updates_total = Counter("bot_updates_total", "Updates processed", ("type",))
+update_seconds = Histogram("bot_update_seconds", "Full update processing time", ("type",))
+handler_seconds = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Handler exceptions", ("handler",))
+
+sql_queries = Counter("bot_sql_queries_total", "SQL statements executed", ("guild",))
+sql_seconds = Counter("bot_sql_seconds_total", "Time spent in SQL statements", ("guild",))
+sql_per_update = Histogram("bot_sql_queries_per_update", "SQL statements per update", (), COUNT_BUCKETS)
+
+sheets_calls = Counter("bot_sheets_calls_total", "Google Sheets calls", ("op",))
+sheets_errors = Counter("bot_sheets_errors_total", "Failed Google Sheets calls", ("op",))
+sheets_seconds = Histogram("bot_sheets_seconds", "Google Sheets call latency", ("op",))
+
+api_calls = Counter("bot_api_calls_total", "Telegram Bot API requests", ("method",))
+api_errors = Counter("bot_api_errors_total", "Failed Telegram Bot API requests", ("method",))
+api_retry_after = Counter("bot_api_retry_after_total", "Telegram 429 (flood control) responses", ("method",))
+api_seconds = Histogram("bot_api_seconds", "Telegram Bot API latency", ("method",))
+
+Gauge("bot_asyncio_tasks", "Pending asyncio tasks", lambda: len(asyncio.all_tasks()))
+
+
+# --- ЗАМЕРЫ ---
+
+# Счётчик SQL текущего апдейта: [запросов, секунд]. Ставит UpdateMetricsMiddleware.
+update_sql = ContextVar("update_sql", default=None)
+
+
+def instrument_engine(engine, guild_id):
+    """Вешает на движок гильдии подсчёт запросов и времени."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        took = time.perf_counter() - conn.info["query_started"].pop()
+        sql_queries.inc(guild_id)
+        sql_seconds.inc(guild_id, value=took)
+        stats = update_sql.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += took
+
+    return engine
+
+
+@contextmanager
+def track_sheets(op):
+    """with track_sheets("append_row"): ... — время, количество и ошибки вызовов gspread."""
+    started = time.perf_counter()
+    sheets_calls.inc(op)
+    try:
+        yield
+    except Exception:
+        sheets_errors.inc(op)
+        raise
+    finally:
+        sheets_seconds.observe(time.perf_counter() - started, op)
+
+
+# --- HTTP ---
+
+_runner = None
+# async-функции, обновляющие значения гейджей перед отдачей /metrics (то, что нельзя читать на цикле событий)
+_refreshers = []
+
+
+def refresh_before_render(fn):
+    """Декоратор: fn() вызывается (await) перед каждым запросом /metrics."""
+    _refreshers.append(fn)
+    return fn
+
+
+async def handle_metrics(request: web.Request):
+    for fn in _refreshers:
+        try: await fn()
+        except Exception as e: print(f"❌ Metrics refresh {fn.__name__} failed: {e}")
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics():
+    """Поднимает /metrics на METRICS_PORT (если задан)."""
+    global _runner
+    if not METRICS_PORT: return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Metrics listening on {METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_metrics():
+    if _runner: await _runner.cleanup()
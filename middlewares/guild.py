@@ -0,0 +1,24 @@
+from aiogram import BaseMiddleware
+
+from guilds import GUILDS, bind_user, enter_guild, resolve_guild
+
+
+class GuildMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на update: определяет гильдию апдейта и выставляет
+    guilds.current_guild — от неё зависят база, таблица и каталог очередей.
+    """
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+
+        # Приглашение в гильдию: t.me/<bot>?start=<guild_id>
+        message = event.message
+        if user and message and message.text and message.text.startswith("/start "):
+            arg = message.text.split(maxsplit=1)[1].strip()
+            if arg in GUILDS: bind_user(user.id, arg)
+
+        gid = resolve_guild(chat.id if chat else None, user.id if user else None)
+        with enter_guild(gid):
+            return await handler(event, data)
@@ -0,0 +1,76 @@
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import CallbackQuery
+
+import lag_watchdog
+import metrics
+import tracing
+from callbacks import SEP, cb
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware на update: полное время апдейта и число SQL-запросов в нём."""
+
+    async def __call__(self, handler, event, data):
+        kind = event.event_type
+        lag_watchdog.tag(kind)
+        stats = [0, 0.0]
+        token = metrics.update_sql.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.update_sql.reset(token)
+            metrics.updates_total.inc(kind)
+            metrics.update_seconds.observe(time.perf_counter() - started, kind)
+            metrics.sql_per_update.observe(stats[0])
+
+
+def handler_name(event, data):
+    """Имя для метки: код кнопки для callback (см. callbacks.py), иначе имя функции-хендлера."""
+    if isinstance(event, CallbackQuery):
+        code = (event.data or "").split(SEP)[0]
+        return f"cb:{code}" if code in cb.handlers else "cb:unknown"
+    handler = data.get("handler")
+    return handler.callback.__name__ if handler else "unknown"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware (message / callback_query): задержка и ошибки по хендлерам."""
+
+    async def __call__(self, handler, event, data):
+        name = handler_name(event, data)
+        # Если хендлер заблокирует цикл, сторож подпишет стек этим именем
+        lag_watchdog.tag(f"{data['event_update'].event_type} {name}")
+        tracing.annotate(handler=name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+        finally:
+            metrics.handler_seconds.observe(time.perf_counter() - started, name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Запросы к Bot API: количество, время, ошибки и 429 по методам."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        metrics.api_calls.inc(name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.api_retry_after.inc(name)
+            metrics.api_errors.inc(name)
+            raise
+        except Exception:
+            metrics.api_errors.inc(name)
+            raise
+        finally:
+            metrics.api_seconds.observe(time.perf_counter() - started, name)
@@ -0,0 +1,14 @@
+from aiogram import BaseMiddleware
+
+import profiler
+from middlewares.metrics import handler_name
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Внутренний middleware: в режиме cProfile профилирует выборку апдейтов (см. profiler.py)."""
+
+    async def __call__(self, handler, event, data):
+        run = profiler.current()
+        if not run or not run.wants():
+            return await handler(event, data)
+        return await run.profile(handler_name(event, data), handler(event, data))
@@ -0,0 +1,117 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+
+from aiogram import BaseMiddleware
+
+# Сколько записей держим в буфере перед записью на диск
+FLUSH_EVERY = 50
+
+# Текст, который оставляем как есть: команды и "технический" ввод (числа, даты, время)
+_KEEP_TEXT = re.compile(r"^(/\S+(\s+\S+)?|[\d\s.:,\-]+)$")
+
+
+class Anonymizer:
+    """
+    Заменяет id, username и введённый текст (ники) хэшем с солью: один и тот же игрок
+    всегда получает один псевдоним. С той же солью tools/replay.py обезличивает копию
+    базы, и записанные апдейты попадают на "своих" игроков.
+    """
+
+    def __init__(self, salt):
+        self.salt = salt.encode()
+
+    def _hash(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).hexdigest()
+
+    def anon_id(self, value):
+        # Группы (отрицательные id) определяют гильдию — их не трогаем
+        if value < 0: return value
+        return int(self._hash(value)[:12], 16) % 10 ** 10 + 1
+
+    def anon_text(self, text):
+        if not text or _KEEP_TEXT.match(text.strip()): return text
+        return f"N{self._hash(text.strip().lower())[:8]}"
+
+    def anon_username(self, username):
+        return f"u{self._hash(username)[:8]}" if username else username
+
+
+class UpdateRecorder(BaseMiddleware):
+    """
+    Внешний middleware на update: пишет входящие апдейты в JSONL для tools/replay.py.
+
+    Записи компактные (только то, что читают хендлеры) и обезличенные (см. Anonymizer).
+    Id из callback_data остаются, поэтому лог проигрывается на копии базы.
+    """
+
+    def __init__(self, path, salt=None):
+        if not salt:
+            print("⚠️ RECORD_SALT is not set: recorded players can't be matched to a database copy")
+        self.anon = Anonymizer(salt or os.urandom(16).hex())
+        self.file = open(path, "a", encoding="utf-8")
+        self.pending = 0
+
+    def compact(self, update):
+        if update.message and update.message.from_user:
+            m = update.message
+            row = {"k": "m", "x": self.anon.anon_text(m.text), "m": m.message_id, "ct": m.chat.type}
+            chat_id, user = m.chat.id, m.from_user
+        elif update.callback_query:
+            q = update.callback_query
+            if not q.message: return None
+            row = {"k": "c", "d": q.data, "m": q.message.message_id, "ct": q.message.chat.type}
+            chat_id, user = q.message.chat.id, q.from_user
+        else:
+            return None
+
+        row["u"] = self.anon.anon_id(user.id)
+        row["c"] = self.anon.anon_id(chat_id)
+        if user.username: row["n"] = self.anon.anon_username(user.username)
+        return row
+
+    async def __call__(self, handler, event, data):
+        try:
+            row = self.compact(event)
+            if row:
+                row["t"] = round(time.time(), 3)
+                self.file.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+                self.pending += 1
+                if self.pending >= FLUSH_EVERY: self.flush()
+        except Exception as e:
+            # Запись — вспомогательная вещь, апдейт из-за неё не теряем
+            print(f"❌ Update recorder error: {e}")
+        return await handler(event, data)
+
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load(path):
+    """Читает лог записи: список dict в порядке поступления."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_update(row, update_id):
+    """Собирает из записи aiogram Update для dp.feed_update."""
+    from aiogram import types
+
+    user = types.User(id=row["u"], is_bot=False, first_name="Replay", username=row.get("n"))
+    chat = types.Chat(id=row["c"], type=row.get("ct", "private"))
+    if row["k"] == "m":
+        return types.Update(update_id=update_id, message=types.Message(
+            message_id=row["m"], date=int(row["t"]), chat=chat, from_user=user, text=row.get("x"),
+        ))
+    return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+        id=str(update_id), from_user=user, chat_instance="replay", data=row.get("d"),
+        message=types.Message(message_id=row["m"], date=int(row["t"]), chat=chat, text="replay"),
+    ))
@@ -0,0 +1,72 @@
+import os
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import DeleteMessage, EditMessageReplyMarkup, EditMessageText, SendMessage
+from aiogram.types import Message
+from cachetools import LRUCache
+
+# --- CONFIGURATION ---
+# Сколько сообщений помним (хватает с запасом на всех активных игроков).
+# 0 — кэш выключен: нужно, если одни и те же сообщения редактируют несколько реплик.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "5000"))
+
+
+def _markup_hash(markup):
+    return hash(markup.model_dump_json()) if markup else 0
+
+
+def _text_hash(text, parse_mode):
+    return hash((text, str(parse_mode)))
+
+
+class RenderCacheMiddleware(BaseRequestMiddleware):
+    """
+    Запоминает, что последним отрисовано в каждом сообщении (chat_id, message_id),
+    и не ходит в Telegram, если новое edit_text ничего не меняет.
+
+    Кэш живёт в памяти процесса и знает только о своих правках. Если сообщение
+    отредактировала другая реплика, здешняя запись устарела, и нужная правка будет
+    ошибочно пропущена — поэтому при нескольких репликах кэш выключают (RENDER_CACHE_SIZE=0).
+    """
+
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        # (chat_id, message_id) -> (хэш текста, хэш клавиатуры)
+        self.cache = LRUCache(maxsize=maxsize)
+        self.skipped = 0
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup)) and method.chat_id and method.message_id:
+            key = (method.chat_id, method.message_id)
+            old_text, old_markup = self.cache.get(key, (None, None))
+
+            if isinstance(method, EditMessageText):
+                new = (_text_hash(method.text, method.parse_mode), _markup_hash(method.reply_markup))
+            else:
+                new = (old_text, _markup_hash(method.reply_markup))
+
+            if new == (old_text, old_markup):
+                self.skipped += 1
+                return True
+
+            try:
+                result = await make_request(bot, method)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in e.message: raise
+                result = True
+            self.cache[key] = new
+            return result
+
+        if isinstance(method, DeleteMessage):
+            self.cache.pop((method.chat_id, method.message_id), None)
+            return await make_request(bot, method)
+
+        result = await make_request(bot, method)
+
+        # Новое сообщение: запоминаем сразу, чтобы первое "пустое" редактирование тоже не ушло
+        if isinstance(method, SendMessage) and isinstance(result, Message):
+            self.cache[(result.chat.id, result.message_id)] = (
+                _text_hash(method.text, method.parse_mode),
+                _markup_hash(method.reply_markup),
+            )
+        return result
@@ -0,0 +1,73 @@
+import time
+from aiogram import BaseMiddleware
+from cachetools import TTLCache
+
+# --- НАСТРОЙКИ ---
+# Токен-бакет: в среднем RATE нажатий в секунду, с запасом до BURST подряд
+RATE = 2.0
+BURST = 5
+# Сколько секунд одинаковое нажатие (тот же юзер, та же кнопка того же вида сообщения) считается дублем
+DEDUP_TTL = 1.0
+# Сколько пользователей помним одновременно
+MAX_USERS = 10000
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для callback_query: гасит спам кнопками до хендлеров,
+    не трогая базу. Лишние нажатия получают только callback.answer().
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, dedup_ttl=DEDUP_TTL):
+        self.rate = rate
+        self.burst = burst
+        # user_id -> [токены, время последнего пополнения]
+        self.buckets = TTLCache(maxsize=MAX_USERS, ttl=burst / rate * 2)
+        # (user_id, callback_data, версия сообщения), обработанные только что
+        self.recent = TTLCache(maxsize=MAX_USERS, ttl=dedup_ttl)
+        # Те же ключи, которые обрабатываются прямо сейчас
+        self.inflight = set()
+
+    def _take_token(self, user_id):
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        # Перезаписываем, чтобы продлить TTL активному пользователю
+        self.buckets[user_id] = bucket
+
+        if bucket[0] < 1: return False
+        bucket[0] -= 1
+        return True
+
+    @staticmethod
+    def _version(message):
+        """
+        Версия сообщения с кнопкой: после перерисовки меняется дата правки или клавиатура.
+        Повторное нажатие переключателя (toggle_day, toggle_lock) приходит уже с новой
+        версией и дублем не считается; двойной тап по одной отрисовке — считается.
+        """
+        if message is None: return None
+        markup = getattr(message, "reply_markup", None)
+        return (message.message_id, getattr(message, "edit_date", None),
+                hash(markup.model_dump_json()) if markup else 0)
+
+    async def __call__(self, handler, event, data):
+        key = (event.from_user.id, event.data, self._version(event.message))
+
+        # Двойной тап по той же кнопке (например, "Выдать") — тихо поглощаем
+        if key in self.inflight or key in self.recent:
+            return await event.answer()
+
+        if not self._take_token(event.from_user.id):
+            return await event.answer("⏳ Слишком часто! Подожди секунду.")
+
+        self.inflight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.inflight.discard(key)
+            self.recent[key] = True
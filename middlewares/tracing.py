@@ -0,0 +1,25 @@
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+import tracing
+from guilds import current_guild
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware на update: корневой спан трейса (см. tracing.py)."""
+
+    async def __call__(self, handler, event, data):
+        if not tracing.enabled():
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        with tracing.trace(event.event_type, update_id=event.update_id, guild=current_guild.get(),
+                           user=user.id if user else None):
+            return await handler(event, data)
+
+
+class TracingApiMiddleware(BaseRequestMiddleware):
+    """Запросы к Bot API — спаны трейса апдейта, из которого они сделаны."""
+
+    async def __call__(self, make_request, bot, method):
+        with tracing.span(type(method).__name__, "api"):
+            return await make_request(bot, method)
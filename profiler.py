@@ -0,0 +1,150 @@
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import zipfile
+from collections import Counter
+from datetime import datetime
+
+from lag_watchdog import describe_task
+
+# --- CONFIGURATION ---
+# Шаг сэмплирования стека (секунды)
+SAMPLE_INTERVAL = 0.01
+# Какая доля апдейтов профилируется в режиме cProfile
+CPROFILE_FRACTION = float(os.getenv("PROFILE_CPROFILE_FRACTION", "0.1"))
+# Окно профилирования не может быть длиннее (секунды)
+MAX_WINDOW = 15 * 60
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+
+# --- STATE ---
+_run = None
+
+
+class ProfileRun:
+    """
+    Одно включение профилировщика на окно времени.
+
+    sample   — отдельный поток раз в SAMPLE_INTERVAL снимает стек цикла событий и
+               подписывает его хендлером (см. lag_watchdog.tag). Результат — collapsed stacks
+               (строка "хендлер;файл:функция;... количество"), их понимают flamegraph.pl и speedscope.
+    cprofile — cProfile на случайной доле апдейтов, по одному за раз, статистика по хендлерам.
+               Пока профилируемый апдейт ждёт await, в профиль попадают и соседние задачи.
+    """
+
+    def __init__(self, mode, seconds):
+        self.mode = mode
+        self.seconds = seconds
+        self.started = datetime.now()
+        self.stacks = Counter()
+        self.stats = {}
+        self.busy = False
+        self.done = threading.Event()
+        self.stopped = asyncio.Event()
+        self.task = None
+
+    # --- SAMPLING ---
+
+    def sample_forever(self, loop, thread_id):
+        while not self.done.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None: continue
+            task = asyncio.current_task(loop)
+            label = describe_task(task) if task else "(idle)"
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join([label, *reversed(stack)])] += 1
+
+    # --- CPROFILE ---
+
+    def wants(self):
+        return self.mode == CPROFILE and not self.busy and random.random() < CPROFILE_FRACTION
+
+    async def profile(self, label, awaitable):
+        prof = cProfile.Profile()
+        self.busy = True
+        prof.enable()
+        try:
+            return await awaitable
+        finally:
+            prof.disable()
+            self.busy = False
+            if label in self.stats: self.stats[label].add(prof)
+            else: self.stats[label] = pstats.Stats(prof)
+
+    # --- RESULT ---
+
+    def report(self):
+        """Возвращает (имя файла, содержимое, краткая сводка по хендлерам)."""
+        stamp = self.started.strftime("%Y-%m-%d_%H-%M")
+        if self.mode == SAMPLE:
+            by_label = Counter()
+            for stack, n in self.stacks.items(): by_label[stack.split(";", 1)[0]] += n
+            total = sum(by_label.values()) or 1
+            summary = "\n".join(f"{n * 100 / total:5.1f}%  {label}" for label, n in by_label.most_common(10))
+            body = "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+            return f"profile_{stamp}.folded", body.encode(), summary or "Нет сэмплов"
+
+        buf = io.BytesIO()
+        lines = []
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for label, stats in sorted(self.stats.items(), key=lambda kv: -kv[1].total_tt):
+                safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)
+                out = io.StringIO()
+                stats.stream = out
+                stats.sort_stats("cumulative").print_stats(30)
+                zf.writestr(f"{safe}.txt", out.getvalue())
+                # Тот же формат, что у Stats.dump_stats: python -m pstats <файл> / snakeviz
+                zf.writestr(f"{safe}.pstats", marshal.dumps(stats.stats))
+                lines.append(f"{stats.total_tt * 1000:8.1f} ms  {label}")
+        summary = "\n".join(lines[:10]) or "Ни один апдейт не попал в выборку"
+        return f"profile_{stamp}.zip", buf.getvalue(), summary
+
+
+# --- УПРАВЛЕНИЕ ---
+
+def current():
+    return _run
+
+
+def start(mode, seconds, on_done):
+    """
+    Включает профилирование на seconds секунд (из работающего цикла).
+    По окончании вызывает await on_done(имя файла, содержимое, сводка).
+    """
+    global _run
+    if _run: raise RuntimeError("Profiler is already running")
+    run = _run = ProfileRun(mode, min(seconds, MAX_WINDOW))
+
+    if mode == SAMPLE:
+        loop = asyncio.get_running_loop()
+        threading.Thread(
+            target=run.sample_forever, args=(loop, threading.get_ident()), name="profiler", daemon=True
+        ).start()
+
+    async def finish():
+        global _run
+        try: await asyncio.wait_for(run.stopped.wait(), run.seconds)
+        except asyncio.TimeoutError: pass
+        run.done.set()
+        _run = None
+        try: await on_done(*run.report())
+        except Exception as e: print(f"❌ Profiler report failed: {e}")
+
+    run.task = asyncio.create_task(finish())
+    return run
+
+
+def stop():
+    """Досрочно завершает окно — отчёт всё равно будет отправлен."""
+    if _run: _run.stopped.set()
@@ -0,0 +1,188 @@
+"""
+Ночная сверка вкладок очередей в Google Sheets с базой.
+
+Вкладка — журнал: каждая строка (дата, очередь, основа, персонаж, статус) дописывается
+по событию. Если запись в таблицу не удалась, журнал расходится с очередью в базе.
+Сверка читает вкладки активных очередей гильдии одним batch_get (вкладки, которых нет
+в таблице, пропускаются с предупреждением), по последнему статусу каждого
+персонажа восстанавливает "очередь по таблице", сравнивает с базой и дописывает
+недостающие строки — по одному запросу на вкладку. Итог — в лог и мастерам в личку.
+
+Здесь же — частая задача, дописывающая outbox (строки, отложенные, пока Google был недоступен).
+Обе ставит планировщик (только у лидера), а выполняет воркер (см. jobs.py). Ключ задачи
+не даёт двум дозаписям одной гильдии идти одновременно и писать одно и то же дважды.
+"""
+import os
+from datetime import datetime
+
+from database import session, User, Character, QueueEntry, QueueType
+from guilds import GUILDS, get_guild
+from loader import bot, scheduler
+from metrics import Counter, track_sheets
+from tracing import span
+import jobs
+import utils
+from breaker import CircuitOpen
+
+# --- CONFIGURATION ---
+# Когда сверять (МСК, тихие часы). Пусто — сверка выключена.
+RECONCILE_AT = os.getenv("RECONCILE_AT", "05:30")
+# Как часто дописывать outbox, секунд
+OUTBOX_INTERVAL = int(os.getenv("OUTBOX_INTERVAL", "60"))
+
+# Строки журнала начинаются с 8-й (как пишет utils.log_rewards_to_sheet)
+FIRST_ROW = 8
+JOINED = "🔁 Сверка: в очереди"
+LEFT = "🔁 Сверка: нет в очереди"
+
+sheet_drift = Counter("bot_sheet_drift_total", "Sheet rows added by reconciliation", ("guild", "kind"))
+
+
+def _in_queue(status):
+    """Последний статус означает, что персонаж стоит в очереди."""
+    return status in ("В очереди", "👑 Мастер добавил", JOINED) or status.startswith(("🔄", "♻️"))
+
+
+def sheet_queues(rows):
+    """
+    Очередь по журналу вкладки: {(очередь, персонаж): основа} для тех, чей последний статус — "в очереди".
+    Замена ("🔄 Замена (старый)") заодно выводит из очереди старого персонажа.
+    """
+    active = {}
+    for row in rows:
+        if len(row) < 5 or not row[1] or not row[3]: continue
+        _, queue_name, main_nick, char_nick, status = (str(v).strip() for v in row[:5])
+        if status.startswith(("🔄", "♻️")) and "(" in status:
+            active.pop((queue_name, status[status.rfind("(") + 1:].rstrip(")")), None)
+        if _in_queue(status): active[(queue_name, char_nick)] = main_nick
+        else: active.pop((queue_name, char_nick), None)
+    return active
+
+
+def db_queues():
+    """Очередь по базе: {(очередь, персонаж): основа}."""
+    rows = (session.query(QueueType.name, QueueEntry.character_name, Character.nickname)
+            .join(QueueEntry.queue)
+            .outerjoin(Character, (Character.user_id == QueueEntry.user_id) & (Character.is_main == True))
+            .all())
+    return {(q_name, char_nick): main_nick or char_nick for q_name, char_nick, main_nick in rows}
+
+
+def diff(tabs, in_db, by_tab):
+    """Строки, которые надо дописать: {вкладка: [строки]}, плюс сколько пропущено и сколько лишних."""
+    now = datetime.now().strftime("%d.%m.%Y %H:%M")
+    writes, missing, stale = {}, 0, 0
+    for tab, queue_names in tabs.items():
+        in_sheet = sheet_queues(by_tab.get(tab, []))
+        rows = []
+        for key, main_nick in in_db.items():
+            if key[0] in queue_names and key not in in_sheet:
+                rows.append([now, key[0], main_nick, key[1], JOINED])
+                missing += 1
+        for key, main_nick in in_sheet.items():
+            if key[0] in queue_names and key not in in_db:
+                rows.append([now, key[0], main_nick, key[1], LEFT])
+                stale += 1
+        if rows: writes[tab] = rows
+    return writes, missing, stale
+
+
+def _range(tab, cells):
+    return "'{}'!{}".format(tab.replace("'", "''"), cells)
+
+
+def _read_tabs(url, tabs):
+    """
+    Блокирующее чтение вкладок одним запросом (в потоке). Одна отсутствующая вкладка
+    роняет весь batch_get ("Unable to parse range"), поэтому сначала сверяем названия листов.
+    Возвращает (таблица, {вкладка: строки}, [вкладки, которых нет]).
+    """
+    sh = utils._sheets_client().open_by_url(url)
+    titles = {ws.title for ws in sh.worksheets()}
+    found = [tab for tab in tabs if tab in titles]
+    missing = [tab for tab in tabs if tab not in titles]
+    if not found: return sh, {}, missing
+    result = sh.values_batch_get([_range(tab, f"A{FIRST_ROW}:E") for tab in found])
+    return sh, {tab: vr.get("values", []) for tab, vr in zip(found, result.get("valueRanges", []))}, missing
+
+
+def _write_tabs(sh, writes):
+    """Блокирующая запись: одно добавление строк на вкладку (в потоке)."""
+    for tab, rows in writes.items():
+        sh.values_append(_range(tab, f"A{FIRST_ROW}"), {"valueInputOption": "RAW"}, {"values": rows})
+
+
+async def reconcile():
+    """Сверяет вкладки текущей гильдии с базой и дописывает расхождения. Возвращает (пропущено, лишних)."""
+    guild = get_guild()
+    if not guild.spreadsheet_url: return 0, 0
+
+    # Вкладка -> активные очереди каталога, которые в неё пишутся (вкладка может быть общей)
+    tabs = {}
+    for (q_name,) in session.query(QueueType.name).filter(QueueType.is_active == True):
+        if q_name in guild.queues: tabs.setdefault(guild.queues[q_name], set()).add(q_name)
+    if not tabs: return 0, 0
+
+    # Строки, ещё ждущие записи или outbox, иначе посчитаются расхождением
+    if await jobs.waiting("sheet_rows", guild.id) or await utils.flush_outbox():
+        raise CircuitOpen("log rows are still waiting to be written")
+
+    with track_sheets("reconcile_read"), span("reconcile_read", "sheets", tabs=len(tabs)):
+        sh, by_tab, absent = await utils.sheets_breaker().call(_read_tabs, guild.spreadsheet_url, list(tabs))
+    for tab in absent:
+        print(f"⚠️ Sheet reconcile '{guild.id}': tab '{tab}' not found, skipped")
+        del tabs[tab]
+    writes, missing, stale = diff(tabs, db_queues(), by_tab)
+    if writes:
+        with track_sheets("reconcile_write"), span("reconcile_write", "sheets", tabs=len(writes)):
+            await utils.sheets_breaker().call(_write_tabs, sh, writes)
+    sheet_drift.inc(guild.id, "missing", value=missing)
+    sheet_drift.inc(guild.id, "stale", value=stale)
+    return missing, stale
+
+
+# Задачи лежат в базе планировщика (pickle), поэтому в аргументах только id гильдии
+async def run_reconcile(guild_id):
+    await jobs.enqueue("reconcile", guild_id=guild_id, key=f"reconcile:{guild_id}")
+
+
+async def run_outbox(guild_id):
+    await jobs.enqueue("outbox", guild_id=guild_id, key=f"outbox:{guild_id}")
+
+
+@jobs.handler("reconcile")
+async def _reconcile_job():
+    guild_id = get_guild().id
+    try:
+        missing, stale = await reconcile()
+    except CircuitOpen as e:
+        print(f"⏸ Sheet reconcile skipped for guild '{guild_id}': {e}")
+        return
+    except Exception as e:
+        print(f"❌ Sheet reconcile failed for guild '{guild_id}': {type(e).__name__}: {e}")
+        return
+    print(f"🔁 Sheet reconcile '{guild_id}': added {missing} missing, closed {stale} stale")
+    if not missing and not stale: return
+
+    text = (f"🔁 <b>Сверка с таблицей</b>\n\nДописано строк: {missing + stale}\n"
+            f"• были в очереди, но не в таблице: {missing}\n• были в таблице, но не в очереди: {stale}")
+    for (tid,) in session.query(User.telegram_id).filter_by(is_master=True):
+        try: await bot.send_message(tid, text, parse_mode="HTML")
+        except Exception: pass
+
+
+@jobs.handler("outbox")
+async def _outbox_job():
+    if get_guild().spreadsheet_url: await utils.flush_outbox()
+
+
+def schedule_jobs():
+    """Ставит для каждой гильдии дозапись outbox и (или убирает) ежедневную сверку."""
+    for gid in GUILDS:
+        scheduler.add_job(run_outbox, "interval", seconds=OUTBOX_INTERVAL, id=f"outbox_{gid}", replace_existing=True, args=[gid])
+        job_id = f"reconcile_{gid}"
+        if not RECONCILE_AT:
+            if scheduler.get_job(job_id): scheduler.remove_job(job_id)
+            continue
+        h, m = map(int, RECONCILE_AT.split(":"))
+        scheduler.add_job(run_reconcile, "cron", hour=h, minute=m, id=job_id, replace_existing=True, args=[gid])
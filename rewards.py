@@ -0,0 +1,45 @@
+"""
+Планировщик раздачи: кому из очереди выдать N наград, чтобы было честно.
+
+Первыми идут те, кто дольше всех не получал награду этой очереди (никогда — раньше всех),
+при равенстве — кто дольше стоит в очереди. Последние награды берутся одним запросом
+по индексу истории (очередь, игрок, время), N лучших — через кучу, без сортировки всей очереди.
+"""
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import func
+
+from database import session, QueueEntry, RewardHistory
+
+# Для сравнения "никогда не получал" — раньше любой настоящей награды
+NEVER = datetime.min
+
+
+@dataclass(frozen=True, slots=True)
+class PlanRow:
+    entry_id: int
+    user_id: int
+    character_name: str
+    last_reward: datetime  # None — ещё не получал
+    joined_at: datetime
+
+
+def last_rewards(queue_name, user_ids):
+    """{user_id: время последней награды в этой очереди} одним запросом по индексу."""
+    if not user_ids: return {}
+    rows = (session.query(RewardHistory.user_id, func.max(RewardHistory.timestamp))
+            .filter(RewardHistory.queue_name == queue_name, RewardHistory.user_id.in_(user_ids))
+            .group_by(RewardHistory.user_id).all())
+    return dict(rows)
+
+
+def plan(qid, queue_name, count):
+    """Кому выдать count наград в очереди, в порядке выдачи: [PlanRow]."""
+    entries = (session.query(QueueEntry.id, QueueEntry.user_id, QueueEntry.character_name, QueueEntry.created_at)
+               .filter(QueueEntry.queue_type_id == qid).all())
+    last = last_rewards(queue_name, {e.user_id for e in entries})
+    rows = [PlanRow(e.id, e.user_id, e.character_name, last.get(e.user_id), e.created_at) for e in entries]
+    # id записи — последний довод: кто записался раньше, тот и впереди
+    return heapq.nsmallest(count, rows, key=lambda r: (r.last_reward or NEVER, r.joined_at or NEVER, r.entry_id))
@@ -0,0 +1,115 @@
+"""
+Холодный старт: замер фаз запуска и прогрев кэшей до того, как бот начнёт принимать апдейты.
+
+Импортировать первым в main.py — от момента импорта считается фаза "imports".
+"""
+import time
+
+_started = time.perf_counter()
+
+import asyncio
+import os
+from contextlib import contextmanager
+
+import metrics
+
+# --- CONFIGURATION ---
+# Сколько ждём прогрева (ростер из Google может тормозить). Не успели — стартуем холодными.
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "30"))
+
+# фаза -> секунды, в порядке выполнения. Подфазы — "родитель:имя" (идут параллельно внутри родителя)
+phases = {}
+
+metrics.Gauge("bot_startup_phase_seconds", "Startup phase duration", lambda: phases, label="phase")
+
+
+@contextmanager
+def phase(name):
+    """with phase("init_db"): ... — время блока попадёт в отчёт о запуске."""
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - t
+
+
+def mark(name):
+    """Фаза от запуска процесса (или конца предыдущей фазы) до текущего момента."""
+    phases[name] = time.perf_counter() - _started - sum(v for k, v in phases.items() if ":" not in k)
+
+
+def report():
+    total = time.perf_counter() - _started
+    print(f"⏱ Startup: {total:.2f} s")
+    for name, sec in phases.items():
+        if ":" in name: continue
+        print(f"   {name:<20} {sec * 1000:8.0f} ms  {sec / total * 100:4.0f}%")
+        for sub, sub_sec in phases.items():
+            if sub.startswith(name + ":"): print(f"     {sub.split(':', 1)[1]:<18} {sub_sec * 1000:8.0f} ms")
+
+
+# --- ПРОГРЕВ ---
+
+async def _warm_roster():
+    """Ростеры всех гильдий из Google — параллельно, запросы идут в потоках."""
+    from guilds import GUILDS, current_guild
+    import utils
+
+    async def one(gid):
+        current_guild.set(gid)  # у каждой задачи своя копия контекста
+        await utils.update_cache()
+
+    gids = [gid for gid, g in GUILDS.items() if g.spreadsheet_url]
+    await asyncio.gather(*(one(gid) for gid in gids))
+    return f"{len(gids)} roster(s)"
+
+
+async def _warm_catalogue():
+    """Каталог очередей и счётчики записей: первые запросы к каждой базе, статичные клавиатуры."""
+    from guilds import GUILDS, current_guild
+    from database import get_queues_with_entries, get_queue_counts
+    import keyboards
+
+    for gid in GUILDS:
+        token = current_guild.set(gid)
+        try:
+            get_queues_with_entries()
+            get_queue_counts()
+        finally:
+            current_guild.reset(token)
+    keyboards.get_master_menu()
+    keyboards._build_main_menu(False)
+    keyboards._build_main_menu(True)
+    return f"{len(GUILDS)} catalogue(s)"
+
+
+async def _warm_users(storage):
+    """Привязки игроков к гильдиям и живые FSM-состояния — в память одним запросом каждое."""
+    from guilds import preload_bindings
+
+    bindings = preload_bindings()
+    states = await storage.preload()
+    return f"{bindings} binding(s), {states} FSM state(s)"
+
+
+async def warm_up(storage):
+    """Прогревает кэши параллельно. Ошибка или таймаут не мешают запуску — просто первые игроки заплатят сами."""
+    jobs = {"roster": _warm_roster(), "catalogue": _warm_catalogue(), "users": _warm_users(storage)}
+
+    async def timed(name, coro):
+        with phase(f"warm_up:{name}"):
+            return await coro
+
+    phases.setdefault("warm_up", 0.0)
+    with phase("warm_up"):
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(timed(n, c) for n, c in jobs.items()), return_exceptions=True),
+                WARMUP_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            print(f"⚠️ Warm-up did not finish in {WARMUP_TIMEOUT:.0f} s, starting cold")
+            return
+    for name, result in zip(jobs, results):
+        if isinstance(result, Exception): print(f"❌ Warm-up {name} failed: {result}")
+        else: print(f"🔥 Warm-up {name}: {result}")
@@ -0,0 +1,92 @@
+"""
+Микро-бенчмарк роутинга inline-кнопок:
+старая цепочка F.data.startswith(...) против таблицы действий из callbacks.py.
+
+Запуск из корня проекта:
+    python -m tools.bench_callbacks
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+from aiogram import Bot, Dispatcher, F, Router, types
+
+from callbacks import CallbackDispatcher, pack
+
+# Префиксы в том порядке, в каком их проверял aiogram до перехода на таблицу
+LEGACY_PREFIXES = [
+    "back_to_main", "menu_chars", "add_main", "confirm_main_change", "add_alt", "del_alt_menu",
+    "del_c_", "conf_del_", "menu_join", "view_q_", "pre_join_", "do_join_", "leave_q_",
+    "my_active_queues", "swap_start_", "do_swap_", "menu_history", "menu_info",
+    "menu_master", "m_users_list", "m_u_manage_", "m_ban_toggle_", "m_del_char_", "m_add_admin_start",
+    "m_distribute", "dist_", "issue_", "m_limits_menu", "m_list_limits", "m_set_global", "m_set_personal",
+    "m_lock_menu", "toggle_lock_", "m_edit_desc", "edit_d_", "m_force_add", "f_add_", "m_force_del",
+    "sel_del_", "kill_", "m_global_log", "m_announce", "ann_", "toggle_day_", "days_confirm",
+    "m_schedule", "del_sch_", "m_backup",
+]
+
+# Типичный микс нажатий: в основном просмотр очередей и запись
+LEGACY_SAMPLE = ["view_q_3", "do_join_3_17", "menu_join", "leave_q_3", "issue_42", "back_to_main", "del_sch_5"]
+PACKED_SAMPLE = [pack("view_q", 3), pack("do_join", 3, 17), "menu_join", pack("leave_q", 3),
+                 pack("issue", 42), "back_to_main", pack("del_sch", 5)]
+
+ROUNDS = 20000
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def build_legacy():
+    router = Router()
+    for prefix in LEGACY_PREFIXES:
+        flt = F.data.startswith(prefix) if prefix.endswith("_") or prefix == "m_users_list" else F.data == prefix
+        router.callback_query.register(noop, flt)
+    return router
+
+
+def build_table():
+    cb = CallbackDispatcher()
+    arity = {"view_q": 1, "do_join": 2, "leave_q": 1, "issue": 1, "del_sch": 1}
+    for prefix in LEGACY_PREFIXES:
+        code = prefix.rstrip("_")
+        cb.action(code, *[int] * arity.get(code, 0))(noop)
+    async def dispatch(callback, state):
+        return await cb.dispatch(callback, state)
+
+    router = Router()
+    router.callback_query.register(dispatch)
+    return router
+
+
+def make_update(i, data):
+    user = types.User(id=1, is_bot=False, first_name="bench")
+    return types.Update(update_id=i, callback_query=types.CallbackQuery(
+        id=str(i), from_user=user, chat_instance="bench", data=data,
+    ))
+
+
+async def run(name, router, sample):
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot(token=os.environ["BOT_TOKEN"])
+    updates = [make_update(i, sample[i % len(sample)]) for i in range(ROUNDS)]
+
+    started = time.perf_counter()
+    for upd in updates:
+        await dp.feed_update(bot, upd)
+    took = time.perf_counter() - started
+
+    print(f"{name:<22} {ROUNDS / took:>10.0f} upd/s   {took / ROUNDS * 1e6:>7.1f} µs/upd")
+    await bot.session.close()
+
+
+async def main():
+    await run("F.data.startswith", build_legacy(), LEGACY_SAMPLE)
+    await run("dispatch table", build_table(), PACKED_SAMPLE)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,247 @@
+"""
+Общие заготовки для скриптов в tools/: бот в памяти без Telegram и Google.
+
+Импортировать ДО модулей проекта — prepare() выставляет переменные окружения,
+которые читаются при импорте loader/guilds.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+# Счётчики id для апдейтов и сообщений
+_ids = itertools.count(1)
+
+
+def prepare(db_path=":memory:"):
+    """Настраивает окружение: базы в памяти (или в db_path), без Google Sheets, webhook и метрик."""
+    os.environ.setdefault("BOT_TOKEN", "123456:harness")
+    os.environ["BOT_MODE"] = "polling"
+    os.environ["FSM_DB_PATH"] = ":memory:"
+    os.environ["ROUTER_DB_PATH"] = ":memory:"
+    # Очередь задач открывается из нескольких потоков — ей нужен файл, а не ":memory:"
+    os.environ["JOBS_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="harness-jobs-"), "jobs.db")
+    os.environ["SCHEDULER_DB_URL"] = "sqlite://"
+    os.environ["GUILDS_FILE"] = os.path.join(tempfile.gettempdir(), "harness-no-guilds.json")
+    os.environ.pop("BOARD_CHAT_ID", None)
+    os.environ.pop("METRICS_PORT", None)
+    os.environ.pop("API_PORT", None)
+    # Трейсы пишем, только если их попросили явно (TRACE_LOG=...)
+    os.environ.setdefault("TRACE_LOG", "")
+
+    import guilds
+    guilds.GUILDS[guilds.DEFAULT_GUILD].db_path = db_path
+
+
+def build_dispatcher():
+    """dp проекта с подключёнными роутерами, без антиспама (скрипты жмут кнопки быстрее людей)."""
+    from loader import bot, dp
+    from handlers import user, admin
+    import callbacks
+
+    if not dp.sub_routers:
+        dp.include_router(user.router)
+        dp.include_router(admin.router)
+        dp.include_router(callbacks.router)
+    for m in dp.callback_query.outer_middleware:
+        if hasattr(m, "rate"): m.rate = m.burst = 10 ** 9
+        if hasattr(m, "recent"): m.recent = {}
+    return bot, dp
+
+
+def fake_sheets(roster=None, delay=0.0, blocking=False):
+    """
+    Подменяет Google Sheets: ростер — список ников (None — любой ник валиден),
+    строки лога (очередь, основа, персонаж, статус) складываются в возвращаемый список.
+    delay — задержка "ответа Google" на каждый вызов; blocking=True держит при этом
+    весь цикл событий, как синхронный gspread.
+    """
+    import utils
+    import handlers.user
+    import handlers.admin
+
+    written = []
+
+    async def wait():
+        if not delay: return
+        if blocking: time.sleep(delay)
+        else: await asyncio.sleep(delay)
+
+    async def check_google_sheet(nickname):
+        await wait()
+        return roster is None or nickname.strip().lower() in {n.lower() for n in roster}
+
+    async def log_rewards_to_sheet(rows, at=None):
+        # Одна пачка — один "ответ Google", как у настоящей записи
+        await wait()
+        written.extend(rows)
+        return True
+
+    for module in (utils, handlers.user, handlers.admin):
+        if hasattr(module, "check_google_sheet"): module.check_google_sheet = check_google_sheet
+    utils.log_rewards_to_sheet = log_rewards_to_sheet
+    return written
+
+
+class FakeTelegram:
+    """
+    Request-middleware вместо сети: на send_message отвечает готовым Message, на остальное — True.
+    Все вызовы складываются в self.calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, make_request, bot, method):
+        from aiogram.methods import SendMessage, SendDocument
+        from aiogram.types import Chat, Message
+
+        self.calls.append(method)
+        if isinstance(method, (SendMessage, SendDocument)):
+            return Message(
+                message_id=next(_ids), date=0, chat=Chat(id=method.chat_id, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+
+def install_fake_telegram(bot):
+    fake = FakeTelegram()
+    bot.session.middleware(fake)
+    return fake
+
+
+class FakeBotAPI:
+    """
+    Локальный HTTP-сервер вместо api.telegram.org: отвечает в формате Bot API
+    и запоминает последнюю inline-клавиатуру в каждом чате — виртуальные
+    игроки "видят" кнопки и жмут их, как настоящий клиент.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        # chat_id -> последняя присланная клавиатура
+        self.markups = {}
+        self.url = None
+        self._runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency: await asyncio.sleep(self.latency)
+
+        chat_id = data.get("chat_id")
+        if chat_id and "reply_markup" in data:
+            self.markups[int(chat_id)] = json.loads(data["reply_markup"])
+
+        result = True
+        if method.lower() in ("sendmessage", "senddocument"):
+            result = {
+                "message_id": next(_ids), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, "text": data.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    def buttons(self, chat_id, prefix=""):
+        """callback_data кнопок из последней клавиатуры чата, начинающиеся с prefix."""
+        rows = self.markups.get(chat_id, {}).get("inline_keyboard", [])
+        return [b["callback_data"] for row in rows for b in row
+                if b.get("callback_data", "").startswith(prefix)]
+
+    async def start(self, host="127.0.0.1", port=0):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    def point(self, bot):
+        """Направляет запросы бота на этот сервер."""
+        from aiogram.client.telegram import TelegramAPIServer
+        bot.session.api = TelegramAPIServer.from_base(self.url)
+
+    async def stop(self):
+        if self._runner: await self._runner.cleanup()
+
+
+def percentile(values, p):
+    """p-й перцентиль (nearest rank)."""
+    if not values: return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+# --- АПДЕЙТЫ ---
+
+def _user(telegram_id):
+    from aiogram import types
+    return types.User(id=telegram_id, is_bot=False, first_name=f"u{telegram_id}", username=f"user{telegram_id}")
+
+
+def message(telegram_id, text):
+    from aiogram import types
+    n = next(_ids)
+    chat = types.Chat(id=telegram_id, type="private")
+    return types.Update(update_id=n, message=types.Message(
+        message_id=n, date=0, chat=chat, from_user=_user(telegram_id), text=text,
+    ))
+
+
+def callback(telegram_id, data):
+    from aiogram import types
+    n = next(_ids)
+    chat = types.Chat(id=telegram_id, type="private")
+    return types.Update(update_id=n, callback_query=types.CallbackQuery(
+        id=str(n), from_user=_user(telegram_id), chat_instance="harness", data=data,
+        message=types.Message(message_id=n, date=0, chat=chat, text="menu"),
+    ))
+
+
+# --- ДАННЫЕ ---
+
+def seed(n_users, entries_per_user=2, history_per_user=5, seed_value=42):
+    """
+    Наполняет базу текущей гильдии: n_users игроков с основой и двумя твинами,
+    записи в очередях и история наград. Первый игрок (telegram_id=1) — мастер.
+    """
+    from database import session, User, Character, QueueType, QueueEntry, RewardHistory
+
+    rnd = random.Random(seed_value)
+    queue_ids = [q.id for q in session.query(QueueType).order_by(QueueType.id)]
+
+    users = [
+        User(telegram_id=i + 1, username=f"user{i + 1}", is_master=(i == 0),
+             personal_limit=3 if i % 5 == 0 else None)
+        for i in range(n_users)
+    ]
+    session.add_all(users)
+    session.flush()
+
+    objects = []
+    for u in users:
+        nicks = [f"Main{u.id}", f"AltA{u.id}", f"AltB{u.id}"]
+        objects += [Character(user_id=u.id, nickname=n, is_main=(j == 0)) for j, n in enumerate(nicks)]
+        for qid in rnd.sample(queue_ids, entries_per_user):
+            objects.append(QueueEntry(user_id=u.id, queue_type_id=qid, character_name=rnd.choice(nicks)))
+        objects += [
+            RewardHistory(user_id=u.id, character_name=nicks[0], queue_name="Метеориты", issued_by="user1")
+            for _ in range(history_per_user)
+        ]
+    session.add_all(objects)
+    session.commit()
+    return users
@@ -0,0 +1,276 @@
+"""
+Нагрузочный тест: N виртуальных игроков жмут кнопки по сценариям через webhook,
+бот ходит в локальный фейковый Bot API, Google Sheets заменён заглушкой.
+
+Для каждого числа игроков печатает пропускную способность, p50/p95/p99 по сценариям
+и оценку точки насыщения. Результат можно сохранить и сравнить с прошлым коммитом.
+
+Запуск из корня проекта:
+    python -m tools.loadtest                                  # 10,25,50,100,200 игроков
+    python -m tools.loadtest --users 50,100 --rounds 5
+    python -m tools.loadtest --out before.json
+    python -m tools.loadtest --compare before.json            # после изменений
+    python -m tools.loadtest --sheets-delay 0.3 --sheets-blocking   # как живой gspread
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from tools import harness
+from tools.harness import percentile
+
+_tmp = tempfile.mkdtemp(prefix="loadtest-")
+harness.prepare(os.path.join(_tmp, "guild_0.db"))
+
+import aiohttp
+from aiohttp import web
+
+import database
+import guilds
+import webhook
+from database import init_db
+
+# Сколько раз и с какой паузой повторяем апдейт, на который webhook ответил 503 (Telegram делает так же)
+RETRIES = 20
+RETRY_DELAY = 0.1
+
+
+class Stats:
+    def __init__(self):
+        # сценарий -> задержки шагов (секунды)
+        self.latencies = defaultdict(list)
+        self.updates = 0
+        self.rejected = 0
+        self.failed = 0
+
+
+class VirtualUser:
+    """Игрок: отправляет апдейты в webhook и выбирает кнопки из того, что ему прислал бот."""
+
+    def __init__(self, tid, http, url, api, stats, think, rnd):
+        self.tid, self.http, self.url, self.api, self.stats = tid, http, url, api, stats
+        self.think, self.rnd = think, rnd
+
+    async def send(self, flow, update):
+        body = update.model_dump_json(exclude_none=True)
+        started = time.perf_counter()
+        for _ in range(RETRIES):
+            async with self.http.post(self.url, data=body, headers={"Content-Type": "application/json"}) as resp:
+                if resp.status != 503: break
+            self.stats.rejected += 1
+            await asyncio.sleep(RETRY_DELAY)
+        else:
+            self.stats.failed += 1
+        self.stats.latencies[flow].append(time.perf_counter() - started)
+        self.stats.updates += 1
+        if self.think: await asyncio.sleep(self.rnd.uniform(0, self.think))
+
+    async def click(self, flow, data):
+        await self.send(flow, harness.callback(self.tid, data))
+
+    async def say(self, flow, text):
+        await self.send(flow, harness.message(self.tid, text))
+
+    async def pick(self, flow, prefix):
+        """Жмёт случайную кнопку с таким префиксом. False — такой кнопки нет."""
+        options = self.api.buttons(self.tid, prefix)
+        if not options: return False
+        await self.click(flow, self.rnd.choice(options))
+        return True
+
+    # --- СЦЕНАРИИ ---
+
+    async def onboarding(self):
+        await self.say("onboarding", "/start")
+        await self.click("onboarding", "menu_chars")
+        await self.click("onboarding", "add_main")
+        await self.say("onboarding", f"Main{self.tid}")
+        await self.click("onboarding", "add_alt")
+        await self.say("onboarding", f"Alt{self.tid}")
+
+    async def browse(self):
+        await self.click("browse", "back_to_main")
+        await self.click("browse", "menu_info")
+        await self.click("browse", "menu_history")
+
+    async def join(self):
+        await self.click("join", "menu_join")
+        if not await self.pick("join", "view_q"): return
+        if not await self.pick("join", "pre_join"): return
+        await self.pick("join", "do_join")
+
+    async def swap(self):
+        await self.click("swap", "my_active_queues")
+        if await self.pick("swap", "swap_start"):
+            await self.pick("swap", "do_swap")
+
+    async def leave(self):
+        await self.click("leave", "my_active_queues")
+        await self.pick("leave", "leave_q")
+
+    async def master_issue(self):
+        await self.click("master_issue", "menu_master")
+        await self.click("master_issue", "m_distribute")
+        if await self.pick("master_issue", "dist"):
+            await self.pick("master_issue", "issue")
+
+    async def run(self, rounds, is_master):
+        await self.onboarding()
+        for _ in range(rounds):
+            if is_master:
+                await self.master_issue()
+                await self.browse()
+            else:
+                await self.join()
+                await self.swap()
+                await self.browse()
+                if self.rnd.random() < 0.3: await self.leave()
+
+
+async def run_level(n_users, args, api, url):
+    """Свежая база, n_users игроков (каждый двадцатый — мастер) проходят сценарии одновременно."""
+    database.close_sessions()
+    guilds.GUILDS[guilds.DEFAULT_GUILD].db_path = os.path.join(_tmp, f"guild_{n_users}.db")
+    init_db()
+    api.markups.clear()
+
+    stats = Stats()
+    rnd = random.Random(args.seed)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        users = [VirtualUser(tid, http, url, api, stats, args.think, random.Random(rnd.random()))
+                 for tid in range(1, n_users + 1)]
+        # Первый зарегистрированный становится мастером
+        await users[0].say("onboarding", "/start")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(u.run(args.rounds, is_master=(u.tid % 20 == 1)) for u in users))
+        wall = time.perf_counter() - started
+
+    all_latencies = [v for values in stats.latencies.values() for v in values]
+    return {
+        "users": n_users,
+        "updates": stats.updates,
+        "seconds": round(wall, 3),
+        "throughput": round(stats.updates / wall, 1),
+        "rejected_503": stats.rejected,
+        "failed": stats.failed,
+        "p95_ms": round(percentile(all_latencies, 95) * 1000, 1),
+        "flows": {
+            flow: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+            }
+            for flow, values in sorted(stats.latencies.items())
+        },
+    }
+
+
+def saturation(levels, slo_ms):
+    """Первый уровень, где пропускная способность перестала расти (+<10%) или p95 вышел за SLO."""
+    prev = None
+    for level in levels:
+        if level["p95_ms"] > slo_ms: return level["users"], f"p95 {level['p95_ms']} ms > SLO {slo_ms} ms"
+        if prev and level["throughput"] < prev["throughput"] * 1.1:
+            return level["users"], f"throughput flat ({prev['throughput']} -> {level['throughput']} upd/s)"
+        prev = level
+    return None, "not reached"
+
+
+def print_level(level, baseline=None):
+    def delta(new, old, lower_is_better=True):
+        if old is None or not old: return ""
+        change = (new - old) / old * 100
+        good = change < 0 if lower_is_better else change > 0
+        return f" ({'+' if change >= 0 else ''}{change:.0f}%{' ✓' if good else ''})"
+
+    base_flows = baseline["flows"] if baseline else {}
+    print(f"\n👥 {level['users']} users: {level['updates']} updates in {level['seconds']} s, "
+          f"{level['throughput']} upd/s{delta(level['throughput'], baseline and baseline['throughput'], False)}, "
+          f"503: {level['rejected_503']}, failed: {level['failed']}")
+    print(f"   {'flow':<14} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for flow, f in level["flows"].items():
+        old = base_flows.get(flow, {})
+        print(f"   {flow:<14} {f['count']:>6} {f['p50_ms']:>9} {f['p95_ms']:>9} {f['p99_ms']:>9}"
+              f"{delta(f['p95_ms'], old.get('p95_ms'))}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="10,25,50,100,200", help="уровни нагрузки через запятую")
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз каждый игрок проходит сценарий")
+    parser.add_argument("--think", type=float, default=0.05, help="пауза игрока между нажатиями, до N секунд")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="задержка фейкового Bot API, секунды")
+    parser.add_argument("--sheets-delay", type=float, default=0.0, help="задержка фейковых Google Sheets, секунды")
+    parser.add_argument("--sheets-blocking", action="store_true", help="Sheets блокируют цикл, как синхронный gspread")
+    parser.add_argument("--slo", type=float, default=500, help="допустимый p95 шага, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    bot, dp = harness.build_dispatcher()
+    harness.fake_sheets(delay=args.sheets_delay, blocking=args.sheets_blocking)
+    api = await harness.FakeBotAPI(latency=args.api_latency).start()
+    api.point(bot)
+
+    runner = web.AppRunner(webhook.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{webhook.WEBHOOK_PATH}"
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        baseline = {level["users"]: level for level in old["levels"]}
+        print(f"Comparing with {args.compare} (commit {old.get('commit')})")
+
+    levels = []
+    try:
+        for n in map(int, args.users.split(",")):
+            level = await run_level(n, args, api, url)
+            levels.append(level)
+            print_level(level, baseline.get(n))
+    finally:
+        await runner.cleanup()
+        await api.stop()
+        await dp.storage.close()
+        await bot.session.close()
+
+    users, reason = saturation(levels, args.slo)
+    print(f"\n📈 Saturation: {f'~{users} users' if users else 'not reached'} ({reason})")
+    print(f"   Bot API calls: {dict(api.calls.most_common())}")
+
+    if args.out:
+        result = {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            "saturation": {"users": users, "reason": reason},
+            "levels": levels,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"💾 Saved to {args.out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+"""
+Память за "неделю" трафика: RSS процесса и пиковый размер identity map сессии по дням.
+
+Игроки каждый день открывают меню, смотрят очереди, записываются, меняются и выходят,
+мастер раздаёт награды (история растёт). Апдейты идут через dp.feed_update на базе
+во временном файле, Telegram и Google Sheets — заглушки. Падает (код 1), если RSS
+после прогрева растёт дальше допуска.
+
+Запуск из корня проекта:
+    python -m tools.membench
+    python -m tools.membench --players 500 --days 7 --updates-per-day 20
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from tools import harness
+
+_tmp = tempfile.mkdtemp(prefix="membench-")
+harness.prepare(os.path.join(_tmp, "guild_bot.db"))
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import database
+from database import session, init_db, Character, QueueEntry, QueueType
+
+
+def rss_mb():
+    """Текущий RSS процесса (Linux: /proc; иначе — пиковый из getrusage)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class IdentityMapPeak:
+    """
+    Пиковый размер identity map за день. Меряем в момент загрузки объекта, то есть внутри
+    хендлера: между апдейтами карта пуста (слабые ссылки), и замер там ничего не показал бы.
+    """
+
+    def __init__(self):
+        self.value = 0
+        event.listen(Session, "loaded_as_persistent", self._loaded)
+
+    def _loaded(self, sess, instance):
+        self.value = max(self.value, len(sess.identity_map))
+
+    def take(self):
+        value, self.value = self.value, 0
+        return value
+
+
+class World:
+    """Что бенчмарк знает о базе: id очередей и персонажей игроков."""
+
+    def __init__(self):
+        self.queues = [q.id for q in session.query(QueueType).order_by(QueueType.id)]
+        self.chars = {}
+        for tid, cid in session.query(database.User.telegram_id, Character.id).join(Character).order_by(Character.id):
+            self.chars.setdefault(tid, []).append(cid)
+
+
+def player_day(tid, world, rnd, n_updates):
+    """Апдейты одного игрока за день."""
+    u = harness.callback
+    out = [harness.message(tid, "/start")]
+    while len(out) < n_updates:
+        qid = rnd.choice(world.queues)
+        action = rnd.random()
+        if action < 0.35:
+            out += [u(tid, "menu_join"), u(tid, f"view_q:{qid}"), u(tid, f"pre_join:{qid}"),
+                    u(tid, f"do_join:{qid}:{rnd.choice(world.chars[tid])}")]
+        elif action < 0.55:
+            out += [u(tid, "my_active_queues"), u(tid, "back_to_main")]
+        elif action < 0.7:
+            out += [u(tid, "menu_history"), u(tid, "menu_info")]
+        elif action < 0.85:
+            out += [u(tid, "menu_chars"), u(tid, "back_to_main")]
+        else:
+            out += [u(tid, f"leave_q:{qid}")]
+    return out
+
+
+def master_day(world, rnd, rewards):
+    """Мастер листает игроков и раздаёт награды по первым местам очередей."""
+    u = harness.callback
+    out = [u(1, "menu_master"), u(1, "m_users_list:0"), u(1, "m_users_list:1"), u(1, "m_distribute")]
+    heads = (session.query(QueueEntry.id, QueueEntry.queue_type_id)
+             .order_by(QueueEntry.id).limit(rewards).all())
+    for eid, qid in heads:
+        out += [u(1, f"dist:{qid}"), u(1, f"issue:{eid}")]
+    return out
+
+
+async def run(args):
+    database.close_sessions()
+    init_db()
+    harness.seed(args.players, entries_per_user=1, history_per_user=0)
+    bot, dp = harness.build_dispatcher()
+    fake = harness.install_fake_telegram(bot)
+    harness.fake_sheets()
+
+    world = World()
+    rnd = random.Random(args.seed)
+    players = list(world.chars)
+    samples = []
+    peak = IdentityMapPeak()
+    started = time.perf_counter()
+
+    print(f"{'day':>4} {'updates':>8} {'rss MB':>8} {'peak id. map':>13} {'gc objects':>11} {'sec':>6}")
+    for day in range(1, args.days + 1):
+        day_started = time.perf_counter()
+        updates = master_day(world, rnd, args.rewards)
+        for tid in rnd.sample(players, int(len(players) * args.active)):
+            updates += player_day(tid, world, rnd, args.updates_per_day)
+        for update in updates:
+            await dp.feed_update(bot, update)
+        peak_map = peak.take()
+        # Заглушка Telegram копит вызовы — это память бенчмарка, не бота
+        fake.calls.clear()
+        await dp.storage.flush()
+        gc.collect()
+
+        sample = (day, len(updates), rss_mb(), peak_map, len(gc.get_objects()), time.perf_counter() - day_started)
+        samples.append(sample)
+        print(f"{sample[0]:>4} {sample[1]:>8} {sample[2]:>8.1f} {sample[3]:>13} {sample[4]:>11} {sample[5]:>6.1f}")
+
+    await dp.storage.close()
+    await bot.session.close()
+
+    # Первые дни — прогрев (кэши, пулы, скомпилированные запросы); дальше RSS должен стоять
+    warm = samples[min(args.warmup_days, len(samples) - 1)]
+    last = samples[-1]
+    growth = last[2] - warm[2]
+    print(f"\n⏱ {time.perf_counter() - started:.0f} s. RSS after warm-up (day {warm[0]}): {warm[2]:.1f} MB, "
+          f"day {last[0]}: {last[2]:.1f} MB ({growth:+.1f} MB). Peak identity map: {warm[3]} -> {last[3]} objects")
+    if growth > args.tolerance:
+        print(f"❌ RSS grew by more than {args.tolerance} MB after warm-up")
+        return 1
+    print("✅ Memory is flat")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=300)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--active", type=float, default=0.6, help="доля игроков, заходящих в бота за день")
+    parser.add_argument("--updates-per-day", type=int, default=15, help="апдейтов у активного игрока за день")
+    parser.add_argument("--rewards", type=int, default=40, help="наград, выдаваемых мастером за день")
+    parser.add_argument("--warmup-days", type=int, default=2)
+    parser.add_argument("--tolerance", type=float, default=5.0, help="допустимый рост RSS после прогрева, МБ")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
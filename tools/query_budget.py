@@ -0,0 +1,244 @@
+"""
+Проверка числа SQL-запросов на каждый хендлер.
+
+Прогоняет сценарии через dp.feed_update на базе в памяти при двух объёмах данных
+и падает (код 1), если хендлер превысил записанный бюджет или число запросов
+растёт вместе с числом игроков (N+1). Падает и если у сценария нет бюджета или
+какой-то хендлер роутеров (кнопка или сообщение) не покрыт ни одним сценарием.
+
+Запуск из корня проекта:
+    python -m tools.query_budget            # проверка
+    python -m tools.query_budget --record   # записать текущие значения как бюджет
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from tools import harness
+
+harness.prepare()
+
+from aiogram import BaseMiddleware
+from sqlalchemy import event
+
+import database
+from callbacks import cb
+from database import session, init_db, Character, QueueEntry, User
+from middlewares.metrics import handler_name
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), "query_budgets.json")
+# Сколько игроков в "маленькой" и "большой" гильдии
+SCALES = (20, 200)
+MASTER = 1
+
+
+def scenarios():
+    """(имя, апдейт) в порядке выполнения. Меняющие данные — в конце."""
+    entry = session.query(QueueEntry).filter_by(user_id=2).first()
+    other = session.query(QueueEntry).filter_by(user_id=3).first()
+    victim = session.query(QueueEntry).filter_by(user_id=4).first()
+    player = session.query(User).filter_by(telegram_id=2).one()
+    master_main = session.query(User).filter_by(telegram_id=MASTER).one().characters[0]
+    master_qids = {e.queue_type_id for e in session.query(QueueEntry).filter_by(user_id=MASTER)}
+    free_qid = next(qid for qid in range(1, 12) if qid not in master_qids)
+    alt_id = next(c.id for c in player.characters if not c.is_main)
+    # План раздачи — в самой длинной очереди, которую не трогают issue и kill
+    counts = database.get_queue_counts()
+    plan_qid = max((qid for qid in counts if qid not in (other.queue_type_id, victim.queue_type_id)), key=counts.get)
+    # Игроки 5-10 ни в каких сценариях выше не участвуют — их удаляем, баним и т.п.
+    alt_a, alt_b = (session.query(Character).filter_by(user_id=_uid(5), is_main=False).order_by(Character.id))
+    banned = _uid(6)
+    stripped = session.query(Character).filter_by(user_id=_uid(7), is_main=True).one()
+
+    u, m = harness.callback, harness.message
+    return [
+        ("cmd_start", harness.message(MASTER, "/start")),
+        ("back_to_main", u(MASTER, "back_to_main")),
+        ("menu_chars", u(MASTER, "menu_chars")),
+        ("del_alt_menu", u(MASTER, "del_alt_menu")),
+        ("menu_join", u(MASTER, "menu_join")),
+        ("view_q", u(MASTER, f"view_q:{free_qid}")),
+        ("pre_join", u(MASTER, f"pre_join:{free_qid}")),
+        ("my_active_queues", u(2, "my_active_queues")),
+        ("swap_start", u(2, f"swap_start:{entry.id}")),
+        ("menu_history", u(MASTER, "menu_history")),
+        ("menu_info", u(MASTER, "menu_info")),
+        ("menu_master", u(MASTER, "menu_master")),
+        ("m_users_list", u(MASTER, "m_users_list:0")),
+        ("m_users_list_p2", u(MASTER, "m_users_list:1")),
+        ("m_u_manage", u(MASTER, f"m_u_manage:{player.id}:0")),
+        ("m_distribute", u(MASTER, "m_distribute")),
+        ("dist", u(MASTER, f"dist:{other.queue_type_id}")),
+        ("m_limits_menu", u(MASTER, "m_limits_menu")),
+        ("m_list_limits", u(MASTER, "m_list_limits")),
+        ("m_lock_menu", u(MASTER, "m_lock_menu")),
+        ("m_edit_desc", u(MASTER, "m_edit_desc")),
+        ("m_force_del", u(MASTER, "m_force_del")),
+        ("sel_del", u(MASTER, f"sel_del:{other.queue_type_id}")),
+        ("m_global_log", u(MASTER, "m_global_log")),
+        ("m_schedule", u(MASTER, "m_schedule")),
+        # --- меняют данные ---
+        ("do_join", u(MASTER, f"do_join:{free_qid}:{master_main.id}")),
+        ("do_swap", u(2, f"do_swap:{entry.id}:{alt_id}")),
+        ("leave_q", u(MASTER, f"leave_q:{free_qid}")),
+        ("toggle_lock", u(MASTER, "toggle_lock:1")),
+        ("issue", u(MASTER, f"issue:{other.id}")),
+        ("kill", u(MASTER, f"kill:{victim.id}")),
+        ("plan", u(MASTER, f"plan:{plan_qid}:3")),
+        ("plan_ok", u(MASTER, f"plan_ok:{plan_qid}")),
+        # --- персонажи игрока ---
+        ("add_main", u(2, "add_main")),
+        ("process_main_input", m(2, "NewMain2")),
+        ("confirm_main_change", u(2, "confirm_main_change")),
+        ("add_alt", u(2, "add_alt")),
+        ("process_alt", m(2, "NewAlt2")),
+        ("del_c", u(5, f"del_c:{alt_a.id}")),
+        ("conf_del", u(5, f"conf_del:{alt_b.id}:swap")),
+        # --- мастер: игроки, лимиты, описание, ручное добавление ---
+        ("m_ban_toggle", u(MASTER, f"m_ban_toggle:{banned}:0")),
+        ("m_del_char", u(MASTER, f"m_del_char:{stripped.id}:{stripped.user_id}:0")),
+        ("m_add_admin_start", u(MASTER, "m_add_admin_start")),
+        ("m_add_admin_save", m(MASTER, "user8")),
+        ("m_set_personal", u(MASTER, "m_set_personal")),
+        ("m_set_personal_nick", m(MASTER, "Main9")),
+        ("m_set_personal_save", m(MASTER, "4")),
+        ("m_set_global", u(MASTER, "m_set_global")),
+        ("m_set_global_save", m(MASTER, "5")),
+        ("edit_d", u(MASTER, "edit_d:1")),
+        ("m_edit_save", m(MASTER, "Новое описание")),
+        ("m_force_add", u(MASTER, "m_force_add")),
+        ("m_force_nick", m(MASTER, "Main10")),
+        ("f_add", u(MASTER, f"f_add:{free_qid}")),
+        # --- объявления: разовое в будущем (id 1), по дням недели, прямо сейчас ---
+        ("m_announce", u(MASTER, "m_announce")),
+        ("m_ann_text", m(MASTER, "Сбор в 20:00")),
+        ("ann_future", u(MASTER, "ann:future")),
+        ("process_future_datetime", m(MASTER, "01.01.2030 20:00")),
+        ("m_announce_weekly", u(MASTER, "m_announce")),
+        ("m_ann_text_weekly", m(MASTER, "Сбор в 20:00")),
+        ("ann_weekly", u(MASTER, "ann:weekly")),
+        ("toggle_day", u(MASTER, "toggle_day:mon")),
+        ("days_confirm", u(MASTER, "days_confirm")),
+        ("process_time_only", m(MASTER, "20:00")),
+        ("m_announce_now", u(MASTER, "m_announce")),
+        ("m_ann_text_now", m(MASTER, "Сбор в 20:00")),
+        ("ann_now", u(MASTER, "ann:now")),
+        ("del_sch", u(MASTER, "del_sch:1")),
+        # --- служебное ---
+        ("m_backup", u(MASTER, "m_backup")),
+        ("m_profile", u(MASTER, "m_profile")),
+        ("prof", u(MASTER, "prof:sample:60")),
+        ("prof_stop", u(MASTER, "prof_stop")),
+    ]
+
+
+def _uid(telegram_id):
+    return session.query(User.id).filter_by(telegram_id=telegram_id).scalar()
+
+
+class HandlerSeen(BaseMiddleware):
+    """Внутренний middleware: запоминает, какой хендлер обработал апдейт (имя — как в метриках)."""
+
+    def __init__(self):
+        self.name = None
+
+    async def __call__(self, handler, event, data):
+        self.name = handler_name(event, data)
+        return await handler(event, data)
+
+
+def registered_handlers(dp):
+    """Все хендлеры, которым нужен бюджет: коды кнопок и message-хендлеры роутеров."""
+    names = {f"cb:{code}" for code in cb.handlers}
+    for router in dp.chain_tail:
+        names.update(h.callback.__name__ for h in router.message.handlers)
+    return names
+
+
+async def measure(n_users, seen):
+    """
+    Прогоняет сценарии на свежей базе с n_users игроками.
+    Возвращает {сценарий: запросов} и {сценарий: какой хендлер его обработал}.
+    """
+    database.close_sessions()
+    init_db()
+    harness.seed(n_users)
+    bot, dp = harness.build_dispatcher()
+
+    counter = [0]
+    engine = database.get_session().get_bind()
+    listener = lambda *args: counter.__setitem__(0, counter[0] + 1)
+    event.listen(engine, "after_cursor_execute", listener)
+
+    counts, ran = {}, {}
+    for name, update in scenarios():
+        # Сессия долгоживущая: начинаем каждый апдейт с "холодного" состояния, как в проде после commit
+        session.expire_all()
+        counter[0] = 0
+        seen.name = None
+        await dp.feed_update(bot, update)
+        counts[name] = counter[0]
+        ran[name] = seen.name
+
+    event.remove(engine, "after_cursor_execute", listener)
+    # Отчёт профилировщика (prof_stop) уходит фоном — дожидаемся, чтобы следующий прогон начал с чистого листа
+    await asyncio.sleep(0.1)
+    return counts, ran
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", action="store_true", help="записать текущие значения в query_budgets.json")
+    args = parser.parse_args()
+
+    bot, dp = harness.build_dispatcher()
+    harness.install_fake_telegram(bot)
+    harness.fake_sheets()
+    seen = HandlerSeen()
+    dp.message.middleware(seen)
+    dp.callback_query.middleware(seen)
+
+    (small, _), (large, ran) = [await measure(n, seen) for n in SCALES]
+    budgets = {}
+    if os.path.exists(BUDGETS_FILE):
+        with open(BUDGETS_FILE, encoding="utf-8") as f: budgets = json.load(f)
+
+    failed = []
+    print(f"{'scenario':<26} {SCALES[0]:>6} {SCALES[1]:>6} {'budget':>7}")
+    for name in large:
+        budget = budgets.get(name)
+        problems = []
+        if ran[name] in (None, "cb:unknown"): problems.append("no handler ran")
+        if large[name] > small[name]: problems.append("grows with data (N+1)")
+        if budget is None: problems.append("no budget (run with --record)")
+        elif large[name] > budget: problems.append(f"over budget by {large[name] - budget}")
+        if problems: failed.append(name)
+        print(f"{name:<26} {small[name]:>6} {large[name]:>6} {budget if budget is not None else '-':>7}  {'; '.join(problems)}")
+
+    # Новый хендлер без сценария не должен проходить проверку молча
+    uncovered = sorted(registered_handlers(dp) - set(ran.values()))
+    if uncovered:
+        print(f"\n❌ Handlers without a budget scenario: {', '.join(uncovered)}")
+        failed += uncovered
+
+    await dp.storage.close()
+    await bot.session.close()
+
+    if args.record:
+        with open(BUDGETS_FILE, "w", encoding="utf-8") as f:
+            json.dump(large, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"📝 Budgets written to {BUDGETS_FILE}")
+        return 0
+
+    if failed:
+        print(f"\n❌ {len(failed)} handler(s) failed: {', '.join(failed)}")
+        return 1
+    print("\n✅ All handlers within budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
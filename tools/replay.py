@@ -0,0 +1,153 @@
+"""
+Проигрывание записанного трафика (RECORD_UPDATES, см. middlewares/recorder.py).
+
+Апдейты из лога подаются в dp.feed_update с исходными паузами (1x), ускоренно (10x)
+или без пауз (max) на КОПИИ базы; бот ходит в локальный фейковый Bot API.
+В конце — задержки по хендлерам, пропускная способность и число SQL-запросов.
+
+Запуск из корня проекта:
+    python -m tools.replay updates.jsonl --db guild_bot.db --salt "$RECORD_SALT"
+    python -m tools.replay updates.jsonl --db guild_bot.db --salt "$RECORD_SALT" --speed 10
+    python -m tools.replay updates.jsonl --db guild_bot.db --salt "$RECORD_SALT" --speed max --out after.json
+
+--salt должен совпадать с RECORD_SALT при записи: с ним игроки в копии базы получают
+те же псевдонимы, что и в логе. Исходная база не меняется.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from tools import harness
+from tools.harness import percentile
+
+_tmp = tempfile.mkdtemp(prefix="replay-")
+DB_COPY = os.path.join(_tmp, "guild_bot.db")
+harness.prepare(DB_COPY)
+
+import metrics
+from database import init_db
+from middlewares.recorder import Anonymizer, load, to_update
+from callbacks import SEP
+
+
+def _rewrite(db, table, column, fn):
+    rows = db.execute(f"SELECT id, {column} FROM {table}").fetchall()
+    db.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", [(fn(value), rid) for rid, value in rows])
+
+
+def anonymize_db(path, salt):
+    """Обезличивает копию базы так же, как UpdateRecorder — апдейты из лога попадут на своих игроков."""
+    anon = Anonymizer(salt)
+    db = sqlite3.connect(path)
+    with db:
+        _rewrite(db, "users", "telegram_id", lambda tid: anon.anon_id(tid) if tid else tid)
+        # Все колонки с ником персонажа или username: один и тот же ник везде получает один псевдоним
+        _rewrite(db, "users", "username", anon.anon_username)
+        _rewrite(db, "reward_history", "issued_by", anon.anon_username)
+        for table, column in (("characters", "nickname"), ("queue_entries", "character_name"),
+                              ("reward_history", "character_name"),
+                              ("sheet_outbox", "main_nick"), ("sheet_outbox", "char_nick")):
+            _rewrite(db, table, column, anon.anon_text)
+    db.close()
+
+
+def label(row):
+    if row["k"] == "c": return "cb:" + (row.get("d") or "").split(SEP)[0]
+    text = row.get("x") or ""
+    return "msg:" + text.split()[0] if text.startswith("/") else "msg:text"
+
+
+async def replay(rows, bot, dp, speed, concurrency):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    t0 = rows[0]["t"]
+    started = time.perf_counter()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def feed(i, row):
+        if speed != "max":
+            # Ждём момента, когда апдейт пришёл в записи (с учётом ускорения)
+            due = started + (row["t"] - t0) / speed
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            begin = due
+        async with limit:
+            if speed == "max": begin = time.perf_counter()
+            try:
+                await dp.feed_update(bot, to_update(row, i))
+            except Exception as e:
+                errors[label(row)] += 1
+                if errors[label(row)] == 1: print(f"⚠️ {label(row)}: {type(e).__name__}: {e}")
+        # Задержка считается от момента "прихода" апдейта — включая ожидание в очереди
+        latencies[label(row)].append(time.perf_counter() - begin)
+
+    await asyncio.gather(*(feed(i, row) for i, row in enumerate(rows, 1)))
+    return time.perf_counter() - started, latencies, errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="файл, записанный с RECORD_UPDATES")
+    parser.add_argument("--db", help="база гильдии, с которой снята запись (будет скопирована)")
+    parser.add_argument("--salt", help="RECORD_SALT, с которым писался лог")
+    parser.add_argument("--speed", default="1", help="1, 10, ... или max")
+    parser.add_argument("--concurrency", type=int, default=40, help="сколько апдейтов обрабатывать одновременно")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="задержка фейкового Bot API, секунды")
+    parser.add_argument("--out", help="сохранить результат в JSON")
+    args = parser.parse_args()
+    speed = args.speed if args.speed == "max" else float(args.speed)
+
+    rows = load(args.log)
+    if not rows: sys.exit("Empty log")
+
+    if args.db: shutil.copy(args.db, DB_COPY)
+    # Схема — до обезличивания: в копии старой базы может не быть новых таблиц (sheet_outbox)
+    init_db()
+    if args.db:
+        if args.salt: anonymize_db(DB_COPY, args.salt)
+        else: print("⚠️ --salt not given: recorded players won't match players in the database copy")
+
+    bot, dp = harness.build_dispatcher()
+    harness.fake_sheets()
+    api = await harness.FakeBotAPI(latency=args.api_latency).start()
+    api.point(bot)
+
+    span = rows[-1]["t"] - rows[0]["t"]
+    print(f"▶️ Replaying {len(rows)} updates recorded over {span:.0f} s at {args.speed}x")
+    try:
+        wall, latencies, errors = await replay(rows, bot, dp, speed, args.concurrency)
+    finally:
+        await api.stop()
+        await dp.storage.close()
+        await bot.session.close()
+
+    sql_total = sum(metrics.sql_queries.values.values())
+    print(f"\n⏱ {wall:.1f} s, {len(rows) / wall:.1f} upd/s, SQL statements: {sql_total} ({sql_total / len(rows):.1f}/update)")
+    print(f"{'handler':<22} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    result = {}
+    for name, values in sorted(latencies.items(), key=lambda kv: -len(kv[1])):
+        result[name] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "errors": errors.get(name, 0),
+        }
+        r = result[name]
+        print(f"{name:<22} {r['count']:>6} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['errors']:>7}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"log": args.log, "speed": args.speed, "seconds": round(wall, 3),
+                       "sql_statements": sql_total, "handlers": result}, f, indent=2, ensure_ascii=False)
+        print(f"💾 Saved to {args.out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
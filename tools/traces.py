@@ -0,0 +1,143 @@
+"""
+Разбор трейсов бота (TRACE_LOG, см. tracing.py): самые медленные апдейты и куда ушло их время.
+
+Запуск из корня проекта:
+    python -m tools.traces                       # 10 самых медленных из traces.jsonl (+ ротированные)
+    python -m tools.traces --top 30 --handler cb:do_join
+    python -m tools.traces --user 123456789      # апдейты одного игрока
+    python -m tools.traces --trace 3f9a1c...     # дерево спанов одного трейса
+
+Время по видам: sql — SQLite, sheets — Google Sheets, api — Bot API, background — фоновые
+задачи апдейта; "self" — остаток корневого спана (код хендлеров, ожидание цикла).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+KINDS = ("sql", "sheets", "api", "background")
+
+
+def load(path):
+    """{trace_id: [спаны]} из файла и его ротированных копий (file.1, file.2, ...)."""
+    traces = defaultdict(list)
+    for name in sorted(glob.glob(path + ".*")) + [path]:
+        if not os.path.exists(name): continue
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip(): continue
+                try: span = json.loads(line)
+                except ValueError: continue
+                traces[span["trace"]].append(span)
+    return traces
+
+
+def root_of(spans):
+    return next((s for s in spans if s.get("parent") is None), None)
+
+
+def breakdown(spans, root):
+    """Время по видам: считаем только спаны верхнего уровня своего вида (SQL внутри фоновой задачи — у задачи)."""
+    by_id = {s["span"]: s for s in spans}
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for s in spans:
+        if s is root or s["kind"] not in KINDS: continue
+        parent = by_id.get(s["parent"])
+        if parent is not None and parent is not root and parent["kind"] in KINDS: continue
+        totals[s["kind"]] += s["ms"]
+        counts[s["kind"]] += 1
+    # Фоновые задачи идут параллельно апдейту — в "self" их не вычитаем
+    inline = sum(v for k, v in totals.items() if k != "background")
+    totals["self"] = max(0.0, root["ms"] - inline)
+    return totals, counts
+
+
+def print_top(traces, args):
+    rows = []
+    for tid, spans in traces.items():
+        root = root_of(spans)
+        if root is None: continue
+        if args.handler and root.get("handler") != args.handler: continue
+        if args.user and str(root.get("user")) != args.user: continue
+        rows.append((root, spans))
+    rows.sort(key=lambda r: -r[0]["ms"])
+
+    if not rows:
+        print("No traces")
+        return
+    print(f"{'trace':<17} {'time':<11} {'handler':<22} {'user':>11} {'total ms':>9}  "
+          + " ".join(f"{k:>12}" for k in KINDS) + f" {'self':>8}")
+    for root, spans in rows[:args.top]:
+        totals, counts = breakdown(spans, root)
+        when = datetime.fromtimestamp(root["ts"]).strftime("%m-%d %H:%M")
+        cells = " ".join(f"{f'{totals[k]:.0f}/{counts[k]}':>12}" if counts[k] else f"{'-':>12}" for k in KINDS)
+        mark = " ❌" if "error" in root else ""
+        print(f"{root['trace']:<17} {when:<11} {str(root.get('handler', root['name'])):<22} "
+              f"{str(root.get('user', '')):>11} {root['ms']:>9.0f}  {cells} {totals['self']:>8.0f}{mark}")
+    print("\n(ms/count per kind; see --trace <id> for the span tree)")
+
+    # Сводка по хендлерам среди выбранных: где в сумме теряется время
+    by_handler = defaultdict(lambda: defaultdict(float))
+    for root, spans in rows:
+        totals, _ = breakdown(spans, root)
+        h = by_handler[root.get("handler", root["name"])]
+        h["n"] += 1
+        h["ms"] += root["ms"]
+        for k, v in totals.items(): h[k] += v
+    print(f"\n{'handler':<22} {'traces':>6} {'avg ms':>8}  " + " ".join(f"{k:>10}" for k in KINDS + ("self",)))
+    for name, h in sorted(by_handler.items(), key=lambda kv: -kv[1]["ms"])[:args.top]:
+        share = " ".join(f"{h[k] / h['ms'] * 100 if h['ms'] else 0:>9.0f}%" for k in KINDS + ("self",))
+        print(f"{str(name):<22} {int(h['n']):>6} {h['ms'] / h['n']:>8.0f}  {share}")
+
+
+def print_tree(traces, trace_id):
+    matches = [tid for tid in traces if tid.startswith(trace_id)]
+    if len(matches) != 1:
+        print(f"Trace '{trace_id}': {'not found' if not matches else 'ambiguous'}")
+        return 1
+    spans = traces[matches[0]]
+    root = root_of(spans)
+    children = defaultdict(list)
+    for s in spans:
+        if s is not root: children[s["parent"]].append(s)
+    t0 = root["ts"] if root else min(s["ts"] for s in spans)
+
+    def show(span, depth):
+        attrs = {k: v for k, v in span.items() if k not in ("trace", "span", "parent", "name", "kind", "ts", "ms")}
+        offset = (span["ts"] - t0) * 1000
+        extra = " ".join(f"{k}={v}" for k, v in attrs.items())
+        print(f"{offset:>8.0f} ms {'  ' * depth}{span['kind']}: {span['name']}  {span['ms']:.1f} ms  {extra}")
+        for child in sorted(children[span["span"]], key=lambda s: s["ts"]):
+            show(child, depth + 1)
+
+    if root: show(root, 0)
+    else:
+        print("(root span is missing — only child spans were written)")
+        for s in sorted(spans, key=lambda s: s["ts"]): show(s, 0)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", default=os.getenv("TRACE_LOG", "traces.jsonl"))
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--handler", help="только этот хендлер (как в метриках: cb:do_join, cmd_start)")
+    parser.add_argument("--user", help="только апдейты этого telegram id")
+    parser.add_argument("--trace", help="показать дерево спанов трейса (можно начало id)")
+    args = parser.parse_args()
+
+    traces = load(args.file)
+    if not traces:
+        print(f"No spans in {args.file}")
+        return 1
+    if args.trace: return print_tree(traces, args.trace)
+    print_top(traces, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
+from sqlalchemy import event
+
+# --- CONFIGURATION ---
+# Куда пишем трейсы (JSONL, ротация 5 файлов по 5 МБ). Пусто — трейсинг выключен.
+TRACE_LOG_FILE = os.getenv("TRACE_LOG", "traces.jsonl")
+# Доля апдейтов, которые пишутся всегда
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0.01"))
+# Медленные (дольше стольких секунд) и упавшие апдейты пишутся независимо от выборки
+TRACE_SLOW = float(os.getenv("TRACE_SLOW", "1.0"))
+# Больше стольких спанов в одном трейсе не храним (апдейт, сделавший тысячи запросов, и так виден)
+MAX_SPANS = 500
+
+log = logging.getLogger("traces")
+
+# Текущий трейс и спан: (Trace, id спана). Ставит TracingMiddleware, наследуют фоновые задачи.
+_current = ContextVar("trace_span", default=None)
+
+
+class Trace:
+    """
+    Спаны одного апдейта. Решение, писать ли трейс, принимается, когда закончился корневой
+    спан (медленный, упавший или попавший в выборку). Спаны фоновых задач, закончившихся
+    позже, дописываются, если трейс оставили.
+    """
+
+    def __init__(self):
+        self.id = os.urandom(8).hex()
+        self.ids = itertools.count(1)
+        self.spans = []
+        self.dropped = 0
+        self.keep = None
+        self.sampled = random.random() < TRACE_SAMPLE
+        # Атрибуты корневого спана: дополняются через annotate()
+        self.root_attrs = {}
+
+    def add(self, span):
+        if self.keep is None:
+            if len(self.spans) < MAX_SPANS: self.spans.append(span)
+            else: self.dropped += 1
+        elif self.keep:
+            _write(span)
+
+    def finish(self, root):
+        self.keep = self.sampled or root["ms"] >= TRACE_SLOW * 1000 or "error" in root
+        if not self.keep: return
+        if self.dropped: root["dropped_spans"] = self.dropped
+        for span in self.spans: _write(span)
+        _write(root)
+        self.spans = []
+
+
+def _write(span):
+    if not log.handlers: _setup_log()
+    log.info(json.dumps(span, ensure_ascii=False, separators=(",", ":")))
+
+
+def _span_dict(trace, sid, parent, name, kind, wall_start, took, attrs, error):
+    span = {"trace": trace.id, "span": sid, "parent": parent, "name": name, "kind": kind,
+            "ts": round(wall_start, 3), "ms": round(took * 1000, 2)}
+    if attrs: span.update(attrs)
+    if error: span["error"] = error
+    return span
+
+
+def enabled():
+    return bool(TRACE_LOG_FILE)
+
+
+def correlation_id():
+    """Id трейса текущего апдейта (для логов) или None."""
+    current = _current.get()
+    return current[0].id if current else None
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Корневой спан апдейта. Всё, что выполнится внутри (и запущенные отсюда фоновые задачи), — его дети."""
+    t = Trace()
+    t.root_attrs.update(attrs)
+    token = _current.set((t, 0))
+    wall_start, started = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield t
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        t.finish(_span_dict(t, 0, None, name, "update", wall_start, time.perf_counter() - started, t.root_attrs, error))
+
+
+@contextmanager
+def span(name, kind, **attrs):
+    """Дочерний спан текущего трейса. Вне трейса ничего не делает."""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    t, parent = current
+    sid = next(t.ids)
+    token = _current.set((t, sid))
+    wall_start, started = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        t.add(_span_dict(t, sid, parent, name, kind, wall_start, time.perf_counter() - started, attrs, error))
+
+
+def annotate(**attrs):
+    """Дописывает атрибуты в корневой спан (например, имя хендлера, которое известно только внутри)."""
+    current = _current.get()
+    if current: current[0].root_attrs.update(attrs)
+
+
+def instrument_engine(engine):
+    """SQL-запросы — спаны текущего трейса."""
+    if not enabled(): return engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault("trace_started", []).append((time.time(), time.perf_counter()))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        current = _current.get()
+        if current is None or not conn.info.get("trace_started"): return
+        wall_start, started = conn.info["trace_started"].pop()
+        t, parent = current
+        t.add(_span_dict(t, next(t.ids), parent, _sql_name(statement), "sql", wall_start,
+                         time.perf_counter() - started, None, None))
+
+    return engine
+
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.I)
+
+
+def _sql_name(statement):
+    """Глагол и первая таблица: "SELECT users", "INSERT queue_entries" — без параметров."""
+    verb = statement.split(None, 1)[0].upper() if statement.strip() else "SQL"
+    table = _SQL_TABLE.search(statement)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def _setup_log():
+    handler = RotatingFileHandler(TRACE_LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=4, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
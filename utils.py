@@ -1,54 +1,90 @@
+import asyncio
 import os
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime, timedelta
-from dotenv import load_dotenv # Нужно для чтения .env
 
-# Загружаем переменные из .env
-load_dotenv()
+import background
+import events
+import jobs
+from breaker import CircuitBreaker, CircuitOpen, CLOSED, HALF_OPEN, OPEN, describe
+from database import session, SheetOutbox
+from events import EntryJoined, EntryLeft, EntrySwapped, RewardIssued
+from guilds import get_guild
+from metrics import track_sheets
+from tracing import span
 
 # --- CONFIGURATION ---
 CREDENTIALS_FILE = 'credentials.json'
+# URL таблицы, столбец ростера и вкладки очередей — у каждой гильдии свои (см. guilds.py)
+# Таймаут одного вызова Google Sheets, секунд
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "10"))
+# После стольких ошибок подряд Google считается недоступным: ростер — из кэша, лог — в outbox
+SHEETS_FAILURES = int(os.getenv("SHEETS_FAILURES", "3"))
+# Как часто в это время проверять, не ожил ли Google, секунд
+SHEETS_RETRY_AFTER = float(os.getenv("SHEETS_RETRY_AFTER", "60"))
 
-# ТЕПЕРЬ БЕРЕМ ИЗ ПЕРЕМЕННОЙ ОКРУЖЕНИЯ
-SPREADSHEET_URL = os.getenv("SPREADSHEET_URL") 
+# --- CACHE STORAGE ---
+# guild_id -> (ники из ростера, время обновления)
+roster_cache = {}
+CACHE_DURATION = timedelta(minutes=10)
 
-# Проверка на случай, если забыли добавить в .env
-if not SPREADSHEET_URL:
-    print("⚠️ WARNING: SPREADSHEET_URL not found in .env file!")
+def _sheets_client():
+    """Клиент Google Sheets. gspread и oauth2client тянут весь стек Google-авторизации,
+    поэтому импортируются при первом обращении, а не при старте бота."""
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
 
-# НАСТРОЙКА: Какой по счету столбец читать?
-# 0 = Столбец A (Первый)
-TARGET_COL_INDEX = 1 
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
+    client = gspread.authorize(creds)
+    client.http_client.set_timeout(SHEETS_TIMEOUT)
+    return client
 
-# Сколько первых строк пропускать
-SKIP_ROWS = 1
+def _transient(error):
+    """
+    Сбой, который пройдёт сам: таймаут, обрыв связи, 5xx или 429 от Google. Нет прав (403),
+    нет таблицы или вкладки — ошибка настройки одной гильдии, предохранитель из-за неё не размыкаем.
+    """
+    import gspread
+    if isinstance(error, gspread.exceptions.APIError):
+        code = error.response.status_code
+        return code >= 500 or code == 429
+    return not isinstance(error, gspread.exceptions.GSpreadException)
 
-# --- CACHE STORAGE ---
-cached_nicks = []
-last_update_time = None
-CACHE_DURATION = timedelta(minutes=10)
+# url таблицы -> предохранитель: одна неисправная таблица не отключает Google для остальных гильдий
+_breakers = {}
+
+async def _publish_breaker(breaker):
+    try: await jobs.save_breaker(breaker)
+    except Exception as e: print(f"⚠️ Breaker state of {breaker.name} not published: {e}")
+
+def sheets_breaker():
+    """Предохранитель таблицы текущей гильдии — через него идут все её вызовы Google Sheets (см. breaker.py)."""
+    guild = get_guild()
+    url = guild.spreadsheet_url
+    if url not in _breakers:
+        _breakers[url] = CircuitBreaker(f"sheets:{guild.id}", SHEETS_FAILURES, SHEETS_RETRY_AFTER, SHEETS_TIMEOUT,
+                                        lambda: _sheets_client().open_by_url(url), _transient, _publish_breaker)
+    return _breakers[url]
+
+def _read_roster(url):
+    """Блокирующее чтение первого листа — выполняется в потоке."""
+    sheet = _sheets_client().open_by_url(url).sheet1
+    return sheet.title, sheet.get_all_values()
 
 async def update_cache():
-    global cached_nicks, last_update_time
+    guild = get_guild()
     
-    if not SPREADSHEET_URL:
-        print("❌ Error: SPREADSHEET_URL is missing.")
+    if not guild.spreadsheet_url:
+        print(f"❌ Error: spreadsheet_url is missing for guild '{guild.id}'.")
         return
 
-    print(f"🔗 DEBUG: Читаю таблицу: {SPREADSHEET_URL}")
+    print(f"🔗 DEBUG: Читаю таблицу: {guild.spreadsheet_url}")
     try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-        client = gspread.authorize(creds)
-
-        # Открываем первый лист
-        sheet = client.open_by_url(SPREADSHEET_URL).sheet1
-        title = sheet.title
+        with track_sheets("read_roster"), span("read_roster", "sheets"):
+            # Открываем первый лист (в потоке: ростеры гильдий при старте читаются параллельно)
+            title, all_rows = await sheets_breaker().call(_read_roster, guild.spreadsheet_url)
         print(f"📄 DEBUG: Открыт лист с названием: '{title}'") # <--- ПРОВЕРЬ ЭТО ИМЯ!
-        
-        all_rows = sheet.get_all_values()
-        
+
         if not all_rows:
             print("❌ Таблица пуста.")
             return
@@ -66,26 +102,28 @@ async def update_cache():
 
         new_nicks = []
         for i, row in enumerate(all_rows):
-            if i < SKIP_ROWS: continue
+            if i < guild.skip_rows: continue
             
-            # Используем твой текущий настройки
-            if len(row) > TARGET_COL_INDEX:
-                val = str(row[TARGET_COL_INDEX]).strip()
+            # Используем настройки гильдии
+            if len(row) > guild.target_col_index:
+                val = str(row[guild.target_col_index]).strip()
                 if val and len(val) > 1:
                     new_nicks.append(val)
         
-        cached_nicks = new_nicks
-        last_update_time = datetime.now()
+        roster_cache[guild.id] = (new_nicks, datetime.now())
         
+    except CircuitOpen as e:
+        print(f"⏸ Ростер из кэша: {e}")
     except Exception as e:
-        print(f"❌ Error: {e}")
+        print(f"❌ Error: {describe(e)}")
 
 async def check_google_sheet(nickname: str) -> bool:
-    global cached_nicks, last_update_time
+    _, last_update_time = roster_cache.get(get_guild().id, ([], None))
 
     if not last_update_time or (datetime.now() - last_update_time) > CACHE_DURATION:
         await update_cache()
 
+    cached_nicks, _ = roster_cache.get(get_guild().id, ([], None))
     nickname_lower = nickname.strip().lower()
     allowed_list_lower = [n.lower() for n in cached_nicks]
 
@@ -95,69 +133,175 @@ async def check_google_sheet(nickname: str) -> bool:
     return False
 
 # --- ЛОГИРОВАНИЕ В GOOGLE SHEETS ---
+# Строки пишутся по доменным событиям (см. events.py): копятся SHEETS_BATCH_DELAY секунд
+# и уходят одной задачей в очередь (см. jobs.py) — воркер пишет их пачкой: одна авторизация
+# и по одному append_rows на вкладку.
 
-# Словарь: "Название очереди в боте" : "Название вкладки в Google"
-SHEET_MAPPING = {
-    "Камень доблести": "Камень доблести",
-    "Метеориты": "Метеориты",
-    "Жемчужины Фу Си": "Фу Си",
-    "Опыт в диск": "Опыт в диск",
-    "Проходки в УФ": "Проходки в УФ",
-    "Знаки Единства": "Знак Единства",
-    "Колода карт": "Колода",
-    "Сущность карты": "Сущность карты",
-    "Камень божества": "Камень божика",
-    "Камни бессмертных": "Камни бессмертных",
-    "Цилинь": "Цилинь"
-}
-
-async def log_reward_to_sheet(queue_name: str, main_nick: str, char_nick: str, manager_name: str, status: str = "Выдано"):
-    print(f"\n🚀 DEBUG: Начинаю запись в таблицу для очереди: '{queue_name}'") # <--- ЛОВУШКА 1
-
-    # 1. Определяем нужную вкладку
-    target_sheet_name = SHEET_MAPPING.get(queue_name)
-    print(f"📄 DEBUG: Целевая вкладка по словарю: '{target_sheet_name}'") # <--- ЛОВУШКА 2
-    
-    if not target_sheet_name:
-        print(f"⚠️ DEBUG: Нет маппинга! Пробую использовать имя очереди как есть: '{queue_name}'")
-        target_sheet_name = queue_name 
+SHEETS_BATCH_DELAY = float(os.getenv("SHEETS_BATCH_DELAY", "2"))
 
-    try:
-        # 2. Подключаемся
-        print("🔌 DEBUG: Подключаюсь к Google API...") # <--- ЛОВУШКА 3
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-        client = gspread.authorize(creds)
-        
-        # 3. Открываем таблицу
-        print(f"📂 DEBUG: Открываю таблицу по URL...") 
-        sh = client.open_by_url(SPREADSHEET_URL)
-        
-        # 4. Открываем вкладку
-        print(f"📑 DEBUG: Ищу вкладку '{target_sheet_name}'...")
-        worksheet = sh.worksheet(target_sheet_name)
-        
-        # 5. Формируем строку
-        now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        row = [now, queue_name, main_nick, char_nick, status]
-        print(f"📝 DEBUG: Пытаюсь записать строку: {row}")
-        
-        # 6. Записываем
-        worksheet.append_row(row, table_range="A8")
-        print(f"✅ Записано в Google ('{target_sheet_name}'): {char_nick} - {status}")
-        return True
+# guild_id -> [(очередь, основа, персонаж, статус)], ждущие записи
+_pending_rows = {}
+
+_LEFT_STATUS = {"left": "❌ Вышел", "kicked": "⛔ Кик Мастером", "character_removed": "❌ Ушел (удаление перса)"}
+_SWAP_STATUS = {"swap": "🔄 Замена ({})", "main_changed": "🔄 Смена основы ({})", "character_removed": "♻️ Авто-замена ({})"}
+
+
+def _sheet_row(event):
+    """Строка лога для события или None, если событие в таблицу не пишется (например, бан)."""
+    if isinstance(event, EntryJoined):
+        return event.queue_name, event.main_nick, event.character, "👑 Мастер добавил" if event.by_master else "В очереди"
+    if isinstance(event, EntryLeft):
+        status = _LEFT_STATUS.get(event.reason)
+        return (event.queue_name, event.main_nick, event.character, status) if status else None
+    if isinstance(event, EntrySwapped):
+        status = _SWAP_STATUS[event.reason].format(event.old_character)
+        return event.queue_name, event.main_nick, event.new_character, status
+    if isinstance(event, RewardIssued):
+        return event.queue_name, event.main_nick, event.character, "Выдано"
+    return None
+
+
+@events.subscribe(EntryJoined, EntryLeft, EntrySwapped, RewardIssued)
+async def _queue_sheet_row(event):
+    row = _sheet_row(event)
+    if not row: return
+    gid = get_guild().id
+    rows = _pending_rows.setdefault(gid, [])
+    rows.append(row)
+    # Первая строка пачки запускает отложенную запись, остальные просто дописываются к ней
+    if len(rows) == 1 and not await background.submit("sheets", _flush_rows, gid):
+        lost = _pending_rows.pop(gid, [])
+        print(f"❌ Sheets log rows dropped: {lost}")
 
-    except gspread.WorksheetNotFound:
-        print(f"❌ ERROR: Вкладка '{target_sheet_name}' НЕ НАЙДЕНА в таблице!")
-        print("   Проверь название листа на пробелы и регистр.")
-        return False
-    except gspread.exceptions.APIError as e:
-        print(f"❌ ERROR: Ошибка API Гугла. Возможно, нет прав 'Редактора'.")
-        print(f"   Детали: {e}")
-        return False
+
+async def _flush_rows(gid):
+    await asyncio.sleep(SHEETS_BATCH_DELAY)
+    rows = _pending_rows.pop(gid, [])
+    if not rows: return
+    try:
+        # Время — когда всё произошло, а не когда воркер дошёл до задачи
+        await jobs.enqueue("sheet_rows", {"rows": rows, "at": datetime.now().strftime("%d.%m.%Y %H:%M")}, gid)
     except Exception as e:
-        print(f"❌ CRITICAL ERROR: {e}")
-        # Выводим полный текст ошибки, чтобы понять причину
-        import traceback
-        traceback.print_exc()
-        return False
\ No newline at end of file
+        print(f"❌ Sheets log rows not queued, retrying: {e}")
+        # Возвращаем строки в начало пачки; если новых строк нет, отложенную запись запускаем сами
+        newer = _pending_rows.get(gid)
+        _pending_rows[gid] = rows + (newer or [])
+        if newer is None and not await background.submit("sheets", _flush_rows, gid):
+            lost = _pending_rows.pop(gid, [])
+            print(f"❌ Sheets log rows dropped: {lost}")
+
+
+@jobs.handler("sheet_rows")
+async def _sheet_rows_job(rows, at):
+    await log_rewards_to_sheet([tuple(r) for r in rows], at)
+
+
+def _open(url):
+    return _sheets_client().open_by_url(url)
+
+
+def _append_tab(sh, tab, rows):
+    """Блокирующая запись строк в одну вкладку (в потоке)."""
+    sh.worksheet(tab).append_rows(rows, table_range="A8")
+
+
+async def _write_cells(cells):
+    """
+    Пишет готовые строки [время, очередь, основа, персонаж, статус], по вызову на вкладку.
+    Возвращает номера строк (в cells), которые точно не записаны и которые надо повторить.
+
+    Вкладки нет — её строки отбрасываются (повтор не поможет). Вызов не уложился в таймаут —
+    строки не повторяем: поток ещё мог дописать их, и повтор задвоил бы лог. Если запись
+    так и не дошла, недостающее допишет ночная сверка (см. reconcile.py).
+    """
+    import gspread
+    from requests.exceptions import ReadTimeout
+
+    guild = get_guild()
+    breaker = sheets_breaker()
+    by_tab = {}
+    for i, row in enumerate(cells):
+        # Вкладка по словарю гильдии; нет маппинга — пробуем имя очереди как есть
+        by_tab.setdefault(guild.queues.get(row[1]) or row[1], []).append(i)
+
+    unsent, written = [], 0
+    with track_sheets("append_reward"), span("append_reward", "sheets", rows=len(cells)):
+        try:
+            sh = await breaker.call(_open, guild.spreadsheet_url)
+        except Exception as e:
+            print(f"⏸ Google Sheets: {describe(e)} — {len(cells)} строк(и) отложено в outbox")
+            return list(range(len(cells)))
+
+        for tab, idx in by_tab.items():
+            try:
+                await breaker.call(_append_tab, sh, tab, [cells[i] for i in idx])
+                written += len(idx)
+            except gspread.WorksheetNotFound:
+                print(f"❌ ERROR: Вкладка '{tab}' НЕ НАЙДЕНА в таблице! Проверь название листа на пробелы и регистр.")
+            except (asyncio.TimeoutError, ReadTimeout):
+                print(f"⚠️ Google Sheets: вкладка '{tab}' не ответила за {breaker.timeout:g} с — "
+                      f"{len(idx)} строк(и) не повторяем (могли записаться), проверит сверка")
+            except gspread.exceptions.APIError as e:
+                print(f"❌ ERROR: Ошибка API Гугла во вкладке '{tab}'. Возможно, нет прав 'Редактора'. Строки отложены в outbox.")
+                print(f"   Детали: {e}")
+                unsent += idx
+            except Exception as e:
+                print(f"⏸ Google Sheets, вкладка '{tab}': {describe(e)} — {len(idx)} строк(и) отложено в outbox")
+                unsent += idx
+    if written: print(f"✅ Записано в Google: {written} строк(и)")
+    return sorted(unsent)
+
+
+async def log_rewards_to_sheet(rows, at=None):
+    """
+    Пишет строки (очередь, основа, персонаж, статус) во вкладки очередей текущей гильдии.
+    Не записанные точно (Google недоступен, ошибка) ждут в outbox со своим временем.
+    Возвращает True, если в outbox ничего не отложено.
+    """
+    at = at or datetime.now().strftime("%d.%m.%Y %H:%M")
+    cells = [[at, *row] for row in rows]
+    unsent = await _write_cells(cells)
+    if unsent:
+        session.add_all([SheetOutbox(logged_at=c[0], queue_name=c[1], main_nick=c[2], char_nick=c[3], status=c[4])
+                         for c in (cells[i] for i in unsent)])
+        session.commit()
+    return not unsent
+
+
+# --- OUTBOX ---
+
+def outbox_size():
+    return session.query(SheetOutbox).count()
+
+
+async def flush_outbox(limit=500):
+    """Дописывает отложенные строки текущей гильдии по порядку. Возвращает, сколько строк ещё ждёт."""
+    if sheets_breaker().state != CLOSED: return outbox_size()
+    rows = session.query(SheetOutbox).order_by(SheetOutbox.id).limit(limit).all()
+    if not rows: return 0
+    unsent = set(await _write_cells([[r.logged_at, r.queue_name, r.main_nick, r.char_nick, r.status] for r in rows]))
+    # Из outbox уходит всё, кроме точно не записанного: его попробуем в следующий раз
+    done = [r.id for i, r in enumerate(rows) if i not in unsent]
+    if done:
+        session.query(SheetOutbox).filter(SheetOutbox.id.in_(done)).delete(synchronize_session=False)
+        session.commit()
+    return outbox_size()
+
+
+async def sheets_status():
+    """Строка для панели мастера: связь с Google Sheets и отложенные строки."""
+    breaker = sheets_breaker()
+    pending = outbox_size()
+    waiting = f"\nОтложено строк лога: {pending}" if pending else ""
+    # Предохранитель свой в каждом процессе: пишет в таблицу воркер (WORKER_MODE=external), а панель —
+    # в боте. Берём худшее из своего и опубликованных другими (разомкнутый обновляется раз в SHEETS_RETRY_AFTER)
+    states = [(breaker.state, breaker.opened_at, breaker.last_error)]
+    try: states += await jobs.breaker_states(breaker.name, 3 * SHEETS_RETRY_AFTER)
+    except Exception as e: print(f"⚠️ Breaker states of {breaker.name} not read: {e}")
+    state, opened_at, last_error = max(states, key=lambda s: (CLOSED, HALF_OPEN, OPEN).index(s[0]))
+    if state == CLOSED:
+        return f"📡 Google Sheets: 🟢 на связи{waiting}"
+    since = datetime.fromtimestamp(opened_at).strftime("%H:%M")
+    state = "🟡 проверяем связь" if state == HALF_OPEN else "🔴 недоступна"
+    return (f"📡 Google Sheets: {state} с {since} ({last_error}).\n"
+            f"Ники проверяются по кэшу, записи в таблицу откладываются.{waiting}")
@@ -0,0 +1,96 @@
+import asyncio
+import signal
+import time
+import traceback
+from collections import deque
+
+from aiohttp import web
+from aiogram import types
+
+from metrics import Gauge
+from loader import bot, dp, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEB_HOST, WEB_PORT, WEBHOOK_MAX_INFLIGHT
+
+# Сколько ждём завершения текущих апдейтов при остановке
+DRAIN_TIMEOUT = 30
+
+# --- СОСТОЯНИЕ ---
+inflight = 0
+accepting = True
+drained = asyncio.Event()
+# Время обработки последних апдейтов (мс) — для локальных замеров
+latencies = deque(maxlen=1000)
+
+Gauge("bot_webhook_inflight", "Webhook updates being processed", lambda: inflight)
+
+
+async def handle_update(request: web.Request):
+    global inflight
+
+    # Секрет обязателен в режиме webhook (см. loader.py); без него приложение поднимают только локальные замеры
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+
+    # Backpressure: Telegram повторит апдейт, если мы ответим не 200
+    if not accepting or inflight >= WEBHOOK_MAX_INFLIGHT:
+        return web.Response(status=503)
+
+    inflight += 1
+    drained.clear()
+    started = time.perf_counter()
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        # Ошибку логируем, но отвечаем 200 — иначе Telegram будет слать апдейт по кругу
+        print(f"❌ Webhook update failed: {e}")
+        traceback.print_exc()
+    finally:
+        inflight -= 1
+        if inflight == 0: drained.set()
+
+    took_ms = (time.perf_counter() - started) * 1000
+    latencies.append(took_ms)
+    return web.Response(headers={"X-Process-Time-Ms": f"{took_ms:.2f}"})
+
+
+async def drain():
+    """Перестаёт принимать апдейты и ждёт, пока доработают уже принятые."""
+    global accepting
+    accepting = False
+    if inflight == 0: return
+    try:
+        await asyncio.wait_for(drained.wait(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Webhook drain timeout, still in flight: {inflight}")
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    return app
+
+
+async def run_webhook():
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        # Telegram принимает только 1-100; свой лимит (503 сверх WEBHOOK_MAX_INFLIGHT) от этого не меняется
+        max_connections=min(max(WEBHOOK_MAX_INFLIGHT, 1), 100),
+        drop_pending_updates=True,
+    )
+    print(f"🌐 Webhook listening on {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+
+    # Docker останавливает контейнер через SIGTERM — дожидаемся текущих апдейтов
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await drain()
+        await runner.cleanup()
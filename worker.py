@@ -0,0 +1,50 @@
+"""
+Воркер: выполняет задачи из очереди (jobs.py) в отдельном процессе — записи в Google Sheets,
+рассылки, бэкапы не делят ядро и цикл событий с кнопками игроков.
+
+Запуск рядом с ботом (бот — с WORKER_MODE=external, общие JOBS_DB_PATH, ROUTER_DB_PATH и базы гильдий):
+    python worker.py
+Воркеров может быть несколько: задачи берутся в аренду, одну задачу выполняет один воркер.
+Метрики воркера — на своём METRICS_PORT.
+"""
+import asyncio
+import logging
+import signal
+
+from loader import bot
+import jobs
+import metrics
+import lag_watchdog
+from database import init_db
+import breaker
+
+# Модули, где объявлены обработчики задач (@jobs.handler)
+import utils
+import reconcile
+import handlers.admin
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await metrics.start_metrics()
+    lag_watchdog.start()
+    print(f"🧰 Worker {jobs.WORKER_ID} started: {jobs.WORKER_CONCURRENCY} slot(s), jobs: {', '.join(jobs.kinds())}")
+    try:
+        # Начатые задачи доделываются; что не начато — останется в очереди
+        await jobs.run(stop)
+    finally:
+        await lag_watchdog.stop()
+        await breaker.stop_all()
+        await metrics.stop_metrics()
+        await bot.session.close()
+        print("Worker stopped")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    asyncio.run(main())